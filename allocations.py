@@ -0,0 +1,227 @@
+"""Per-endpoint memory allocation tracking with tracemalloc.
+
+When MEMORY_TRACKING is set, every request's peak traced allocation is
+recorded against its endpoint. The first request to each endpoint, and
+every MEMORY_SNAPSHOT_EVERY-th after that, also takes tracemalloc snapshots
+before and after, and keeps the source lines that allocated the most memory
+still alive when the request ended.
+
+tracemalloc is process-wide: allocations from requests running at the same
+time in other threads are mixed in. Numbers are cleanest with one request
+per worker at a time.
+
+tracemalloc slows allocation noticeably and snapshots take a while in a
+large process, so this is for finding regressions, not for every worker.
+"""
+
+import json
+import os
+import threading
+import tracemalloc
+from datetime import datetime
+
+from flask import current_app, g, request
+
+DEFAULT_DUMP_DIR = 'memory'
+DEFAULT_SNAPSHOT_EVERY = 10
+DEFAULT_TRACE_FRAMES = 1
+NUM_TOP_SITES = 10
+
+# allocations made by tracemalloc and this module aren't the request's
+SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+)
+
+
+class EndpointAllocations:
+    """Peak and top allocation sites for one endpoint."""
+
+    def __init__(self):
+        self.num_requests = 0
+        self.total_peak_bytes = 0
+        self.max_peak_bytes = 0
+        self.last_peak_bytes = 0
+        self.num_snapshots = 0
+        self.top_sites = []
+
+    def record_peak(self, peak_bytes):
+        self.num_requests += 1
+        self.total_peak_bytes += peak_bytes
+        self.max_peak_bytes = max(self.max_peak_bytes, peak_bytes)
+        self.last_peak_bytes = peak_bytes
+
+    def to_dict(self):
+        return {
+            'requests': self.num_requests,
+            'mean_peak_bytes': self.total_peak_bytes // max(self.num_requests, 1),
+            'max_peak_bytes': self.max_peak_bytes,
+            'last_peak_bytes': self.last_peak_bytes,
+            'snapshots': self.num_snapshots,
+            'top_sites': self.top_sites,
+        }
+
+
+class AllocationTracker:
+    """Flask extension recording allocations per endpoint.
+
+    Switched by the MEMORY_TRACKING config value, or at runtime with
+    enable() and disable(). Tracing is process-wide; what's recorded is
+    kept per app.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read settings and install request hooks."""
+
+        app.extensions['allocation_tracker'] = _State(
+            app.config.get('MEMORY_DUMP_DIR') or DEFAULT_DUMP_DIR,
+            app.config.get('MEMORY_SNAPSHOT_EVERY', DEFAULT_SNAPSHOT_EVERY),
+            app.config.get('MEMORY_TRACE_FRAMES', DEFAULT_TRACE_FRAMES)
+        )
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+        if app.config.get('MEMORY_TRACKING', False):
+            self.enable(app)
+
+    @property
+    def enabled(self):
+        return tracemalloc.is_tracing()
+
+    def enable(self, app=None):
+        """Start tracing allocations, with app's (by default the current
+        app's) settings."""
+
+        if not self.enabled:
+            tracemalloc.start(_state(app).trace_frames)
+
+    def disable(self, app=None):
+        """Stop tracing and forget what was recorded for app."""
+
+        if self.enabled:
+            tracemalloc.stop()
+
+        state = _state(app)
+
+        with state.lock:
+            state.endpoints = {}
+
+    def _start_request(self):
+        if not self.enabled:
+            return
+
+        state = _state()
+        endpoint = request.endpoint or 'none'
+
+        with state.lock:
+            stats = state.endpoints.setdefault(endpoint, EndpointAllocations())
+            take_snapshot = stats.num_requests % state.snapshot_every == 0
+
+        if take_snapshot:
+            g.allocations_snapshot = _snapshot()
+
+        tracemalloc.reset_peak()
+        g.allocations_started_at = tracemalloc.get_traced_memory()[0]
+
+    def _finish_request(self, response):
+        started_at = g.pop('allocations_started_at', None)
+        before = g.pop('allocations_snapshot', None)
+
+        if started_at is None or not self.enabled:
+            return response
+
+        peak = tracemalloc.get_traced_memory()[1] - started_at
+        top_sites = None
+
+        if before is not None:
+            top_sites = [
+                {
+                    'site': str(stat.traceback),
+                    'size_bytes': stat.size_diff,
+                    'count': stat.count_diff,
+                }
+                for stat in _snapshot().compare_to(before, 'lineno')[:NUM_TOP_SITES]
+                if stat.size_diff > 0
+            ]
+
+        state = _state()
+
+        with state.lock:
+            stats = state.endpoints.setdefault(
+                request.endpoint or 'none', EndpointAllocations())
+            stats.record_peak(peak)
+
+            if top_sites is not None:
+                stats.num_snapshots += 1
+                stats.top_sites = top_sites
+
+        return response
+
+    def report(self):
+        """Everything recorded for the current app so far, by endpoint,
+        largest peaks first."""
+
+        state = _state()
+
+        with state.lock:
+            endpoints = sorted(
+                state.endpoints.items(),
+                key=lambda item: -item[1].max_peak_bytes
+            )
+            endpoints = {name: stats.to_dict() for name, stats in endpoints}
+
+        return {
+            'pid': os.getpid(),
+            'tracing': self.enabled,
+            'traced_bytes': (tracemalloc.get_traced_memory()[0]
+                             if self.enabled else 0),
+            'endpoints': endpoints,
+        }
+
+    def dump(self):
+        """Write report and a full tracemalloc snapshot to the current app's
+        dump directory.
+
+        The snapshot can be loaded with tracemalloc.Snapshot.load to dig
+        further. Returns the two file names.
+        """
+
+        directory = _state().directory
+        os.makedirs(directory, exist_ok=True)
+
+        name = f'{datetime.now().strftime("%Y%m%d-%H%M%S-%f")}-{os.getpid()}'
+        report_name = f'{name}.json'
+        snapshot_name = f'{name}.tracemalloc'
+
+        with open(os.path.join(directory, report_name), 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+        _snapshot().dump(os.path.join(directory, snapshot_name))
+
+        return report_name, snapshot_name
+
+
+class _State:
+    """One app's settings, and what's been recorded for its endpoints."""
+
+    def __init__(self, directory, snapshot_every, trace_frames):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.trace_frames = trace_frames
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+
+def _state(app=None):
+    return (app or current_app).extensions['allocation_tracker']
+
+
+def _snapshot():
+    return tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+
+
+allocation_tracker = AllocationTracker()
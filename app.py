@@ -1,30 +1,104 @@
 import os
+import time
 from dotenv import load_dotenv
-from flask import Flask, g, redirect, render_template, session, flash, request
-from sqlalchemy.exc import IntegrityError, NoResultFound
-from models import db, connect_db, User, Project, Needle, Hook, Yarn, TimeLog, Request, Participant, Message, Conversation
+from flask import Blueprint, Flask, g, redirect, render_template, session, flash, request, Response, jsonify, get_template_attribute, abort
+from sqlalchemy.exc import IntegrityError
+from models import db, connect_db, User, Project, Needle, Hook, Yarn, TimeLog, Follow, Request, Participant, Message, Conversation, Notification
 from forms import CSRFProtectForm, SignupForm, LoginForm, NewProjectForm, EditProjectForm, ProjectTimeLogForm, EditTimeLogForm, EditUserForm, MessageForm, NewConversationForm, ProgressForm
 from functools import wraps
 from utils import removeFieldListEntry
+from transactions import unit_of_work
+from streams import broker, notify_new_message, stream_messages, StreamLimitReached
+from follow_graph import follow_graphs
+from sql_timing import sql_timing
+from metrics import metrics
+from slow_queries import slow_query_log
+from profiling import profiler
+from allocations import allocation_tracker
+from replicas import replica_router
+from read_only import read_only_requests
+from dialects import is_postgresql
+
+
+# every route; create_app registers them on the app
+views = Blueprint('views', __name__)
+
+
+def config_from_env():
+    """Read settings from the environment, and from .env if there is one."""
+
+    load_dotenv()
+
+    return {
+        'SQLALCHEMY_DATABASE_URI': os.environ.get('DATABASE_URL'),
+        'SECRET_KEY': os.environ.get('SECRET_KEY'),
+        'DB_POOL_SIZE': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'DB_MAX_OVERFLOW': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'DB_POOL_RECYCLE': int(os.environ.get('DB_POOL_RECYCLE', -1)),
+        'DB_POOL_PRE_PING': bool(int(os.environ.get('DB_POOL_PRE_PING', 0))),
+        'DB_STATEMENT_TIMEOUT_MS': int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0)),
+        'DB_PGBOUNCER': bool(int(os.environ.get('DB_PGBOUNCER', 0))),
+        'LISTEN_DATABASE_URL': os.environ.get('LISTEN_DATABASE_URL'),
+        'REPLICA_DATABASE_URL': os.environ.get('REPLICA_DATABASE_URL'),
+        'REPLICA_STICKY_SECONDS': float(os.environ.get('REPLICA_STICKY_SECONDS', 10)),
+        'BCRYPT_LOG_ROUNDS': int(os.environ.get('BCRYPT_LOG_ROUNDS', 12)),
+        'MAX_MESSAGE_STREAMS': int(os.environ.get('MAX_MESSAGE_STREAMS', 100)),
+        'FOLLOW_GRAPH_MAX_AGE': int(os.environ.get('FOLLOW_GRAPH_MAX_AGE', 300)),
+        'SQL_TIMING': bool(int(os.environ.get('SQL_TIMING', 0))),
+        'METRICS_ENABLED': bool(int(os.environ.get('METRICS_ENABLED', 0))),
+        'METRICS_DIR': os.environ.get('METRICS_DIR'),
+        'METRICS_TOKEN': os.environ.get('METRICS_TOKEN'),
+        'SLOW_QUERY_MS': float(os.environ.get('SLOW_QUERY_MS', 0)),
+        'SLOW_QUERY_LOG': os.environ.get('SLOW_QUERY_LOG', 'slow_queries.log'),
+        'SLOW_QUERY_EXPLAIN_RATE': float(os.environ.get('SLOW_QUERY_EXPLAIN_RATE', 0)),
+        'PROFILER_ENABLED': bool(int(os.environ.get('PROFILER_ENABLED', 0))),
+        'PROFILE_DIR': os.environ.get('PROFILE_DIR', 'profiles'),
+        'MEMORY_TRACKING': bool(int(os.environ.get('MEMORY_TRACKING', 0))),
+        'MEMORY_DUMP_DIR': os.environ.get('MEMORY_DUMP_DIR', 'memory'),
+    }
+
+
+def create_app(config=None):
+    """Create the app.
+
+    Settings come from the environment; config (a dict) overrides them, e.g.
+    create_app({'DB_POOL_SIZE': 20}). Nothing connects to the database and
+    no app context is pushed until the app is used, so a server can load the
+    app and then fork workers (gunicorn --preload).
+    """
 
+    app = Flask(__name__)
+    app.config.from_mapping(config_from_env())
+    app.config.from_mapping(config or {})
 
-load_dotenv()
-
+    connect_db(app)
+    # before any hook that queries
+    replica_router.init_app(app)
+    read_only_requests.init_app(app)
+    broker.init_app(app)
+    follow_graphs.init_app(app)
+    sql_timing.init_app(app)
+    metrics.init_app(app)
+    slow_query_log.init_app(app)
+    allocation_tracker.init_app(app)
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
-app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+    app.register_blueprint(views)
 
+    # after add_user_to_g, since only admins can profile requests
+    profiler.init_app(app)
 
-connect_db(app)
+    return app
 
 
 DEFAULT_NEEDLE_DATA = {'size': 'US 00000000 - 0.5 mm'}
 DEFAULT_HOOK_DATA = {'size': '0.6 mm'}
 CURR_USER_KEY = 'user'
+NAV_COUNTS_KEY = 'nav_counts'
+NAV_COUNTS_SECONDS = 30
+NUM_REQUESTS_SHOWN = 20
 
 
-@app.before_request
+@views.before_app_request
 def add_user_to_g():
     """If logged in, add current user to request."""
 
@@ -33,11 +107,17 @@ def add_user_to_g():
     else:
         g.user = None
 
+    g.user_visibility = {}
 
-@app.before_request
+
+@views.before_app_request
 def add_csrf_form_to_g():
     """Add CSRF-only form so every route can access"""
 
+    # g outlives the request when an app context was pushed beforehand (as
+    # tests and scripts do), and Flask-WTF caches the signed token there;
+    # drop it so each request's token comes from its own session
+    g.pop('csrf_token', None)
     g.csrf_form = CSRFProtectForm()
 
 
@@ -56,28 +136,91 @@ def login_required(f):
     return login_decorator
 
 
+def admin_required(f):
+    """Function decorator. Checks user is an admin."""
+
+    @wraps(f)
+    def admin_decorator(*args, **kwargs):
+
+        if not g.user or not g.user.is_admin:
+            abort(403)
+
+        return f(*args, **kwargs)
+
+    return admin_decorator
+
+
 def check_authorization(f):
-    """Function decorator. Checks if user allowed to access a resource."""
+    """Function decorator. Checks if user allowed to access a resource.
+
+    Passes the loaded user on to the view.
+    """
 
     @wraps(f)
     def authorization_decorator(user_id):
 
-        other_user = User.query.get_or_404(user_id)
+        other_user, can_view = get_user_visibility(user_id)
 
-        if other_user.private:
-            if g.user != other_user and not g.user.is_following(other_user):
-                return render_template('users/private.html', user=other_user)
+        if not can_view:
+            return render_profile('users/private.html', other_user)
 
-        return f(user_id)
+        return f(user_id, other_user)
 
     return authorization_decorator
 
 
+def get_user_visibility(user_id):
+    """Get (user, can_view) for the current user, or 404.
+
+    One query, memoized for the rest of the request.
+    """
+
+    if user_id not in g.user_visibility:
+        row = User.get_with_visibility(user_id, g.user.id)
+
+        if row is None:
+            abort(404)
+
+        g.user_visibility[user_id] = tuple(row)
+
+    return g.user_visibility[user_id]
+
+
+def render_profile(template, user, **context):
+    """Render a page of user's profile, with g.user's follow state for its
+    Follow button (see User.get_follow_state)."""
+
+    follow_state = None
+
+    if user.id != g.user.id:
+        follow_state = user.get_follow_state(g.user.id)
+
+    return render_template(
+        template, user=user, follow_state=follow_state, **context)
+
+
+def get_sizes(model, entries):
+    """Get Needle or Hook rows for the sizes chosen in form entries.
+
+    One query for all entries. Returned in entry order, skipping unknown
+    sizes.
+    """
+
+    sizes = [entry.data['size'] for entry in entries]
+
+    if not sizes:
+        return []
+
+    by_size = {m.size: m for m in model.query.filter(model.size.in_(sizes))}
+
+    return [by_size[size] for size in sizes if size in by_size]
+
 
 def login_user(user):
     """Save user to session."""
 
     session[CURR_USER_KEY] = user.id
+    clear_nav_counts()
 
 
 def logout_user():
@@ -86,8 +229,37 @@ def logout_user():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+    clear_nav_counts()
+
+
+@views.app_template_global()
+def nav_counts():
+    """(follow requests waiting, unread messages) for the logged in user.
+
+    The navbar shows these on every page, so they're kept in the session
+    for NAV_COUNTS_SECONDS rather than counted each time. Views that change
+    them for the user call clear_nav_counts(); changes made by other users
+    show up once they expire.
+    """
+
+    cached = session.get(NAV_COUNTS_KEY)
+
+    if cached and cached[2] > time.time():
+        return cached[0], cached[1]
 
-@app.get('/')
+    counts = (g.user.count_requests_received(), g.user.count_unread_messages())
+    session[NAV_COUNTS_KEY] = [*counts, time.time() + NAV_COUNTS_SECONDS]
+
+    return counts
+
+
+def clear_nav_counts():
+    """Count the navbar's follow requests and unread messages afresh."""
+
+    session.pop(NAV_COUNTS_KEY, None)
+
+
+@views.get('/')
 def homepage():
     """Show homepage.
 
@@ -113,7 +285,7 @@ def homepage():
 # User signup/login/logout
 
 
-@app.route('/signup', methods=['GET', 'POST'])
+@views.route('/signup', methods=['GET', 'POST'])
 def signup():
     """Handle user sign up.
 
@@ -144,7 +316,7 @@ def signup():
     return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@views.route('/login', methods=['GET', 'POST'])
 def login():
     """Handle user login.
 
@@ -168,7 +340,7 @@ def login():
 
     return render_template('users/login.html', form=form)
 
-@app.post('/logout')
+@views.post('/logout')
 def logout():
     """Handle user logout.
 
@@ -188,7 +360,7 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.get('/users')
+@views.get('/users')
 @login_required
 def user_list():
     """Page listing users.
@@ -201,26 +373,49 @@ def user_list():
     else:
         users = User.query.all()
 
-    return render_template('users/user_list.html', users=users)
+    return render_template(
+        'users/user_list.html',
+        users=users,
+        follow_states=User.get_follow_states(g.user.id, [u.id for u in users])
+    )
 
 
-@app.get('/profile')
+@views.get('/users/search')
+@login_required
+def search_users():
+    """Return JSON of users whose username starts with query param 'q'.
+
+    Used to autocomplete message recipients.
+    """
+
+    prefix = request.args.get('q', '').strip()
+
+    if not prefix:
+        return jsonify(users=[])
+
+    users = User.search_by_prefix(prefix, exclude_id=g.user.id)
+
+    return jsonify(users=[{'id': u.id, 'username': u.username} for u in users])
+
+
+@views.get('/profile')
 @login_required
 def user_profile():
     """User profile."""
 
     user = User.query.get_or_404(g.user.id)
 
-    projects = Project.query.filter(
-        Project.user_id == user.id
-        ).order_by(
-            Project.pinned.desc(), Project.created_at.desc()
-        )
+    projects = Project.get_cards(user.id)
 
-    return render_template('users/projects.html', user=user, projects=projects)
+    return render_template(
+        'users/projects.html',
+        user=user,
+        projects=projects,
+        suggestions=user.get_suggestions()
+    )
 
 
-@app.route('/settings', methods=['GET', 'POST'])
+@views.route('/settings', methods=['GET', 'POST'])
 @login_required
 def settings():
     """Show user settings."""
@@ -241,39 +436,70 @@ def settings():
     return render_template('users/settings.html', form=form)
 
 
-@app.get('/notifications')
+@views.get('/notifications')
 @login_required
 def notifications():
-    """Show user notifications."""
+    """Show user notifications.
+
+    Shows the first pending follow requests, by requesting user's id, then a
+    page of notifications.
+    Takes query param, 'before', the cursor of the next page.
+    """
+
+    before = request.args.get('before')
+
+    if before:
+        try:
+            before = Notification.decode_cursor(before)
+        except ValueError:
+            abort(400)
 
     follow_requests = db.session.query(
         Request.user_requesting_id,
         User.username
-    ).outerjoin(User, User.id == Request.user_requesting_id).filter(
+    ).join(User, User.id == Request.user_requesting_id).filter(
         Request.user_being_requested_id == g.user.id
-    ).all()
+    ).order_by(Request.user_requesting_id).limit(NUM_REQUESTS_SHOWN).all()
+
+    num_requests = len(follow_requests)
+
+    if num_requests == NUM_REQUESTS_SHOWN:
+        num_requests = g.user.count_requests_received()
 
-    return render_template('users/notifications.html', follow_requests = follow_requests)
+    events, next_page = Notification.get_page(g.user.id, before)
+
+    return render_template(
+        'users/notifications.html',
+        follow_requests = follow_requests,
+        num_requests = num_requests,
+        events = events,
+        next_cursor = next_page and Notification.encode_cursor(next_page)
+    )
 
 
-@app.get('/users/<int:user_id>')
+@views.get('/users/<int:user_id>')
 @login_required
 @check_authorization
-def user_page(user_id):
-    """Show user profile."""
+def user_page(user_id, user):
+    """Show user profile, with the users g.user follows who follow them."""
 
-    user = User.query.get_or_404(user_id)
+    projects = Project.get_cards(user_id)
 
-    projects = Project.query.filter(
-        Project.user_id == user_id
-        ).order_by(
-            Project.pinned.desc(), Project.created_at.desc()
-        )
+    followed_by, num_followed_by = [], 0
 
-    return render_template('users/projects.html', user=user, projects=projects)
+    if user_id != g.user.id:
+        followed_by, num_followed_by = user.get_followed_by_following(g.user.id)
 
+    return render_profile(
+        'users/projects.html',
+        user,
+        projects=projects,
+        followed_by=followed_by,
+        num_followed_by=num_followed_by
+    )
 
-@app.post('/settings/private')
+
+@views.post('/settings/private')
 @login_required
 def private_account():
     """Handle privating account."""
@@ -291,47 +517,84 @@ def private_account():
     return render_template('users/settings.html', form=form)
 
 
-@app.post('/settings/unprivate')
+@views.post('/settings/unprivate')
 @login_required
 def unprivate_account():
-    """Handle unprivating account."""
+    """Handle unprivating account.
+
+    Pending follow requests are all accepted, since anyone could now follow.
+    """
 
     form = g.csrf_form
 
     if form.validate_on_submit():
-        user = User.query.get(g.user.id)
+        with unit_of_work():
+            user = User.query.get(g.user.id)
 
-        user.private = False
-        db.session.commit()
+            user.private = False
+            num_accepted = Request.accept(user.id)
+
+        clear_nav_counts()
 
         flash('Account now public.', 'success')
 
+        if num_accepted:
+            flash(f'Confirmed {num_accepted} pending follow requests.', 'success')
+
     return render_template('users/settings.html', form=form)
 
 
-@app.get('/users/<int:user_id>/following')
+@views.get('/users/<int:user_id>/following')
 @login_required
 def user_following(user_id):
-    """Show user profile."""
+    """Show a page of users user follows.
+
+    Takes query param, 'after', the cursor of the next page.
+    """
 
-# TODO: n+1
     user = User.query.get_or_404(user_id)
+    users, next_after = user.get_following(request.args.get('after', type=int))
 
-    return render_template('users/following.html', user=user)
+    # the profile's own Follow button and the cards', in one query
+    follow_states = User.get_follow_states(
+        g.user.id, [user.id] + [u.id for u in users])
+
+    return render_template(
+        'users/following.html',
+        user=user,
+        users=users,
+        next_after=next_after,
+        follow_state=follow_states.get(user.id),
+        follow_states=follow_states
+    )
 
 
-@app.get('/users/<int:user_id>/followers')
+@views.get('/users/<int:user_id>/followers')
 @login_required
 def user_followers(user_id):
-    """Show user profile."""
+    """Show a page of users following user.
+
+    Takes query param, 'after', the cursor of the next page.
+    """
 
-# TODO: n+1
     user = User.query.get_or_404(user_id)
+    users, next_after = user.get_followers(request.args.get('after', type=int))
 
-    return render_template('users/followers.html', user=user)
+    # the profile's own Follow button and the cards', in one query
+    follow_states = User.get_follow_states(
+        g.user.id, [user.id] + [u.id for u in users])
+
+    return render_template(
+        'users/followers.html',
+        user=user,
+        users=users,
+        next_after=next_after,
+        follow_state=follow_states.get(user.id),
+        follow_states=follow_states
+    )
 
 
-@app.post('/users/delete')
+@views.post('/users/delete')
 @login_required
 def delete_user():
     """Handle deleting user."""
@@ -349,7 +612,7 @@ def delete_user():
     return redirect(f'/signup')
 
 
-@app.post('/users/<int:user_id>/follow')
+@views.post('/users/<int:user_id>/follow')
 @login_required
 def follow_user(user_id):
     """Handle following user."""
@@ -363,12 +626,12 @@ def follow_user(user_id):
         return redirect("/")
 
     if user.private:
-        user.requests_received.append(g.user)
+        Request.add(user.id, g.user.id)
         db.session.commit()
         flash(f'Request sent to {user.username}', 'success')
 
     else:
-        user.followers.append(g.user)
+        Follow.add(user.id, g.user.id)
         db.session.commit()
         flash(f'Now following {user.username}', 'success')
 
@@ -377,7 +640,7 @@ def follow_user(user_id):
     return redirect(redirect_url)
 
 
-@app.post('/users/<int:user_id>/unfollow')
+@views.post('/users/<int:user_id>/unfollow')
 @login_required
 def unfollow_user(user_id):
     """Handle unfollowing user."""
@@ -390,7 +653,7 @@ def unfollow_user(user_id):
         flash('Unauthorized', 'danger')
         return redirect("/")
 
-    user.followers.remove(g.user)
+    Follow.remove(user.id, g.user.id)
     db.session.commit()
 
     redirect_url = request.form.get("came_from", "/")
@@ -399,7 +662,7 @@ def unfollow_user(user_id):
     return redirect(redirect_url)
 
 
-@app.post('/users/<int:user_id>/cancel_request')
+@views.post('/users/<int:user_id>/cancel_request')
 @login_required
 def cancel_follow_request(user_id):
     """Handle canceling follow request user."""
@@ -412,7 +675,7 @@ def cancel_follow_request(user_id):
         flash('Unauthorized', 'danger')
         return redirect("/")
 
-    user.requests_received.remove(g.user)
+    Request.remove(user.id, g.user.id)
     db.session.commit()
 
     redirect_url = request.form.get("came_from", "/")
@@ -424,7 +687,7 @@ def cancel_follow_request(user_id):
 ##############################################################################
 # Request routes:
 
-@app.post('/requests/<int:requesting_user_id>/confirm')
+@views.post('/requests/<int:requesting_user_id>/confirm')
 @login_required
 def confirm_request(requesting_user_id):
     """Confirm follow request."""
@@ -435,19 +698,19 @@ def confirm_request(requesting_user_id):
         flash('Unauthorized', 'danger')
         return redirect("/")
 
-    follow_request = Request.query.get_or_404((g.user.id, requesting_user_id))
-    db.session.delete(follow_request)
-    db.session.commit()
+    with unit_of_work():
+        other_user = User.query.get_or_404(requesting_user_id)
 
-    other_user = User.query.get_or_404(requesting_user_id)
-    g.user.followers.append(other_user)
-    db.session.commit()
+        if not Request.accept(g.user.id, requesting_user_id):
+            abort(404)
+
+    clear_nav_counts()
 
     flash(f'{other_user.username} is following you now.', 'success')
     return redirect('/notifications')
 
 
-@app.post('/requests/<int:requesting_user_id>/delete')
+@views.post('/requests/<int:requesting_user_id>/delete')
 @login_required
 def delete_request(requesting_user_id):
     """Delete follow request."""
@@ -458,18 +721,59 @@ def delete_request(requesting_user_id):
         flash('Unauthorized', 'danger')
         return redirect("/")
 
-    follow_request = Request.query.get_or_404((g.user.id, requesting_user_id))
-    db.session.delete(follow_request)
+    if not Request.deny(g.user.id, requesting_user_id):
+        abort(404)
+
     db.session.commit()
+    clear_nav_counts()
 
     flash('Deleted follow request.', 'success')
     return redirect('/notifications')
 
 
+@views.post('/requests/confirm_all')
+@login_required
+def confirm_all_requests():
+    """Confirm all pending follow requests."""
+
+    form = g.csrf_form
+
+    if not form.validate_on_submit():
+        flash('Unauthorized', 'danger')
+        return redirect("/")
+
+    with unit_of_work():
+        num_accepted = Request.accept(g.user.id)
+
+    clear_nav_counts()
+
+    flash(f'Confirmed {num_accepted} follow requests.', 'success')
+    return redirect('/notifications')
+
+
+@views.post('/requests/delete_all')
+@login_required
+def delete_all_requests():
+    """Delete all pending follow requests."""
+
+    form = g.csrf_form
+
+    if not form.validate_on_submit():
+        flash('Unauthorized', 'danger')
+        return redirect("/")
+
+    num_denied = Request.deny(g.user.id)
+    db.session.commit()
+    clear_nav_counts()
+
+    flash(f'Deleted {num_denied} follow requests.', 'success')
+    return redirect('/notifications')
+
+
 ##############################################################################
 # Project routes:
 
-@app.route('/projects/new', methods=['POST', 'GET'])
+@views.route('/projects/new', methods=['POST', 'GET'])
 @login_required
 def add_project():
     """Handle new project creation.
@@ -491,66 +795,71 @@ def add_project():
     elif removeFieldListEntry(form.hooks):
         pass
     elif form.validate_on_submit():
-        project = Project(
-            user_id = g.user.id,
-            title = form.title.data or form.pattern.data or None,
-            pattern = form.pattern.data,
-            designer = form.designer.data,
-            progress = form.progress.data
-        )
+        with unit_of_work():
+            project = Project(
+                user_id = g.user.id,
+                title = form.title.data or form.pattern.data or None,
+                pattern = form.pattern.data,
+                designer = form.designer.data,
+                progress = form.progress.data
+            )
 
-        for needle in form.needles.entries:
-            needle = Needle.query.get(needle.data['size'])
-            if needle:
-                project.needles.append(needle)
-
-        for hook in form.hooks.entries:
-            hook = Hook.query.get(hook.data['size'])
-            if hook:
-                project.hooks.append(hook)
-
-        for yarn in form.yarns.entries:
-            project.yarns.append(
-                Yarn(
-                    yarn_name = yarn.data['yarn_name'],
-                    color = yarn.data['color'],
-                    dye_lot = yarn.data['dye_lot'],
-                    weight = yarn.data['weight'],
-                    skein_weight = yarn.data['skein_weight'],
-                    skein_weight_unit = yarn.data['skein_weight_unit'],
-                    skein_length = yarn.data['skein_length'],
-                    skein_length_unit = yarn.data['skein_length_unit'],
-                    num_skeins = yarn.data['num_skeins']
+            project.needles = get_sizes(Needle, form.needles.entries)
+            project.hooks = get_sizes(Hook, form.hooks.entries)
+
+            for yarn in form.yarns.entries:
+                project.yarns.append(
+                    Yarn(
+                        yarn_name = yarn.data['yarn_name'],
+                        color = yarn.data['color'],
+                        dye_lot = yarn.data['dye_lot'],
+                        weight = yarn.data['weight'],
+                        skein_weight = yarn.data['skein_weight'],
+                        skein_weight_unit = yarn.data['skein_weight_unit'],
+                        skein_length = yarn.data['skein_length'],
+                        skein_length_unit = yarn.data['skein_length_unit'],
+                        num_skeins = yarn.data['num_skeins']
+                    )
                 )
-            )
 
-        db.session.add(project)
-        db.session.commit()
+            db.session.add(project)
 
         flash('New project added', 'success')
         return redirect(f'/projects/{project.id}')
 
     return render_template('projects/create.html', form=form)
 
-# TODO: add testing to check authorization
-@app.get('/projects/<int:project_id>')
+@views.get('/projects/<int:project_id>')
 @login_required
 def project_details(project_id):
     """Show project details."""
 
-    project = Project.query.get_or_404(project_id)
+    row = Project.get_with_visibility(project_id, g.user.id)
+
+    if row is None:
+        abort(404)
+
+    project, can_view = row
+
+    if not can_view:
+        return render_profile('users/private.html', project.user)
+
     form = ProgressForm(obj=project)
 
-    other_user = User.query.get_or_404(project.user_id)
+    follow_state = None
 
-    if other_user.private:
-        if g.user != other_user and not g.user.is_following(other_user):
-            return render_template('users/private.html', user=other_user)
+    if project.user_id != g.user.id:
+        follow_state = project.user.get_follow_state(g.user.id)
 
-    return render_template('projects/details.html', project=project, form=form)
+    return render_template(
+        'projects/details.html',
+        project=project,
+        form=form,
+        follow_state=follow_state
+    )
 
 
-@app.route('/projects/<int:project_id>/edit', methods=['GET', 'POST'])
+@views.route('/projects/<int:project_id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_project(project_id):
     """Handle editing project.
@@ -578,40 +887,30 @@ def edit_project(project_id):
     elif removeFieldListEntry(form.hooks):
         pass
     elif form.validate_on_submit():
-        project.title = form.title.data or None
-        project.pattern = form.pattern.data
-        project.designer = form.designer.data
-        project.progress = form.progress.data
-
-        project.needles = []
-        for needle in form.needles.entries:
-            needle = Needle.query.get(needle.data['size'])
-            if needle:
-                project.needles.append(needle)
-
-        project.hooks = []
-        for hook in form.hooks.entries:
-            hook = Hook.query.get(hook.data['size'])
-            if hook:
-                project.hooks.append(hook)
-
-        project.yarns = []
-        for yarn in form.yarns.entries:
-            project.yarns.append(
-                Yarn(
-                    yarn_name = yarn.data['yarn_name'],
-                    color = yarn.data['color'],
-                    dye_lot = yarn.data['dye_lot'],
-                    weight = yarn.data['weight'],
-                    skein_weight = yarn.data['skein_weight'],
-                    skein_weight_unit = yarn.data['skein_weight_unit'],
-                    skein_length = yarn.data['skein_length'],
-                    skein_length_unit = yarn.data['skein_length_unit'],
-                    num_skeins = yarn.data['num_skeins']
+        with unit_of_work():
+            project.title = form.title.data or None
+            project.pattern = form.pattern.data
+            project.designer = form.designer.data
+            project.progress = form.progress.data
+
+            project.needles = get_sizes(Needle, form.needles.entries)
+            project.hooks = get_sizes(Hook, form.hooks.entries)
+
+            project.yarns = []
+            for yarn in form.yarns.entries:
+                project.yarns.append(
+                    Yarn(
+                        yarn_name = yarn.data['yarn_name'],
+                        color = yarn.data['color'],
+                        dye_lot = yarn.data['dye_lot'],
+                        weight = yarn.data['weight'],
+                        skein_weight = yarn.data['skein_weight'],
+                        skein_weight_unit = yarn.data['skein_weight_unit'],
+                        skein_length = yarn.data['skein_length'],
+                        skein_length_unit = yarn.data['skein_length_unit'],
+                        num_skeins = yarn.data['num_skeins']
+                    )
                 )
-            )
-
-        db.session.commit()
 
         flash('Project edited.', 'success')
         return redirect(f'/projects/{project_id}')
@@ -619,7 +918,7 @@ def edit_project(project_id):
     return render_template('projects/edit.html', form=form, project_id=project.id)
 
 
-@app.post('/projects/<int:project_id>/edit_progress')
+@views.post('/projects/<int:project_id>/edit_progress')
 @login_required
 def edit_project_progress(project_id):
     """Handle editing project.
@@ -644,7 +943,7 @@ def edit_project_progress(project_id):
 
     return render_template('projects/edit.html', project=project, form=form)
 
-@app.post('/projects/<int:project_id>/delete')
+@views.post('/projects/<int:project_id>/delete')
 @login_required
 def delete_project(project_id):
     """Handle deleting project."""
@@ -665,7 +964,7 @@ def delete_project(project_id):
     return redirect(f'/users/{g.user.id}')
 
 
-@app.post('/projects/<int:project_id>/pin')
+@views.post('/projects/<int:project_id>/pin')
 @login_required
 def pin_project(project_id):
     """Handle pinning project."""
@@ -687,7 +986,7 @@ def pin_project(project_id):
     return redirect(redirect_url)
 
 
-@app.post('/projects/<int:project_id>/unpin')
+@views.post('/projects/<int:project_id>/unpin')
 @login_required
 def unpin_project(project_id):
     """Handle unpinning project."""
@@ -709,7 +1008,7 @@ def unpin_project(project_id):
     return redirect(redirect_url)
 
 
-@app.route('/projects/log_time', methods=['GET', 'POST'])
+@views.route('/projects/log_time', methods=['GET', 'POST'])
 @login_required
 def time_log_form():
     """Display project time logging form."""
@@ -727,16 +1026,16 @@ def time_log_form():
             flash('Unauthorized', 'danger')
             return redirect("/")
 
-        log = TimeLog(
-            project_id=project.id,
-            date=form.date.data,
-            hours=form.hours.data,
-            minutes=form.minutes.data,
-            notes=form.notes.data
-        )
+        with unit_of_work():
+            log = TimeLog(
+                project_id=project.id,
+                date=form.date.data,
+                hours=form.hours.data,
+                minutes=form.minutes.data,
+                notes=form.notes.data
+            )
 
-        project.time_logs.append(log)
-        db.session.commit()
+            db.session.add(log)
 
         flash('Project log created.', 'success')
         return redirect(f'/projects/{log.project_id}')
@@ -744,7 +1043,7 @@ def time_log_form():
     return render_template('projects/time-log.html',form=form)
 
 
-@app.get('/projects/<int:project_id>/log_time')
+@views.get('/projects/<int:project_id>/log_time')
 @login_required
 def selected_project_time_log_form(project_id):
     """Display project time logging form."""
@@ -763,7 +1062,7 @@ def selected_project_time_log_form(project_id):
     return render_template('projects/time-log.html',form=form)
 
 
-@app.route('/logs/<int:log_id>/edit', methods=['GET', 'POST'])
+@views.route('/logs/<int:log_id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_time_log(log_id):
     """Display project time logging form."""
@@ -792,7 +1091,7 @@ def edit_time_log(log_id):
 ##############################################################################
 # Conversation routes:
 
-@app.get('/conversations')
+@views.get('/conversations')
 @login_required
 def conversations_page():
     """Display conversations page."""
@@ -801,24 +1100,21 @@ def conversations_page():
 
     return render_template('conversations/no_conversation_selected.html', conversations = conversations)
 
-@app.get('/conversations/<int:conversation_id>')
+@views.get('/conversations/<int:conversation_id>')
 @login_required
 def show_converation(conversation_id):
-    """Display conversation."""
+    """Display conversation.
+
+    Read-only, like every GET; the page marks the messages it shows read
+    with a POST to api_mark_read.
+    """
 
     form = MessageForm()
 
-    try:
-        Participant.query.filter(
-        Participant.user_id == g.user.id,
-        Participant.conversation_id == conversation_id
-        ).one()
-    except NoResultFound:
+    if not Participant.is_participant(g.user.id, conversation_id):
         flash('Unauthorized', 'danger')
         return redirect('/')
 
-    conversations = g.user.get_conversations()
-
     participants = db.session.query(User).outerjoin(
         Participant
     ).filter(
@@ -827,11 +1123,14 @@ def show_converation(conversation_id):
     ).all()
 
     messages = db.session.query(
+        Message.id,
         Message.user_id,
         Message.text
     ).filter(
         Message.conversation_id == conversation_id
-    ).all()
+    ).order_by(Message.id).all()
+
+    conversations = g.user.get_conversations()
 
     return render_template(
         'conversations/conversation.html',
@@ -842,20 +1141,14 @@ def show_converation(conversation_id):
         form=form
         )
 
-@app.post('/conversations/<int:conversation_id>/new_message')
+@views.post('/conversations/<int:conversation_id>/new_message')
 @login_required
 def send_message(conversation_id):
     """Send new message."""
 
     form = MessageForm()
 
-    try:
-        Participant.query.filter(
-        Participant.user_id == g.user.id,
-        Participant.conversation_id == conversation_id
-        ).one()
-
-    except NoResultFound:
+    if not Participant.is_participant(g.user.id, conversation_id):
         flash('Unauthorized', 'danger')
         return redirect('/')
 
@@ -867,41 +1160,204 @@ def send_message(conversation_id):
         )
 
         db.session.add(message)
+        db.session.flush()
+        notify_new_message(db.session, message)
+        Notification.add_for_message(message)
         db.session.commit()
 
         return redirect(f'/conversations/{conversation_id}')
 
     return render_template('conversations/conversation.html', form=form)
 
-@app.route('/conversations/new', methods=['POST', 'GET'])
+@views.post('/api/conversations/<int:conversation_id>/read')
+@login_required
+def api_mark_read(conversation_id):
+    """Mark conversation read up to the posted message_id.
+
+    Only ever changes the user's own participant row, so needs no
+    participant check: for other conversations it updates nothing.
+    """
+
+    form = g.csrf_form
+    message_id = request.form.get('message_id', type=int)
+
+    if not form.validate_on_submit() or message_id is None:
+        return (jsonify(errors={'message_id': ['Invalid']}), 400)
+
+    Participant.mark_read(g.user.id, conversation_id, message_id)
+    db.session.commit()
+    clear_nav_counts()
+
+    return ('', 204)
+
+@views.post('/api/conversations/<int:conversation_id>/messages')
+@login_required
+def api_send_message(conversation_id):
+    """Send new message and return it as JSON.
+
+    Response includes the message's rendered HTML, so the page can show it
+    without reloading the whole conversation.
+    """
+
+    if not Participant.is_participant(g.user.id, conversation_id):
+        return (jsonify(errors={'conversation': ['Unauthorized']}), 403)
+
+    form = MessageForm()
+
+    if not form.validate_on_submit():
+        return (jsonify(errors=form.errors), 400)
+
+    message = Message(
+        user_id=g.user.id,
+        conversation_id=conversation_id,
+        text=form.message.data,
+    )
+
+    db.session.add(message)
+    db.session.flush()
+    notify_new_message(db.session, message)
+    Notification.add_for_message(message)
+
+    # read before commit expires message, which would cost a reload
+    serialized = {
+        'id': message.id,
+        'user_id': message.user_id,
+        'text': message.text,
+    }
+
+    db.session.commit()
+
+    create_message = get_template_attribute(
+        'conversations/macros.html', 'create_message')
+
+    return (jsonify(message=serialized, html=str(create_message(serialized))), 201)
+
+@views.get('/conversations/<int:conversation_id>/stream')
+@login_required
+def stream_conversation(conversation_id):
+    """Stream new messages in conversation as server-sent events.
+
+    Messages after the client's Last-Event-ID header are sent first. The
+    first connection has none, so the page passes the last message it
+    rendered as ?after= instead. Only PostgreSQL can announce new messages; on other
+    databases the stream just sends those missed messages and closes, and
+    the client polls by reconnecting.
+    """
+
+    if not Participant.is_participant(g.user.id, conversation_id):
+        return ('Unauthorized', 403)
+
+    hub = broker.current
+    subscriber = None
+
+    if is_postgresql():
+        try:
+            subscriber = hub.subscribe(conversation_id, db.engine)
+        except StreamLimitReached:
+            return ('Too many open streams', 503, {'Retry-After': '5'})
+
+    backlog = []
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+
+    if last_event_id is None:
+        last_event_id = request.args.get('after', type=int)
+
+    try:
+        if last_event_id is not None:
+            # NOTIFY comes from the primary, so a lagging replica could lack
+            # messages the stream has already been told about
+            replica_router.use_primary()
+
+            backlog = [
+                {'id': m.id, 'user_id': m.user_id, 'text': m.text}
+                for m in db.session.query(
+                    Message.id,
+                    Message.user_id,
+                    Message.text
+                ).filter(
+                    Message.conversation_id == conversation_id,
+                    Message.id > last_event_id
+                ).order_by(Message.id)
+            ]
+
+        # End the read transaction so the stream doesn't hold a pooled
+        # connection for as long as the client stays connected.
+        db.session.commit()
+
+    except Exception:
+        if subscriber is not None:
+            hub.unsubscribe(conversation_id, subscriber)
+        raise
+
+    return Response(
+        stream_messages(hub, conversation_id, subscriber, backlog),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@views.route('/conversations/new', methods=['POST', 'GET'])
+@login_required
 def new_conversation():
-    """Handle creating new conversation"""
+    """Handle creating new conversation.
+
+    If the two users already have a conversation, the message is added to it
+    instead of starting another one.
+    """
 
     conversations = g.user.get_conversations()
 
     form = NewConversationForm()
 
-    form.user.choices = [(user.id, user.username) for user in User.query.filter(User.id != g.user.id).all()]
-
     if form.validate_on_submit():
-        conversation = Conversation()
-        db.session.add(conversation)
-        db.session.commit()
+        recipient = User.query.filter(
+            User.username == form.recipient.data
+        ).one_or_none()
 
-        user_id = form.user.data
-        user = User.query.get_or_404(user_id)
-        user.conversations.append(conversation)
-        g.user.conversations.append(conversation)
-        db.session.commit()
+        if not recipient or recipient.id == g.user.id:
+            flash('User not found.', 'danger')
+            return render_template('conversations/new_conversation.html',  form= form, conversations=conversations)
 
-        message = Message(
-            user_id = g.user.id,
-            conversation_id = conversation.id,
-            text = form.message.data
-        )
-        db.session.add(message)
-        db.session.commit()
+        with unit_of_work():
+            conversation = Conversation.get_or_create_direct(g.user.id, recipient.id)
+
+            message = Message(
+                user_id = g.user.id,
+                conversation_id = conversation.id,
+                text = form.message.data
+            )
+            db.session.add(message)
+            db.session.flush()
+            notify_new_message(db.session, message)
+            Notification.add_for_message(message)
 
         return redirect(f'/conversations/{conversation.id}')
 
     return render_template('conversations/new_conversation.html',  form= form, conversations=conversations)
+
+
+##############################################################################
+# Admin routes
+
+
+@views.get('/admin/memory')
+@admin_required
+def memory_report():
+    """Show allocations recorded per endpoint in this worker."""
+
+    return jsonify(allocation_tracker.report())
+
+
+@views.post('/admin/memory/dump')
+@admin_required
+def dump_memory_report():
+    """Write allocation report and tracemalloc snapshot to dump files."""
+
+    if not g.csrf_form.validate_on_submit():
+        abort(400)
+
+    if not allocation_tracker.enabled:
+        return (jsonify(errors={'memory': ['Memory tracking is off.']}), 409)
+
+    report_file, snapshot_file = allocation_tracker.dump()
+
+    return jsonify(report=report_file, snapshot=snapshot_file)
@@ -0,0 +1,175 @@
+"""Benchmark the in-memory follow graph against the same queries in SQL.
+
+Loads a synthetic power-law follow graph into a scratch database, builds
+the graph from it, then times each kind of query both ways for a sample of
+users and checks they agree.
+
+    createdb craft_app_bench
+    python -m benchmarks.follow_graph --users 50000 --following 20
+
+The scratch database's users and follows tables are dropped and recreated.
+"""
+
+import argparse
+import io
+import os
+import random
+import statistics
+import time
+
+from sqlalchemy import create_engine, text
+
+from models import db, User, Follow, DEFAULT_IMG_URL
+from follow_graph import FollowGraph
+from seed import power_law_edges
+
+DEFAULT_DATABASE_URL = 'postgresql:///craft_app_bench'
+
+SQL_QUERIES = {
+    'num_followers': text(
+        'SELECT count(*) FROM follows WHERE user_being_followed_id = :user_id'
+    ),
+    'mutual_followers': text(
+        'SELECT a.user_following_id FROM follows a '
+        'JOIN follows b ON b.user_following_id = a.user_following_id '
+        'WHERE a.user_being_followed_id = :user_id '
+        'AND b.user_being_followed_id = :other_user_id '
+        'ORDER BY 1'
+    ),
+    'followed_by_following': text(
+        'SELECT a.user_being_followed_id FROM follows a '
+        'JOIN follows b ON b.user_following_id = a.user_being_followed_id '
+        'WHERE a.user_following_id = :user_id '
+        'AND b.user_being_followed_id = :other_user_id '
+        'ORDER BY 1'
+    ),
+    'suggestions': text(
+        'SELECT b.user_being_followed_id, count(*) FROM follows a '
+        'JOIN follows b ON b.user_following_id = a.user_being_followed_id '
+        'WHERE a.user_following_id = :user_id '
+        'AND b.user_being_followed_id != :user_id '
+        'AND NOT EXISTS ('
+        '  SELECT 1 FROM follows c '
+        '  WHERE c.user_following_id = :user_id '
+        '  AND c.user_being_followed_id = b.user_being_followed_id) '
+        'GROUP BY 1 ORDER BY 2 DESC, 1 LIMIT 10'
+    ),
+}
+
+
+def load(engine, num_users, edges):
+    """Recreate users and follows and COPY the graph in."""
+
+    tables = [User.__table__, Follow.__table__]
+
+    db.metadata.drop_all(engine, tables=tables)
+    db.metadata.create_all(engine, tables=tables)
+
+    users = io.StringIO(''.join(
+        f'{user_id}\tuser{user_id}\tuser{user_id}@example.com\t'
+        f'{DEFAULT_IMG_URL}\tx\tf\n'
+        for user_id in range(1, num_users + 1)
+    ))
+    follows = io.StringIO(''.join(f'{a}\t{b}\n' for a, b in edges))
+
+    connection = engine.raw_connection()
+
+    try:
+        cursor = connection.cursor()
+        cursor.copy_expert(
+            'COPY users (id, username, email, image_url, password, private) '
+            'FROM STDIN', users)
+        cursor.copy_expert(
+            'COPY follows (user_following_id, user_being_followed_id) '
+            'FROM STDIN', follows)
+        cursor.execute(
+            "SELECT setval('users_id_seq', (SELECT max(id) FROM users))")
+        cursor.execute('ANALYZE users')
+        cursor.execute('ANALYZE follows')
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def time_calls(fn, args_list):
+    """Microseconds per call, one sample per args."""
+
+    samples = []
+
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        samples.append((time.perf_counter() - start) * 1e6)
+
+    return samples
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    return f'{statistics.median(samples):10.1f} {p95:10.1f}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--following', type=float, default=20,
+                        help='average number of users each user follows')
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database-url', default=os.environ.get(
+        'BENCH_DATABASE_URL', DEFAULT_DATABASE_URL))
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url)
+    rng = random.Random(args.seed)
+
+    start = time.perf_counter()
+    edges = power_law_edges(args.users, args.following, args.seed)
+    load(engine, args.users, edges)
+    print(f'loaded {args.users} users, {len(edges)} follows '
+          f'in {time.perf_counter() - start:.1f}s')
+
+    graph = FollowGraph()
+    graph.max_age = float('inf')
+
+    start = time.perf_counter()
+    graph.build(engine)
+    print(f'built graph in {time.perf_counter() - start:.2f}s')
+
+    users = [rng.randint(1, args.users) for _ in range(args.samples)]
+    pairs = [(user_id, rng.choice(edges)[1]) for user_id in users]
+
+    cases = {
+        'num_followers': (graph.num_followers, [(u,) for u in users]),
+        'mutual_followers': (graph.mutual_followers, pairs),
+        'followed_by_following': (graph.followed_by_following, pairs),
+        'suggestions': (graph.suggestions, [(u,) for u in users]),
+    }
+
+    print(f'\n{"query":24} {"graph p50":>10} {"graph p95":>10} '
+          f'{"sql p50":>10} {"sql p95":>10}   (microseconds)')
+
+    with engine.connect() as connection:
+        for name, (fn, args_list) in cases.items():
+            query = SQL_QUERIES[name]
+
+            def run_sql(user_id, other_user_id=None):
+                return connection.execute(
+                    query,
+                    {'user_id': user_id, 'other_user_id': other_user_id}
+                ).all()
+
+            for case_args in args_list:
+                expected = fn(*case_args)
+                rows = run_sql(*case_args)
+                got = (rows[0][0] if name == 'num_followers'
+                       else [tuple(r) if len(r) > 1 else r[0] for r in rows])
+                assert got == expected, (name, case_args, got, expected)
+
+            print(f'{name:24} {summarize(time_calls(fn, args_list))} '
+                  f'{summarize(time_calls(run_sql, args_list))}')
+
+
+if __name__ == '__main__':
+    main()
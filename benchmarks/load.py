@@ -0,0 +1,493 @@
+"""Load test the app served by gunicorn on localhost.
+
+Starts gunicorn with several workers against a seeded database, then runs
+simulated users in threads for a fixed time. Each user logs in as a random
+seeded account (a bcrypt check, like a real login) and repeatedly picks a
+scenario by weight:
+
+- browse_feed: homepage, then a project from it
+- view_profiles: a user's page, followers and following
+- log_time: time log form, then log time on an own project
+- chat: conversations, one conversation, send a message
+- login: log out and in again
+
+Throughput, latency percentiles and error rate are reported per scenario
+and per step:
+
+    python seed.py --database-url postgresql:///craft_app_bench --users 10000
+    python -m benchmarks.load --workers 4 --users 32 --duration 30
+
+A step is an error when it returns an unexpected status or the connection
+fails. Set METRICS_ENABLED, SQL_TIMING, DB_POOL_SIZE etc. in the
+environment to pass them through to the server. --preload loads the app
+once before forking the workers, as a memory-saving deployment would.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import date
+from urllib.parse import urlencode
+
+from sqlalchemy import create_engine, text
+
+DEFAULT_DATABASE_URL = 'postgresql:///craft_app_bench'
+PASSWORD = 'password'
+STARTUP_TIMEOUT = 30
+REQUEST_TIMEOUT = 30
+
+SCENARIO_WEIGHTS = {
+    'browse_feed': 40,
+    'view_profiles': 30,
+    'log_time': 10,
+    'chat': 15,
+    'login': 5,
+}
+
+CSRF_TOKEN_RE = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+PROJECT_LINK_RE = re.compile(r'href="/projects/(\d+)"')
+
+
+class StepError(Exception):
+    """A request failed or returned an unexpected status."""
+
+
+class Results:
+    """Latencies and errors by scenario and by scenario step."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.sessions = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, scenario, step, seconds, error):
+        with self._lock:
+            self.latencies[(scenario, step)].append(seconds * 1000)
+
+            if error:
+                self.errors[(scenario, step)] += 1
+
+    def finish_session(self, scenario):
+        with self._lock:
+            self.sessions[scenario] += 1
+
+    def summary(self, duration):
+        """Stats per scenario (steps combined) and per step."""
+
+        def stats(latencies, errors, sessions=None):
+            latencies = sorted(latencies)
+
+            result = {
+                'requests': len(latencies),
+                'requests_per_second': round(len(latencies) / duration, 1),
+                'p50_ms': round(statistics.median(latencies), 1),
+                'p95_ms': round(percentile(latencies, 0.95), 1),
+                'p99_ms': round(percentile(latencies, 0.99), 1),
+                'max_ms': round(latencies[-1], 1),
+                'errors': errors,
+                'error_rate': round(errors / len(latencies), 4),
+            }
+
+            if sessions is not None:
+                result['sessions'] = sessions
+
+            return result
+
+        scenarios = {}
+        steps = {}
+
+        for scenario in SCENARIO_WEIGHTS:
+            keys = [key for key in self.latencies if key[0] == scenario]
+
+            if not keys:
+                continue
+
+            scenarios[scenario] = stats(
+                [ms for key in keys for ms in self.latencies[key]],
+                sum(self.errors[key] for key in keys),
+                self.sessions[scenario],
+            )
+
+            for key in keys:
+                steps[f'{scenario}.{key[1]}'] = stats(
+                    self.latencies[key], self.errors[key])
+
+        total = stats(
+            [ms for latencies in self.latencies.values() for ms in latencies],
+            sum(self.errors.values()),
+            sum(self.sessions.values()),
+        )
+
+        return {'total': total, 'scenarios': scenarios, 'steps': steps}
+
+
+def percentile(sorted_samples, fraction):
+    return sorted_samples[min(len(sorted_samples) - 1,
+                              int(len(sorted_samples) * fraction))]
+
+
+class Client:
+    """One simulated user: a keep-alive connection and a session cookie."""
+
+    def __init__(self, port, results):
+        self.port = port
+        self.results = results
+        self.cookie = None
+        self.csrf_token = None
+        self.connection = None
+
+    def request(self, scenario, step, method, path, form=None, expect=(200,)):
+        """Send one request and record it; return the response body."""
+
+        headers = {}
+        body = None
+
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+
+        if form is not None:
+            body = urlencode({**form, 'csrf_token': self.csrf_token})
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        start = time.perf_counter()
+        error = True
+
+        try:
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(
+                    '127.0.0.1', self.port, timeout=REQUEST_TIMEOUT)
+
+            self.connection.request(method, path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            content = response.read().decode('utf-8', 'replace')
+            error = response.status not in expect
+
+        except (OSError, http.client.HTTPException) as e:
+            self.connection.close()
+            self.connection = None
+            raise StepError(f'{method} {path}: {e!r}') from e
+
+        finally:
+            self.results.record(scenario, step, time.perf_counter() - start, error)
+
+        set_cookie = response.getheader('Set-Cookie')
+
+        if set_cookie:
+            self.cookie = set_cookie.split(';', 1)[0]
+
+        if error:
+            raise StepError(f'{method} {path}: {response.status}')
+
+        match = CSRF_TOKEN_RE.search(content)
+
+        if match:
+            self.csrf_token = match.group(1)
+
+        return content
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+class Scenarios:
+    """Scenario steps for one seeded account."""
+
+    def __init__(self, client, account, user_ids, rng):
+        self.client = client
+        self.account = account
+        self.user_ids = user_ids
+        self.rng = rng
+
+    def login(self):
+        request = self.client.request
+        request('login', 'login_form', 'GET', '/login')
+        request('login', 'login', 'POST', '/login', form={
+            'username': f'user{self.account["id"]}',
+            'password': PASSWORD,
+        }, expect=(302,))
+
+    def relogin(self):
+        self.client.request('login', 'logout', 'POST', '/logout', form={},
+                            expect=(302,))
+        self.login()
+
+    def browse_feed(self):
+        request = self.client.request
+        feed = request('browse_feed', 'homepage', 'GET', '/')
+        project_ids = PROJECT_LINK_RE.findall(feed)
+
+        if project_ids:
+            request('browse_feed', 'project_details', 'GET',
+                    f'/projects/{self.rng.choice(project_ids)}')
+
+    def view_profiles(self):
+        request = self.client.request
+        user_id = self.rng.choice(self.user_ids)
+
+        request('view_profiles', 'user_page', 'GET', f'/users/{user_id}')
+        request('view_profiles', 'user_followers', 'GET', f'/users/{user_id}/followers')
+        request('view_profiles', 'user_following', 'GET', f'/users/{user_id}/following')
+
+    def log_time(self):
+        if not self.account['project_ids']:
+            return self.browse_feed()
+
+        request = self.client.request
+        request('log_time', 'time_log_form', 'GET', '/projects/log_time')
+        request('log_time', 'log_time', 'POST', '/projects/log_time', form={
+            'project': self.rng.choice(self.account['project_ids']),
+            'date': date.today().isoformat(),
+            'hours': self.rng.randint(0, 3),
+            'minutes': self.rng.randrange(0, 60, 5),
+            'notes': 'load test',
+        }, expect=(302,))
+
+    def chat(self):
+        if not self.account['conversation_ids']:
+            return self.view_profiles()
+
+        request = self.client.request
+        conversation_id = self.rng.choice(self.account['conversation_ids'])
+
+        request('chat', 'conversations_page', 'GET', '/conversations')
+        request('chat', 'show_conversation', 'GET', f'/conversations/{conversation_id}')
+        request('chat', 'send_message', 'POST',
+                f'/api/conversations/{conversation_id}/messages',
+                form={'message': 'load test'}, expect=(201,))
+
+
+def run_user(port, account, user_ids, results, stop_at, seed):
+    """Simulate one user until stop_at."""
+
+    rng = random.Random(seed)
+    client = Client(port, results)
+    scenarios = Scenarios(client, account, user_ids, rng)
+    run_scenario = {
+        'browse_feed': scenarios.browse_feed,
+        'view_profiles': scenarios.view_profiles,
+        'log_time': scenarios.log_time,
+        'chat': scenarios.chat,
+        'login': scenarios.relogin,
+    }
+    names = list(SCENARIO_WEIGHTS)
+    weights = list(SCENARIO_WEIGHTS.values())
+    logged_in = False
+
+    try:
+        while time.monotonic() < stop_at:
+            try:
+                if not logged_in:
+                    scenarios.login()
+                    logged_in = True
+                    results.finish_session('login')
+                    continue
+
+                name = rng.choices(names, weights)[0]
+                run_scenario[name]()
+                results.finish_session(name)
+
+            except StepError:
+                # start over from a fresh login, as a real user might
+                logged_in = False
+                client.cookie = None
+    finally:
+        client.close()
+
+
+def find_accounts(database_url, num_accounts, seed):
+    """Sample public accounts, with their project and conversation ids."""
+
+    engine = create_engine(database_url)
+
+    with engine.connect() as connection:
+        user_ids = connection.execute(text(
+            'SELECT id FROM users WHERE NOT private ORDER BY id'
+        )).scalars().all()
+
+        if not user_ids:
+            sys.exit('no users; seed the database first (python seed.py)')
+
+        rng = random.Random(seed)
+        account_ids = rng.sample(user_ids, min(num_accounts, len(user_ids)))
+        accounts = []
+
+        for user_id in account_ids:
+            accounts.append({
+                'id': user_id,
+                'project_ids': connection.execute(text(
+                    'SELECT id FROM projects WHERE user_id = :user_id'
+                ), {'user_id': user_id}).scalars().all(),
+                'conversation_ids': connection.execute(text(
+                    'SELECT conversation_id FROM participants WHERE user_id = :user_id'
+                ), {'user_id': user_id}).scalars().all(),
+            })
+
+    engine.dispose()
+
+    return accounts, user_ids
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(database_url, port, workers, threads, preload, log):
+    """Start gunicorn serving wsgi:app; return once it answers requests."""
+
+    env = {**os.environ, 'DATABASE_URL': database_url}
+    env.setdefault('SECRET_KEY', 'load-test')
+
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn',
+         '--bind', f'127.0.0.1:{port}',
+         '--workers', str(workers),
+         '--threads', str(threads),
+         '--timeout', str(REQUEST_TIMEOUT),
+         *(['--preload'] if preload else []),
+         'wsgi:app'],
+        env=env,
+        stdout=log,
+        stderr=log,
+    )
+
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            sys.exit(f'gunicorn exited with {server.returncode}; see {log.name}')
+
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/login')
+
+            if connection.getresponse().status == 200:
+                return server
+
+        except OSError:
+            time.sleep(0.2)
+
+    stop_server(server)
+    sys.exit(f'gunicorn did not answer within {STARTUP_TIMEOUT}s; see {log.name}')
+
+
+def stop_server(server):
+    server.send_signal(signal.SIGTERM)
+
+    try:
+        server.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+def print_summary(summary):
+    header = (f'{"":34} {"req/s":>7} {"p50":>7} {"p95":>7} {"p99":>7} '
+              f'{"max":>7} {"errors":>7}   (milliseconds)')
+
+    def line(name, stats):
+        return (f'{name:34} {stats["requests_per_second"]:7.1f} '
+                f'{stats["p50_ms"]:7.1f} {stats["p95_ms"]:7.1f} '
+                f'{stats["p99_ms"]:7.1f} {stats["max_ms"]:7.1f} '
+                f'{stats["error_rate"]:7.1%}')
+
+    print(f'\n{header}')
+    print(line('total', summary['total']))
+
+    print('\nby scenario')
+
+    for name, stats in summary['scenarios'].items():
+        print(line(f'{name} ({stats["sessions"]} runs)', stats))
+
+    print('\nby step')
+
+    for name, stats in summary['steps'].items():
+        print(line(name, stats))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--workers', type=int, default=4,
+                        help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='threads per gunicorn worker')
+    parser.add_argument('--preload', action='store_true',
+                        help='load the app before forking workers')
+    parser.add_argument('--users', type=int, default=16,
+                        help='simulated users making requests at once')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds to run for')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the summary to this file')
+    parser.add_argument('--server-log', default=os.devnull,
+                        help='where gunicorn output goes')
+    parser.add_argument('--database-url', default=os.environ.get(
+        'BENCH_DATABASE_URL', DEFAULT_DATABASE_URL))
+    args = parser.parse_args()
+
+    accounts, user_ids = find_accounts(args.database_url, args.users, args.seed)
+    port = free_port()
+
+    with open(args.server_log, 'w') as log:
+        server = start_server(
+            args.database_url, port, args.workers, args.threads, args.preload,
+            log)
+
+        print(f'gunicorn on port {port}: {args.workers} workers x '
+              f'{args.threads} threads; {len(accounts)} users for '
+              f'{args.duration:g}s')
+
+        results = Results()
+        stop_at = time.monotonic() + args.duration
+
+        try:
+            threads = [
+                threading.Thread(
+                    target=run_user,
+                    args=(port, account, user_ids, results, stop_at, args.seed + i),
+                )
+                for i, account in enumerate(accounts)
+            ]
+
+            start = time.monotonic()
+
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+            duration = time.monotonic() - start
+
+        finally:
+            stop_server(server)
+
+    summary = results.summary(duration)
+    print_summary(summary)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'workers': args.workers,
+                'threads': args.threads,
+                'users': len(accounts),
+                'duration': round(duration, 1),
+                **summary,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
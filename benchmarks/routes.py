@@ -0,0 +1,368 @@
+"""Benchmark the main routes through the Flask test client.
+
+Requests each route repeatedly as one logged in user against a seeded
+database, and records latency percentiles and the number of SQL statements
+per request. Results can be saved as a baseline, and later runs compared
+against it:
+
+    python seed.py --database-url postgresql:///craft_app_bench \\
+        --users 100000 --projects 1000000 --conversations 100000
+    python -m benchmarks.routes --save
+    # ...change things...
+    python -m benchmarks.routes
+
+With --database-url sqlite:// the run seeds a small in-memory SQLite
+database first, which is quick for checking query counts without a server.
+
+A route regresses when its p50 or p95 is more than --tolerance slower than
+the baseline, or it sends more statements. The run exits non-zero if any
+route regressed. Latencies only compare on the same machine and data, so
+the baseline isn't checked in.
+
+Write routes change the database a little: follows are undone, but each
+run adds time logs and messages.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from datetime import date
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+
+DEFAULT_DATABASE_URL = 'postgresql:///craft_app_bench'
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'routes_baseline.json')
+DEFAULT_TOLERANCE = 0.2
+
+FLASHES_KEY = '_flashes'
+
+
+class Case:
+    """One route to request: method, URL and form data."""
+
+    def __init__(self, name, method, url, data=None, status=200, writes=False):
+        self.name = name
+        self.method = method
+        self.url = url
+        self.data = data
+        self.status = status
+        self.writes = writes
+
+
+def find_subjects(connection):
+    """Ids of seeded rows worth requesting.
+
+    The viewer is the user following the most others who is in a
+    conversation and has a project, so their feed and inbox are the
+    heaviest. The popular user is the public user with the most followers.
+    """
+
+    def scalar(sql, **params):
+        value = connection.execute(text(sql), params).scalar()
+
+        if value is None:
+            sys.exit(f'no rows for: {sql}\nseed the database first (python seed.py)')
+
+        return value
+
+    viewer_id = scalar(
+        'SELECT f.user_following_id FROM follows f '
+        'WHERE EXISTS (SELECT 1 FROM participants p WHERE p.user_id = f.user_following_id) '
+        'AND EXISTS (SELECT 1 FROM projects p WHERE p.user_id = f.user_following_id) '
+        'GROUP BY 1 ORDER BY count(*) DESC, 1 LIMIT 1'
+    )
+    popular_id = scalar(
+        'SELECT f.user_being_followed_id FROM follows f '
+        'JOIN users u ON u.id = f.user_being_followed_id '
+        'WHERE NOT u.private AND u.id != :viewer_id '
+        'GROUP BY 1 ORDER BY count(*) DESC, 1 LIMIT 1',
+        viewer_id=viewer_id
+    )
+
+    return {
+        'viewer_id': viewer_id,
+        'popular_id': popular_id,
+        'popular_project_id': scalar(
+            'SELECT max(id) FROM projects WHERE user_id = :user_id',
+            user_id=popular_id
+        ),
+        'own_project_id': scalar(
+            'SELECT max(id) FROM projects WHERE user_id = :user_id',
+            user_id=viewer_id
+        ),
+        'conversation_id': scalar(
+            'SELECT p.conversation_id FROM participants p '
+            'WHERE p.user_id = :user_id '
+            'ORDER BY (SELECT count(*) FROM messages m '
+            '          WHERE m.conversation_id = p.conversation_id) DESC, 1 '
+            'LIMIT 1',
+            user_id=viewer_id
+        ),
+        'unfollowed_id': scalar(
+            'SELECT u.id FROM users u '
+            'WHERE NOT u.private AND u.id != :user_id '
+            'AND NOT EXISTS (SELECT 1 FROM follows f '
+            '  WHERE f.user_following_id = :user_id '
+            '  AND f.user_being_followed_id = u.id) '
+            'ORDER BY u.id LIMIT 1',
+            user_id=viewer_id
+        ),
+    }
+
+
+def make_cases(subjects):
+    """Cases for the read routes, then the write routes.
+
+    Follow and unfollow alternate, as do pin and unpin, so the data stays
+    the same between runs.
+    """
+
+    s = subjects
+
+    return [
+        Case('homepage', 'GET', '/'),
+        Case('user_page', 'GET', f'/users/{s["popular_id"]}'),
+        Case('user_followers', 'GET', f'/users/{s["popular_id"]}/followers'),
+        Case('user_following', 'GET', f'/users/{s["viewer_id"]}/following'),
+        Case('project_details', 'GET', f'/projects/{s["popular_project_id"]}'),
+        Case('show_converation', 'GET', f'/conversations/{s["conversation_id"]}'),
+        Case('conversations_page', 'GET', '/conversations'),
+        Case('user_list_search', 'GET', '/users?q=user12'),
+        Case('search_users', 'GET', '/users/search?q=user12'),
+        Case('notifications', 'GET', '/notifications'),
+        Case('follow_user', 'POST', f'/users/{s["unfollowed_id"]}/follow',
+             status=302, writes=True),
+        Case('unfollow_user', 'POST', f'/users/{s["unfollowed_id"]}/unfollow',
+             status=302, writes=True),
+        Case('pin_project', 'POST', f'/projects/{s["own_project_id"]}/pin',
+             status=302, writes=True),
+        Case('unpin_project', 'POST', f'/projects/{s["own_project_id"]}/unpin',
+             status=302, writes=True),
+        Case('edit_project_progress', 'POST',
+             f'/projects/{s["own_project_id"]}/edit_progress',
+             data={'progress': 'In progress'}, status=302, writes=True),
+        Case('time_log_form', 'POST', '/projects/log_time',
+             data={'project': s['own_project_id'],
+                   'date': date.today().isoformat(),
+                   'hours': 1, 'minutes': 30, 'notes': 'benchmark'},
+             status=302, writes=True),
+        Case('api_send_message', 'POST',
+             f'/api/conversations/{s["conversation_id"]}/messages',
+             data={'message': 'benchmark'}, status=201, writes=True),
+    ]
+
+
+def run(app, engine, viewer_id, cases, iterations, warmup):
+    """Request each case warmup + iterations times; return stats by name.
+
+    Cases run round robin, so pairs like follow/unfollow alternate.
+    """
+
+    from app import CURR_USER_KEY
+
+    statements = []
+
+    def on_execute(*args):
+        statements[-1] += 1
+
+    samples = {case.name: [] for case in cases}
+    query_counts = {case.name: [] for case in cases}
+
+    event.listen(engine, 'before_cursor_execute', on_execute)
+
+    try:
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = viewer_id
+
+            for i in range(warmup + iterations):
+                for case in cases:
+                    statements.append(0)
+
+                    start = time.perf_counter()
+                    resp = client.open(case.url, method=case.method, data=case.data)
+                    elapsed = time.perf_counter() - start
+
+                    if resp.status_code != case.status:
+                        sys.exit(f'{case.name}: {case.method} {case.url} returned '
+                                 f'{resp.status_code}, expected {case.status}')
+
+                    if case.writes:
+                        # redirects aren't followed, so nothing shows the
+                        # flashed messages; drop them before the cookie grows
+                        with client.session_transaction() as session:
+                            session.pop(FLASHES_KEY, None)
+
+                    if i >= warmup:
+                        samples[case.name].append(elapsed * 1000)
+                        query_counts[case.name].append(statements[-1])
+    finally:
+        event.remove(engine, 'before_cursor_execute', on_execute)
+
+    return {
+        case.name: summarize(samples[case.name], query_counts[case.name])
+        for case in cases
+    }
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def summarize(samples, query_counts):
+    return {
+        'p50_ms': round(statistics.median(samples), 3),
+        'p95_ms': round(percentile(samples, 0.95), 3),
+        'p99_ms': round(percentile(samples, 0.99), 3),
+        'mean_ms': round(statistics.fmean(samples), 3),
+        'queries': max(query_counts),
+        'requests': len(samples),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of results against baseline, as (route, reason) pairs.
+
+    Routes missing from either side are skipped.
+    """
+
+    regressions = []
+
+    for name, result in results.items():
+        base = baseline.get(name)
+
+        if base is None:
+            continue
+
+        for key in ('p50_ms', 'p95_ms'):
+            if result[key] > base[key] * (1 + tolerance):
+                regressions.append((
+                    name,
+                    f'{key} {result[key]:.2f} > {base[key]:.2f} '
+                    f'+ {tolerance:.0%}'
+                ))
+
+        if result['queries'] > base['queries']:
+            regressions.append((
+                name,
+                f'queries {result["queries"]} > {base["queries"]}'
+            ))
+
+    return regressions
+
+
+def print_results(results, baseline):
+    print(f'\n{"route":24} {"p50":>8} {"p95":>8} {"p99":>8} {"queries":>8}'
+          f' {"base p50":>9} {"change":>8}   (milliseconds)')
+
+    for name, result in results.items():
+        base = baseline.get(name)
+        line = (f'{name:24} {result["p50_ms"]:8.2f} {result["p95_ms"]:8.2f} '
+                f'{result["p99_ms"]:8.2f} {result["queries"]:8}')
+
+        if base is not None:
+            change = result['p50_ms'] / base['p50_ms'] - 1 if base['p50_ms'] else 0
+            line += f' {base["p50_ms"]:9.2f} {change:+8.0%}'
+
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--routes', nargs='*',
+                        help='only run these routes (default: all)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save', action='store_true',
+                        help='write results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='allowed slowdown of p50 and p95, as a fraction')
+    parser.add_argument('--database-url', default=os.environ.get(
+        'BENCH_DATABASE_URL', DEFAULT_DATABASE_URL))
+    args = parser.parse_args()
+
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+    from app import create_app
+    from models import db
+    from follow_graph import follow_graphs
+
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': args.database_url,
+        'WTF_CSRF_ENABLED': False,
+    })
+
+    with app.app_context():
+        engine = db.engine
+
+    if make_url(args.database_url).database in (None, '', ':memory:'):
+        # nothing else can reach an in-memory database, so fill it here
+        from seed import seed, Generator
+
+        seed(engine, Generator(users=200, following=10, private=0.1,
+                               pending=0.2, projects=1000, conversations=300,
+                               messages=8, seed=0), log=lambda line: None)
+
+        # requests can't build the follow graph on the one connection to an
+        # in-memory database, and would fall back to SQL; measure the graph
+        with app.app_context():
+            follow_graphs.current.build(engine)
+
+    with engine.connect() as connection:
+        subjects = find_subjects(connection)
+
+    print(', '.join(f'{key}={value}' for key, value in subjects.items()))
+
+    cases = make_cases(subjects)
+
+    if args.routes:
+        cases = [case for case in cases if case.name in args.routes]
+
+    results = run(app, engine, subjects['viewer_id'], cases,
+                  args.iterations, args.warmup)
+
+    baseline = {}
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            saved = json.load(f)
+
+        baseline = saved['routes']
+
+        if saved['subjects'] != subjects:
+            print('warning: baseline was recorded against different data '
+                  f'({saved["database_url"]}); reseed or save a new baseline')
+
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({
+                'database_url': args.database_url,
+                'iterations': args.iterations,
+                'subjects': subjects,
+                'routes': {**baseline, **results},
+            }, f, indent=2)
+
+        print(f'\nsaved baseline to {args.baseline}')
+        return
+
+    regressions = compare(results, baseline, args.tolerance)
+
+    if regressions:
+        print('\nregressions:')
+
+        for name, reason in regressions:
+            print(f'  {name}: {reason}')
+
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
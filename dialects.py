@@ -0,0 +1,153 @@
+"""The few database features that differ between PostgreSQL and SQLite.
+
+Production runs on PostgreSQL. Everything here has a portable fallback so
+the app and most tests also run on SQLite, including in-memory (sqlite://),
+which needs no server:
+
+- insert(): INSERT supporting on_conflict_do_nothing() and RETURNING
+- writable_ctes(): whether INSERT/DELETE ... RETURNING can be a CTE, which
+  lets a write and its notifications go out as one statement; otherwise
+  callers send them one after another in the same transaction
+- string_array_agg(): aggregate strings into a list (array_agg, or
+  json_group_array on SQLite)
+- timestamp_now(): the current time, stored on SQLite in the same format
+  SQLAlchemy stores datetimes in, so they compare correctly with bound ones
+- notify(): pg_notify; a no-op elsewhere, so message streams only work on
+  PostgreSQL
+- configure_engine(): on SQLite, enforce foreign keys (for ON DELETE
+  CASCADE) and let SAVEPOINTs work with pysqlite
+
+Dialect-specific options that other dialects ignore, like postgresql_ops on
+an index, don't need wrapping.
+"""
+
+import json
+
+from sqlalchemy import JSON, DateTime, String, event, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import GenericFunction
+from sqlalchemy.types import TypeDecorator
+
+POSTGRESQL = 'postgresql'
+SQLITE = 'sqlite'
+
+_INSERTS = {
+    POSTGRESQL: postgresql.insert,
+    SQLITE: sqlite.insert,
+}
+
+
+def dialect_name():
+    """Name of the app's database dialect, e.g. 'postgresql'."""
+
+    # models imports this module
+    from models import db
+
+    return db.engine.dialect.name
+
+
+def is_postgresql():
+    return dialect_name() == POSTGRESQL
+
+
+def insert(table):
+    """INSERT for table in the app's dialect, with on_conflict_do_nothing()."""
+
+    return _INSERTS[dialect_name()](table)
+
+
+def writable_ctes():
+    """Can INSERT/DELETE ... RETURNING be used as a CTE?"""
+
+    return is_postgresql()
+
+
+class StringList(TypeDecorator):
+    """List of strings: a text[] on PostgreSQL, a JSON array elsewhere."""
+
+    impl = String
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == POSTGRESQL:
+            return dialect.type_descriptor(postgresql.ARRAY(String))
+
+        return dialect.type_descriptor(JSON())
+
+
+class string_array_agg(GenericFunction):
+    """Aggregate function collecting a string column into a list."""
+
+    type = StringList()
+    inherit_cache = True
+
+
+@compiles(string_array_agg)
+def _compile_string_array_agg(element, compiler, **kw):
+    return f'json_group_array({compiler.process(element.clauses, **kw)})'
+
+
+@compiles(string_array_agg, POSTGRESQL)
+def _compile_string_array_agg_postgresql(element, compiler, **kw):
+    return f'array_agg({compiler.process(element.clauses, **kw)})'
+
+
+class timestamp_now(GenericFunction):
+    """Current time, for server defaults of DateTime columns."""
+
+    type = DateTime(timezone=True)
+    inherit_cache = True
+
+
+@compiles(timestamp_now)
+def _compile_timestamp_now(element, compiler, **kw):
+    return 'CURRENT_TIMESTAMP'
+
+
+@compiles(timestamp_now, POSTGRESQL)
+def _compile_timestamp_now_postgresql(element, compiler, **kw):
+    return 'now()'
+
+
+@compiles(timestamp_now, SQLITE)
+def _compile_timestamp_now_sqlite(element, compiler, **kw):
+    # CURRENT_TIMESTAMP has no fractional seconds, and sorts before the
+    # same time bound as a parameter: '... 12:00:00' < '... 12:00:00.000000'
+    return "strftime('%Y-%m-%d %H:%M:%f000', 'now')"
+
+
+def notify(session, channel, payload):
+    """NOTIFY channel with JSON payload when session's transaction commits.
+
+    Only PostgreSQL has LISTEN/NOTIFY; elsewhere nothing is sent.
+    """
+
+    if not is_postgresql():
+        return
+
+    session.execute(
+        text('SELECT pg_notify(:channel, :payload)'),
+        {'channel': channel, 'payload': json.dumps(payload)}
+    )
+
+
+def configure_engine(engine):
+    """Install dialect workarounds on engine, before it first connects."""
+
+    if engine.dialect.name != SQLITE:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        # pysqlite's own transaction handling breaks SAVEPOINT; turn it off
+        # and have SQLAlchemy emit BEGIN itself
+        dbapi_connection.isolation_level = None
+
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def on_begin(connection):
+        connection.exec_driver_sql('BEGIN')
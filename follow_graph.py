@@ -0,0 +1,516 @@
+"""Worker-local follow graph.
+
+The whole `follows` table held as two compressed sparse row (CSR) adjacency
+structures, one for who each user follows and one for who follows each user.
+Each is a pair of flat integer arrays: for a user's row r, their neighbours
+are targets[offsets[r]:offsets[r + 1]], sorted by user id. At a few bytes per
+edge this stays small enough to keep in every worker, and answers mutual,
+suggestion and degree questions without going to the database.
+
+The arrays are built from one bulk read of `follows` and never modified.
+Follows and unfollows committed in this worker are layered on top as small
+per-user overlays, applied when their transaction commits. Changes made by
+other workers are picked up by rebuilding once the graph is older than its
+max age, or once the overlays grow large.
+"""
+
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter
+
+from flask import current_app
+from sqlalchemy import event, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import SingletonThreadPool, StaticPool
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_AGE_SECONDS = 300
+MAX_OVERLAY_EDGES = 10000
+NUM_SUGGESTIONS = 10
+
+CHANGES_KEY = 'follow_graph_changes'
+
+FOLLOWS_QUERY = text(
+    'SELECT user_following_id, user_being_followed_id FROM follows '
+    'ORDER BY user_following_id, user_being_followed_id'
+)
+
+
+class GraphUnavailable(Exception):
+    """The graph hasn't been built, and can't be built now."""
+
+
+class Adjacency:
+    """One direction of the graph in CSR form.
+
+    rows maps user id to row number. Users with no edges in this direction
+    have no row.
+    """
+
+    def __init__(self, rows, offsets, targets):
+        self.rows = rows
+        self.offsets = offsets
+        self.targets = targets
+
+    @classmethod
+    def from_sorted_edges(cls, sources, targets):
+        """Build from parallel arrays of edges sorted by (source, target)."""
+
+        rows = {}
+        offsets = array('q', [0])
+
+        for source in sources:
+            if source not in rows:
+                rows[source] = len(rows)
+                offsets.append(offsets[-1])
+
+            offsets[-1] += 1
+
+        return cls(rows, offsets, array('q', targets))
+
+    @classmethod
+    def transpose(cls, sources, targets):
+        """Build the reverse direction from edges sorted by (source, target).
+
+        Counting sort on target. Edges are placed in source order, so each
+        row comes out sorted without a sort per row.
+        """
+
+        counts = Counter(targets)
+        rows = {}
+        offsets = array('q', [0])
+
+        for target in sorted(counts):
+            rows[target] = len(rows)
+            offsets.append(offsets[-1] + counts[target])
+
+        reversed_targets = array('q', bytes(8 * len(sources)))
+        next_slot = array('q', offsets[:-1])
+
+        for source, target in zip(sources, targets):
+            row = rows[target]
+            reversed_targets[next_slot[row]] = source
+            next_slot[row] += 1
+
+        return cls(rows, offsets, reversed_targets)
+
+    def bounds(self, user_id):
+        """Start and end of user's neighbours in targets."""
+
+        row = self.rows.get(user_id)
+
+        if row is None:
+            return 0, 0
+
+        return self.offsets[row], self.offsets[row + 1]
+
+    def neighbours(self, user_id):
+        """User's neighbours, as a view onto targets."""
+
+        start, end = self.bounds(user_id)
+        return memoryview(self.targets)[start:end]
+
+    def has_edge(self, source, target):
+        """Binary search source's row for target."""
+
+        start, end = self.bounds(source)
+        i = bisect_left(self.targets, target, start, end)
+        return i < end and self.targets[i] == target
+
+
+class Direction:
+    """An Adjacency plus the edges added and removed since it was built.
+
+    Added edges are never in the base and removed edges always are, so
+    degrees are base + added - removed with no set arithmetic.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.added = {}
+        self.removed = {}
+
+    def add(self, source, target):
+        if self.base.has_edge(source, target):
+            self._discard(self.removed, source, target)
+        else:
+            self.added.setdefault(source, set()).add(target)
+
+    def remove(self, source, target):
+        if self.base.has_edge(source, target):
+            self.removed.setdefault(source, set()).add(target)
+        else:
+            self._discard(self.added, source, target)
+
+    def neighbours(self, user_id):
+        """User's current neighbours: a memoryview if unchanged, else a set."""
+
+        base = self.base.neighbours(user_id)
+
+        if user_id not in self.added and user_id not in self.removed:
+            return base
+
+        neighbours = set(base)
+        neighbours.difference_update(self.removed.get(user_id, ()))
+        neighbours.update(self.added.get(user_id, ()))
+        return neighbours
+
+    def degree(self, user_id):
+        start, end = self.base.bounds(user_id)
+
+        return (end - start
+                + len(self.added.get(user_id, ()))
+                - len(self.removed.get(user_id, ())))
+
+    def has_edge(self, source, target):
+        if target in self.added.get(source, ()):
+            return True
+
+        if target in self.removed.get(source, ()):
+            return False
+
+        return self.base.has_edge(source, target)
+
+    @property
+    def num_changes(self):
+        return (sum(len(s) for s in self.added.values())
+                + sum(len(s) for s in self.removed.values()))
+
+    @staticmethod
+    def _discard(edges, source, target):
+        targets = edges.get(source)
+
+        if targets is not None:
+            targets.discard(target)
+
+            if not targets:
+                del edges[source]
+
+
+class FollowGraph:
+    """Who follows whom, in memory.
+
+    Built lazily on the first query, from the current app's database, on a
+    connection of its own. Engines with only one connection, like in-memory
+    SQLite's, can't spare it while the session has a transaction open on
+    it, e.g. during a request, so their graph isn't built then. Until a
+    graph has been built, queries raise GraphUnavailable, and callers answer
+    from SQL instead. Once built, a graph that can't be rebuilt keeps
+    answering as it is.
+
+    Queries take user ids and return user ids; they don't check that the
+    users still exist.
+    """
+
+    def __init__(self, max_age=DEFAULT_MAX_AGE_SECONDS):
+        self.max_age = max_age
+        self._following = None
+        self._followers = None
+        self._built_at = None
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._building = False
+        self._changes_while_building = None
+
+    @classmethod
+    def from_edges(cls, edges):
+        """Build graph from (follower id, followed id) pairs, without a db."""
+
+        graph = cls()
+        graph._install(*graph._split(sorted(set(edges))))
+        graph._built_at = float('inf')
+        return graph
+
+    # ###################### queries
+
+    def following(self, user_id):
+        """Ids of users user_id follows, sorted."""
+
+        with self._lock:
+            return sorted(self._graph()[0].neighbours(user_id))
+
+    def followers(self, user_id):
+        """Ids of users following user_id, sorted."""
+
+        with self._lock:
+            return sorted(self._graph()[1].neighbours(user_id))
+
+    def num_following(self, user_id):
+        """Number of users user_id follows."""
+
+        with self._lock:
+            return self._graph()[0].degree(user_id)
+
+    def num_followers(self, user_id):
+        """Number of users following user_id."""
+
+        with self._lock:
+            return self._graph()[1].degree(user_id)
+
+    def is_following(self, user_id, other_user_id):
+        """Checks if user_id follows other_user_id."""
+
+        with self._lock:
+            return self._graph()[0].has_edge(user_id, other_user_id)
+
+    def mutual_followers(self, user_id, other_user_id):
+        """Ids of users following both users, sorted."""
+
+        with self._lock:
+            followers = self._graph()[1]
+
+            return _intersection(
+                followers.neighbours(user_id),
+                followers.neighbours(other_user_id)
+            )
+
+    def followed_by_following(self, user_id, other_user_id):
+        """Ids of users user_id follows who follow other_user_id, sorted.
+
+        The "followed by people you follow" list on other_user_id's profile.
+        """
+
+        with self._lock:
+            following, followers = self._graph()
+
+            return _intersection(
+                following.neighbours(user_id),
+                followers.neighbours(other_user_id)
+            )
+
+    def suggestions(self, user_id, limit=NUM_SUGGESTIONS):
+        """Users followed by the users user_id follows, as (id, count) pairs.
+
+        Excludes user_id and anyone they already follow. Ordered by how many
+        of user_id's follows follow them, then by id.
+        """
+
+        # only the neighbour lists are taken under the lock, and counted
+        # after; they're views onto arrays that are never modified, or sets
+        # of their own
+        with self._lock:
+            following = self._graph()[0]
+            followed = following.neighbours(user_id)
+            rows = [following.neighbours(followed_id) for followed_id in followed]
+
+        counts = Counter()
+
+        for row in rows:
+            counts.update(row)
+
+        counts.pop(user_id, None)
+
+        for followed_id in followed:
+            counts.pop(followed_id, None)
+
+        return sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+    # ###################### updates
+
+    def add(self, user_following_id, user_being_followed_id):
+        """Record a committed follow."""
+
+        self.apply([(True, user_following_id, user_being_followed_id)])
+
+    def remove(self, user_following_id, user_being_followed_id):
+        """Record a committed unfollow."""
+
+        self.apply([(False, user_following_id, user_being_followed_id)])
+
+    def apply(self, changes):
+        """Apply committed (is_follow, follower id, followed id) changes.
+
+        Does nothing before the graph is first built, since the build will
+        read them from the database.
+        """
+
+        with self._lock:
+            if self._changes_while_building is not None:
+                self._changes_while_building.extend(changes)
+
+            if self._following is None:
+                return
+
+            self._apply(changes)
+
+            if self._following.num_changes > MAX_OVERLAY_EDGES:
+                self._built_at = None
+
+    def invalidate(self):
+        """Rebuild from the database on next query."""
+
+        with self._lock:
+            self._built_at = None
+
+    # ###################### building
+
+    def _graph(self):
+        """Current (following, followers) directions, building if needed.
+
+        Called holding _lock. A stale graph is rebuilt by one thread while
+        the others keep answering from it; only the first build makes
+        everyone wait.
+        """
+
+        if self._is_fresh() or (self._following is not None and self._building):
+            return self._following, self._followers
+
+        db = current_app.extensions['sqlalchemy']
+
+        if _shares_connection(db.engine) and db.session().in_transaction():
+            # the graph's connection would be the one the transaction is on
+            return self._built_graph()
+
+        self._lock.release()
+
+        try:
+            self.build(db.engine)
+        except SQLAlchemyError as exc:
+            if self._following is None:
+                raise GraphUnavailable() from exc
+
+            logger.exception('Could not rebuild follow graph; keeping the old one.')
+        finally:
+            self._lock.acquire()
+
+        return self._built_graph()
+
+    def _built_graph(self):
+        if self._following is None:
+            raise GraphUnavailable()
+
+        return self._following, self._followers
+
+    def build(self, engine):
+        """Replace graph with one bulk read of follows.
+
+        Reads on its own connection, so only committed follows are seen.
+        Changes committed in this worker during the read are replayed on the
+        new graph.
+        """
+
+        with self._build_lock:
+            with self._lock:
+                if self._is_fresh():
+                    return
+
+                self._building = True
+                self._changes_while_building = []
+
+            try:
+                with engine.connect() as connection:
+                    rows = connection.execution_options(
+                        yield_per=10000
+                    ).execute(FOLLOWS_QUERY)
+
+                    sources, targets = self._split(rows)
+
+                with self._lock:
+                    self._install(sources, targets)
+                    self._apply(self._changes_while_building)
+                    self._built_at = time.monotonic()
+
+            finally:
+                with self._lock:
+                    self._building = False
+                    self._changes_while_building = None
+
+    def _is_fresh(self):
+        return (self._built_at is not None
+                and time.monotonic() - self._built_at < self.max_age)
+
+    @staticmethod
+    def _split(edges):
+        """Sorted (source, target) rows into two arrays."""
+
+        sources = array('q')
+        targets = array('q')
+
+        for source, target in edges:
+            sources.append(source)
+            targets.append(target)
+
+        return sources, targets
+
+    def _install(self, sources, targets):
+        self._following = Direction(Adjacency.from_sorted_edges(sources, targets))
+        self._followers = Direction(Adjacency.transpose(sources, targets))
+
+    def _apply(self, changes):
+        for is_follow, source, target in changes:
+            if is_follow:
+                self._following.add(source, target)
+                self._followers.add(target, source)
+            else:
+                self._following.remove(source, target)
+                self._followers.remove(target, source)
+
+
+def _shares_connection(engine):
+    """Does every checkout of engine get the same connection?"""
+
+    return isinstance(engine.pool, (StaticPool, SingletonThreadPool))
+
+
+def _intersection(a, b):
+    """Sorted ids in both a and b."""
+
+    if len(a) > len(b):
+        a, b = b, a
+
+    return sorted(set(a).intersection(b))
+
+
+class FollowGraphs:
+    """Flask extension keeping a FollowGraph per app, in each worker."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Make app's graph, with the max age from app config."""
+
+        app.extensions['follow_graph'] = FollowGraph(
+            app.config.get('FOLLOW_GRAPH_MAX_AGE', DEFAULT_MAX_AGE_SECONDS))
+
+    @property
+    def current(self):
+        """The current app's FollowGraph."""
+
+        return current_app.extensions['follow_graph']
+
+
+follow_graphs = FollowGraphs()
+
+
+def record_follow(session, user_following_id, user_being_followed_id):
+    """Add follow to graph once session's transaction commits."""
+
+    session.info.setdefault(CHANGES_KEY, []).append(
+        (True, user_following_id, user_being_followed_id))
+
+
+def record_unfollow(session, user_following_id, user_being_followed_id):
+    """Remove follow from graph once session's transaction commits."""
+
+    session.info.setdefault(CHANGES_KEY, []).append(
+        (False, user_following_id, user_being_followed_id))
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_recorded_changes(session):
+    changes = session.info.pop(CHANGES_KEY, None)
+
+    if changes:
+        follow_graphs.current.apply(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_recorded_changes(session):
+    session.info.pop(CHANGES_KEY, None)
@@ -376,6 +376,9 @@ class NewConversationForm(MessageForm):
     """Create new conversation."""
 
     # users = FieldList(FormField(SelectUserForm), min_entries=1)
-    user = SelectField('User', coerce=int, validators=[InputRequired()])
+    recipient = StringField(
+        'To',
+        validators=[InputRequired(), Length(max=30)]
+    )
 
     add_user = SubmitField("Add User")
\ No newline at end of file
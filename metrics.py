@@ -0,0 +1,459 @@
+"""Prometheus metrics, aggregated across worker processes.
+
+Each worker keeps its own counters, histograms and gauges in memory and
+writes them to a file of its own in the metrics directory at most once a
+second. /metrics reads every worker's file and adds them up, so whichever
+worker serves the scrape reports the whole machine:
+
+- counters and histograms from every file, including workers that have
+  exited, so totals never go backwards while the server is up
+- gauges only from workers that are still running
+
+Files are kept per run of the server, in a subdirectory named after its
+process group, which the server and every worker it forks share. When
+collecting starts, subdirectories left by runs that have stopped are
+removed.
+
+/metrics is only served with METRICS_TOKEN set, to scrapers sending it as
+a bearer token.
+"""
+
+import atexit
+import hmac
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import Response, abort, current_app, g, request
+from sqlalchemy import event
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+FLUSH_SECONDS = 1
+
+HELP = {
+    'http_request_duration_seconds': ('histogram', 'Request latency by endpoint.'),
+    'http_responses_total': ('counter', 'Responses by endpoint and status.'),
+    'http_requests_in_flight': ('gauge', 'Requests being handled.'),
+    'db_pool_checkouts_total': ('counter', 'Connections checked out of the pool.'),
+    'db_pool_checked_out': ('gauge', 'Connections currently checked out.'),
+    'db_pool_overflow': ('gauge', 'Connections open beyond the pool size.'),
+    'db_pool_size': ('gauge', 'Configured pool size.'),
+    'bcrypt_queue_depth': ('gauge', 'Password hashes being computed or waiting for CPU.'),
+}
+
+
+class Metrics:
+    """Flask extension collecting request, pool and bcrypt metrics.
+
+    Each app records into a Registry of its own. Switched by the
+    METRICS_ENABLED config value, or at runtime with enable() and disable()
+    on the registry. Files go to METRICS_DIR, by default a directory in the
+    system temp dir.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Install request hooks, pool listeners and the /metrics route."""
+
+        directory = app.config.get('METRICS_DIR') or os.path.join(
+            tempfile.gettempdir(), 'craft_app_metrics')
+
+        with app.app_context():
+            engine = app.extensions['sqlalchemy'].engine
+
+        registry = app.extensions['metrics'] = Registry(directory, engine)
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._teardown_request)
+        app.add_url_rule('/metrics', 'metrics', self._metrics_view)
+
+        if app.config.get('METRICS_ENABLED', False):
+            registry.enable()
+
+    @property
+    def current(self):
+        """The current app's Registry."""
+
+        return current_app.extensions['metrics']
+
+    def _start_request(self):
+        registry = self.current
+
+        if not registry.enabled:
+            return
+
+        g.metrics_started_at = time.perf_counter()
+        registry.add_to_gauge('http_requests_in_flight', 1)
+
+    def _finish_request(self, response):
+        started_at = g.get('metrics_started_at')
+
+        if started_at is None:
+            return response
+
+        registry = self.current
+        endpoint = request.endpoint or 'none'
+
+        registry.observe(
+            'http_request_duration_seconds',
+            time.perf_counter() - started_at,
+            (('endpoint', endpoint), ('method', request.method))
+        )
+        registry.inc(
+            'http_responses_total',
+            (('endpoint', endpoint), ('status', str(response.status_code)))
+        )
+
+        return response
+
+    def _teardown_request(self, exc):
+        if g.pop('metrics_started_at', None) is None:
+            return
+
+        registry = self.current
+        registry.add_to_gauge('http_requests_in_flight', -1)
+
+        if time.monotonic() - registry.flushed_at >= FLUSH_SECONDS:
+            registry.flush()
+
+    def _metrics_view(self):
+        registry = self.current
+        token = current_app.config.get('METRICS_TOKEN')
+
+        if not registry.enabled or not token:
+            abort(404)
+
+        if not hmac.compare_digest(
+                request.headers.get('Authorization', ''), f'Bearer {token}'):
+            abort(401)
+
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+class Registry:
+    """One app's metrics in this worker, and the files of every worker."""
+
+    def __init__(self, directory, engine, buckets=DEFAULT_BUCKETS):
+        self.enabled = False
+        self.directory = directory
+        self.buckets = buckets
+        self.flushed_at = 0
+        self._engine = engine
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._file_name = None
+
+        _registries.add(self)
+
+    @property
+    def run_directory(self):
+        """This run's subdirectory of directory."""
+
+        return os.path.join(self.directory, str(os.getpgrp()))
+
+    def enable(self):
+        """Start collecting."""
+
+        if not self.enabled:
+            _remove_stopped_runs(self.directory)
+            os.makedirs(self.run_directory, exist_ok=True)
+            event.listen(self._engine, 'checkout', self._on_checkout)
+            self.inc('db_pool_checkouts_total', value=0)
+            self.enabled = True
+
+    def disable(self):
+        """Stop collecting. The /metrics route 404s until re-enabled."""
+
+        if self.enabled:
+            event.remove(self._engine, 'checkout', self._on_checkout)
+            self.enabled = False
+
+    # ###################### recording
+
+    def inc(self, name, labels=(), value=1):
+        """Add value to a counter."""
+
+        key = (name, tuple(labels))
+
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def add_to_gauge(self, name, value, labels=()):
+        """Add value (possibly negative) to a gauge."""
+
+        key = (name, tuple(labels))
+
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        """Record value in a histogram."""
+
+        key = (name, tuple(labels))
+
+        with self._lock:
+            histogram = self._histograms.get(key)
+
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    'buckets': [0] * (len(self.buckets) + 1),
+                    'sum': 0.0,
+                    'count': 0,
+                }
+
+            histogram['buckets'][bisect_left(self.buckets, value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def in_progress(self, name):
+        """Count block as in progress on gauge name while it runs."""
+
+        if not self.enabled:
+            yield
+            return
+
+        self.add_to_gauge(name, 1)
+
+        try:
+            yield
+        finally:
+            self.add_to_gauge(name, -1)
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self.inc('db_pool_checkouts_total')
+
+    # ###################### sharing between workers
+
+    def flush(self):
+        """Write this worker's metrics to its file."""
+
+        with self._lock:
+            if self._file_name is None:
+                self._file_name = f'{os.getpid()}-{time.time_ns()}.json'
+
+            data = {
+                'pid': os.getpid(),
+                'counters': [[n, l, v] for (n, l), v in self._counters.items()],
+                'histograms': [[n, l, h] for (n, l), h in self._histograms.items()],
+                'gauges': [[n, l, v] for (n, l), v in self._gauges.items()],
+            }
+
+        data['gauges'].extend(self._pool_gauges())
+
+        path = os.path.join(self.run_directory, self._file_name)
+        fd, tmp_path = tempfile.mkstemp(dir=self.run_directory, suffix='.tmp')
+
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+
+        os.replace(tmp_path, path)
+        self.flushed_at = time.monotonic()
+
+    def clear(self):
+        """Forget everything recorded in this worker, and start a new file."""
+
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+            self._gauges = {}
+            self._file_name = None
+            self.flushed_at = 0
+
+    def _after_fork(self):
+        """Start fresh in a forked worker, so its file doesn't repeat the
+        parent's numbers."""
+
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._file_name = None
+        self.flushed_at = 0
+
+    def _pool_gauges(self):
+        pool = self._engine.pool
+        gauges = []
+
+        for name, method in (('db_pool_checked_out', 'checkedout'),
+                             ('db_pool_overflow', 'overflow'),
+                             ('db_pool_size', 'size')):
+            # SQLite's in-memory pool has a size attribute, not method
+            if callable(getattr(pool, method, None)):
+                gauges.append([name, [], max(0, getattr(pool, method)())])
+
+        return gauges
+
+    def collect(self):
+        """Sum every worker's file into (counters, histograms, gauges)."""
+
+        counters = {}
+        histograms = {}
+        gauges = {}
+
+        for file_name in os.listdir(self.run_directory):
+            if not file_name.endswith('.json'):
+                continue
+
+            try:
+                with open(os.path.join(self.run_directory, file_name)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            for name, labels, value in data['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+
+            for name, labels, histogram in data['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                total = histograms.setdefault(key, {
+                    'buckets': [0] * len(histogram['buckets']),
+                    'sum': 0.0,
+                    'count': 0,
+                })
+                total['buckets'] = [a + b for a, b in zip(total['buckets'], histogram['buckets'])]
+                total['sum'] += histogram['sum']
+                total['count'] += histogram['count']
+
+            if _is_running(data['pid']):
+                for name, labels, value in data['gauges']:
+                    key = (name, tuple(map(tuple, labels)))
+                    gauges[key] = gauges.get(key, 0) + value
+
+        return counters, histograms, gauges
+
+    # ###################### exposition
+
+    def render(self):
+        """All workers' metrics in Prometheus text format."""
+
+        self.flush()
+        counters, histograms, gauges = self.collect()
+
+        samples = {}
+
+        for (name, labels), value in list(counters.items()) + list(gauges.items()):
+            samples.setdefault(name, []).append(
+                (labels, [f'{name}{_labels(labels)} {_number(value)}']))
+
+        for (name, labels), histogram in histograms.items():
+            lines = []
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + (float('inf'),), histogram['buckets']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else _number(bound)
+                lines.append(
+                    f'{name}_bucket{_labels(labels + (("le", le),))} {cumulative}')
+
+            lines.append(f'{name}_sum{_labels(labels)} {_number(histogram["sum"])}')
+            lines.append(f'{name}_count{_labels(labels)} {histogram["count"]}')
+
+            samples.setdefault(name, []).append((labels, lines))
+
+        output = []
+
+        for name in sorted(samples):
+            kind, help_text = HELP.get(name, ('untyped', ''))
+            output.append(f'# HELP {name} {help_text}')
+            output.append(f'# TYPE {name} {kind}')
+
+            for _, lines in sorted(samples[name]):
+                output.extend(lines)
+
+        return '\n'.join(output) + '\n'
+
+
+# every app's registry in this process, for _after_fork and _flush_at_exit
+_registries = weakref.WeakSet()
+
+
+def _reset_after_fork():
+    for registry in list(_registries):
+        registry._after_fork()
+
+
+def _flush_at_exit():
+    """Write what was recorded since the last flush, which would otherwise
+    be lost when a worker exits."""
+
+    for registry in list(_registries):
+        if registry.enabled:
+            registry.flush()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+atexit.register(_flush_at_exit)
+
+
+def _remove_stopped_runs(directory):
+    """Remove the subdirectories of runs whose processes have all exited."""
+
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+
+    for name in names:
+        if name.isdigit() and not _is_group_running(int(name)):
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+def _is_group_running(pgid):
+    try:
+        os.killpg(pgid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+
+    escaped = (
+        f'{key}="{_escape(value)}"' for key, value in labels
+    )
+
+    return '{' + ','.join(escaped) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return str(value)
+
+
+metrics = Metrics()
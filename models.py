@@ -1,17 +1,35 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
-from sqlalchemy import String
-from sqlalchemy.sql.functions import array_agg
-from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy import func, event, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased, contains_eager, object_session
 from datetime import datetime
+from dialects import (
+    POSTGRESQL, insert, writable_ctes, string_array_agg, timestamp_now,
+    configure_engine)
+from follow_graph import (
+    follow_graphs, record_follow, record_unfollow, GraphUnavailable)
+from metrics import metrics
+from pooling import engine_options, configure_pool, dispose_after_fork
+from replicas import RoutingSession, REPLICA_BIND
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 DEFAULT_IMG_URL = (
     "https://icon-library.com/images/default-user-icon/" +
     "default-user-icon-28.jpg")
 
+NUM_FOLLOWED_BY_SHOWN = 3
+NUM_FOLLOWS_SHOWN = 30
+NUM_SUGGESTIONS_SHOWN = 5
+PARTICIPANT_CACHE_SIZE = 10000
+PARTICIPANT_CACHE_SECONDS = 60
+
 
 class Follow(db.Model):
     """Join table for users and users."""
@@ -30,6 +48,114 @@ class Follow(db.Model):
         primary_key=True
     )
 
+    # the primary key serves a user's followers; this serves who they follow
+    __table_args__ = (
+        db.Index(
+            'ix_follows_user_following_id',
+            'user_following_id',
+            'user_being_followed_id'
+        ),
+    )
+
+    @classmethod
+    def is_following(cls, user_following_id, user_being_followed_id):
+        """SQL EXISTS expression: does the first user follow the second?"""
+
+        return db.exists().where(
+            cls.user_following_id == user_following_id,
+            cls.user_being_followed_id == user_being_followed_id
+        )
+
+    @classmethod
+    def followed_by_following(cls, user_id, other_user_id):
+        """Ids of users user_id follows who follow other_user_id, sorted.
+
+        FollowGraph.followed_by_following in SQL, for when there's no graph.
+        """
+
+        followed = aliased(cls)
+        following_other = aliased(cls)
+
+        rows = db.session.query(
+            followed.user_being_followed_id
+        ).join(
+            following_other,
+            following_other.user_following_id == followed.user_being_followed_id
+        ).filter(
+            followed.user_following_id == user_id,
+            following_other.user_being_followed_id == other_user_id
+        ).order_by(followed.user_being_followed_id).all()
+
+        return [id for id, in rows]
+
+    @classmethod
+    def suggestions(cls, user_id, limit):
+        """(id, count) pairs of users followed by the users user_id follows.
+
+        FollowGraph.suggestions in SQL, for when there's no graph.
+        """
+
+        followed = aliased(cls)
+        suggested = aliased(cls)
+        count = func.count()
+
+        return db.session.query(
+            suggested.user_being_followed_id,
+            count
+        ).select_from(
+            followed
+        ).join(
+            suggested,
+            suggested.user_following_id == followed.user_being_followed_id
+        ).filter(
+            followed.user_following_id == user_id,
+            suggested.user_being_followed_id != user_id,
+            ~cls.is_following(user_id, suggested.user_being_followed_id)
+        ).group_by(
+            suggested.user_being_followed_id
+        ).order_by(
+            count.desc(),
+            suggested.user_being_followed_id
+        ).limit(limit).all()
+
+    @classmethod
+    def add(cls, user_being_followed_id, user_following_id):
+        """Insert follow, doing nothing if it already exists.
+
+        One statement, without loading either user's followers, that also
+        notifies the followed user if the follow is new. Caller commits.
+        """
+
+        followed = insert(cls).values(
+            user_being_followed_id=user_being_followed_id,
+            user_following_id=user_following_id
+        ).on_conflict_do_nothing().returning(
+            cls.user_being_followed_id,
+            cls.user_following_id
+        )
+
+        Notification.add_for_inserted(
+            Notification.NEW_FOLLOWER,
+            followed,
+            user_id='user_being_followed_id',
+            actor_id='user_following_id'
+        )
+
+        record_follow(db.session, user_following_id, user_being_followed_id)
+
+    @classmethod
+    def remove(cls, user_being_followed_id, user_following_id):
+        """Delete follow if it exists. Caller commits."""
+
+        db.session.execute(
+            db.delete(cls).where(
+                cls.user_being_followed_id == user_being_followed_id,
+                cls.user_following_id == user_following_id
+            )
+        )
+
+        record_unfollow(db.session, user_following_id, user_being_followed_id)
+
 
 class Request(db.Model):
     """Join table for users to users.
@@ -49,6 +175,145 @@ class Request(db.Model):
         primary_key=True
     )
 
+    @classmethod
+    def is_requesting(cls, user_requesting_id, user_being_requested_id):
+        """SQL EXISTS expression: has the first user asked to follow the
+        second?"""
+
+        return db.exists().where(
+            cls.user_requesting_id == user_requesting_id,
+            cls.user_being_requested_id == user_being_requested_id
+        )
+
+    @classmethod
+    def add(cls, user_being_requested_id, user_requesting_id):
+        """Insert follow request, doing nothing if it already exists.
+
+        One statement, without loading either user's requests, that also
+        notifies the requested user if the request is new. Caller commits.
+        """
+
+        requested = insert(cls).values(
+            user_being_requested_id=user_being_requested_id,
+            user_requesting_id=user_requesting_id
+        ).on_conflict_do_nothing().returning(
+            cls.user_being_requested_id,
+            cls.user_requesting_id
+        )
+
+        Notification.add_for_inserted(
+            Notification.FOLLOW_REQUEST,
+            requested,
+            user_id='user_being_requested_id',
+            actor_id='user_requesting_id'
+        )
+
+    @classmethod
+    def accept(cls, user_being_requested_id, user_requesting_id=None):
+        """Turn follow requests into follows in a single statement.
+
+        Accepts the request from user_requesting_id, or every pending request
+        to user_being_requested_id if it isn't given. The requests are
+        deleted, inserted into follows and their requesters notified by one
+        statement of data-modifying CTEs, so no request is lost or left behind
+        in between. Databases without writable CTEs get the same writes as
+        three statements. Caller commits.
+
+        Returns number of requests accepted.
+        """
+
+        accepted = db.delete(cls).where(
+            *cls._matching(user_being_requested_id, user_requesting_id)
+        ).returning(
+            cls.user_being_requested_id,
+            cls.user_requesting_id
+        )
+
+        if writable_ctes():
+            accepted = accepted.cte('accepted')
+
+            followed = insert(Follow).from_select(
+                ['user_being_followed_id', 'user_following_id'],
+                db.select(
+                    accepted.c.user_being_requested_id,
+                    accepted.c.user_requesting_id
+                )
+            ).on_conflict_do_nothing().cte('followed')
+
+            notified = Notification.insert_from(
+                Notification.FOLLOW_ACCEPTED,
+                accepted.c.user_requesting_id,
+                accepted.c.user_being_requested_id
+            ).cte('notified')
+
+            requesting_ids = db.session.execute(
+                db.select(accepted.c.user_requesting_id).add_cte(followed, notified)
+            ).scalars().all()
+
+        else:
+            requesting_ids = [
+                row.user_requesting_id
+                for row in db.session.execute(accepted).all()
+            ]
+
+            if requesting_ids:
+                db.session.execute(
+                    insert(Follow).on_conflict_do_nothing(),
+                    [
+                        {
+                            'user_being_followed_id': user_being_requested_id,
+                            'user_following_id': requesting_id,
+                        }
+                        for requesting_id in requesting_ids
+                    ]
+                )
+                Notification.add_all(
+                    Notification.FOLLOW_ACCEPTED,
+                    [(requesting_id, user_being_requested_id)
+                     for requesting_id in requesting_ids]
+                )
+
+        for requesting_id in requesting_ids:
+            record_follow(db.session, requesting_id, user_being_requested_id)
+
+        return len(requesting_ids)
+
+    @classmethod
+    def deny(cls, user_being_requested_id, user_requesting_id=None):
+        """Delete follow request from user_requesting_id, or every pending
+        request to user_being_requested_id if it isn't given. Caller commits.
+
+        Returns number of requests deleted.
+        """
+
+        return db.session.execute(
+            db.delete(cls).where(
+                *cls._matching(user_being_requested_id, user_requesting_id)
+            )
+        ).rowcount
+
+    @classmethod
+    def _matching(cls, user_being_requested_id, user_requesting_id=None):
+        """Filters for requests to a user, optionally from one requester."""
+
+        filters = [cls.user_being_requested_id == user_being_requested_id]
+
+        if user_requesting_id is not None:
+            filters.append(cls.user_requesting_id == user_requesting_id)
+
+        return filters
+
+    @classmethod
+    def remove(cls, user_being_requested_id, user_requesting_id):
+        """Delete follow request if it exists. Caller commits."""
+
+        db.session.execute(
+            db.delete(cls).where(
+                cls.user_being_requested_id == user_being_requested_id,
+                cls.user_requesting_id == user_requesting_id
+            )
+        )
+
 
 class User(db.Model):
     """Site user."""
@@ -90,6 +355,25 @@ class User(db.Model):
         default=False
     )
 
+    # can use admin-only tools such as the request profiler
+    is_admin = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False
+    )
+
+    # prefix search (recipient autocomplete) on lowercased username: the
+    # pattern index finds a rare prefix's matches, and the plain one lists
+    # a common prefix's in order. On SQLite they'd be the same index.
+    __table_args__ = (
+        db.Index(
+            'ix_users_username_lower_prefix',
+            func.lower(username).label('username_lower'),
+            postgresql_ops={'username_lower': 'varchar_pattern_ops'}
+        ).ddl_if(dialect=POSTGRESQL),
+        db.Index('ix_users_username_lower', func.lower(username)),
+    )
+
     projects = db.relationship('Project', backref='user', cascade="all, delete-orphan")
 
     followers = db.relationship(
@@ -118,7 +402,12 @@ class User(db.Model):
     def signup(cls, username, email, image_url, password):
         """Creates new user with hashed password and adds to session."""
 
-        hashed = bcrypt.generate_password_hash(password).decode('utf-8')
+        # Flask-Bcrypt keeps the cost from whichever app initialized it
+        # last, so pass the current app's
+        rounds = current_app.config.get('BCRYPT_LOG_ROUNDS')
+
+        with metrics.current.in_progress('bcrypt_queue_depth'):
+            hashed = bcrypt.generate_password_hash(password, rounds).decode('utf-8')
 
         user = cls(
             username=username,
@@ -131,6 +420,34 @@ class User(db.Model):
 
         return user
 
+    @classmethod
+    def search_by_prefix(cls, prefix, exclude_id=None, limit=10):
+        """Find users whose username starts with prefix, case-insensitively.
+
+        In lowercased username order. On PostgreSQL, the varchar_pattern_ops
+        index on lower(username) finds the matches but can't give their
+        order, so they're sorted; the plain lower(username) index gives the
+        order, read until limit users match. The planner picks whichever is
+        cheaper for the prefix.
+        """
+
+        escaped = (prefix.lower()
+                   .replace('\\', '\\\\')
+                   .replace('%', '\\%')
+                   .replace('_', '\\_'))
+
+        query = db.session.query(
+            cls.id,
+            cls.username
+        ).filter(
+            func.lower(cls.username).like(f'{escaped}%', escape='\\')
+        )
+
+        if exclude_id is not None:
+            query = query.filter(cls.id != exclude_id)
+
+        return query.order_by(func.lower(cls.username)).limit(limit).all()
+
     @classmethod
     def login(cls, username, password):
         """Check user credentials.
@@ -141,43 +458,314 @@ class User(db.Model):
         user = cls.query.filter(User.username == username).one_or_none()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            with metrics.current.in_progress('bcrypt_queue_depth'):
+                is_auth = bcrypt.check_password_hash(user.password, password)
+
             if is_auth:
                 return user
 
         return False
 
+    def count_requests_received(self):
+        """Counts follow requests waiting on user."""
+
+        return db.session.query(
+            func.count()
+        ).select_from(
+            Request
+        ).filter(
+            Request.user_being_requested_id == self.id
+        ).scalar()
+
+    def count_follows(self):
+        """Counts (users following user, users user follows), in one query."""
+
+        def count(condition):
+            return db.select(
+                func.count()
+            ).select_from(
+                Follow
+            ).where(
+                condition
+            ).scalar_subquery()
+
+        return db.session.query(
+            count(Follow.user_being_followed_id == self.id),
+            count(Follow.user_following_id == self.id)
+        ).one()
+
+    def get_followers(self, after=None):
+        """Gets a page of users following user, by id.
+
+        after is the id of the last user on the previous page.
+
+        Returns (users, cursor for the next page or None).
+        """
+
+        return User._get_follows_page(
+            Follow.user_following_id,
+            Follow.user_being_followed_id == self.id,
+            after
+        )
+
+    def get_following(self, after=None):
+        """Gets a page of users user follows (see get_followers)."""
+
+        return User._get_follows_page(
+            Follow.user_being_followed_id,
+            Follow.user_following_id == self.id,
+            after
+        )
+
+    @classmethod
+    def _get_follows_page(cls, user_id_column, condition, after):
+        """Page of users joined to follows on user_id_column, for
+        get_followers and get_following. Each page is a range scan of
+        a follows index."""
+
+        query = db.session.query(cls).join(
+            Follow, user_id_column == cls.id
+        ).filter(condition)
+
+        if after is not None:
+            query = query.filter(user_id_column > after)
+
+        rows = query.order_by(
+            user_id_column
+        ).limit(NUM_FOLLOWS_SHOWN + 1).all()
+
+        users = rows[:NUM_FOLLOWS_SHOWN]
+
+        if len(rows) > NUM_FOLLOWS_SHOWN:
+            return (users, users[-1].id)
+
+        return (users, None)
+
+    def get_followed_by_following(self, viewer_id, limit=NUM_FOLLOWED_BY_SHOWN):
+        """Gets (usernames, count) of users viewer_id follows who follow user.
+
+        For "followed by people you follow" on user's profile. At most limit
+        usernames; no query if the follow graph finds none.
+        """
+
+        try:
+            ids = follow_graphs.current.followed_by_following(viewer_id, self.id)
+        except GraphUnavailable:
+            ids = Follow.followed_by_following(viewer_id, self.id)
+
+        users = User.get_by_ids(ids[:limit], User.username)
+
+        return [user.username for user in users], len(ids)
+
+    def get_suggestions(self, limit=NUM_SUGGESTIONS_SHOWN):
+        """Gets (id, username) rows of users followed by the users user
+        follows, most followed first. No query if the follow graph finds
+        none.
+        """
+
+        try:
+            suggestions = follow_graphs.current.suggestions(self.id, limit)
+        except GraphUnavailable:
+            suggestions = Follow.suggestions(self.id, limit)
+
+        ids = [id for id, _ in suggestions]
+
+        return User.get_by_ids(ids, User.id, User.username)
+
+    @classmethod
+    def get_by_ids(cls, ids, *columns):
+        """Gets users (or rows of columns) with ids, in the order given.
+
+        Ids of users that no longer exist are skipped. For short lists of
+        ids, such as a page of them; callers slice longer ones first.
+        """
+
+        if not ids:
+            return []
+
+        rows = db.session.query(
+            *(columns or (cls,)), cls.id.label('_id')
+        ).filter(
+            cls.id.in_(ids)
+        ).all()
+
+        by_id = {row._id: row if columns else row[0] for row in rows}
+
+        return [by_id[id] for id in ids if id in by_id]
+
+    def get_follow_state(self, viewer_id):
+        """Gets 'following' or 'requested' if viewer_id follows user or has
+        asked to, else None. One query."""
+
+        following, requested = db.session.query(
+            Follow.is_following(viewer_id, self.id),
+            Request.is_requesting(viewer_id, self.id)
+        ).one()
+
+        if following:
+            return 'following'
+
+        if requested:
+            return 'requested'
+
+        return None
+
+    @classmethod
+    def get_follow_states(cls, viewer_id, user_ids):
+        """Gets get_follow_state for each of user_ids, in one query.
+
+        Returns a dict by user id, without users viewer_id neither follows
+        nor has asked to follow.
+        """
+
+        if not user_ids:
+            return {}
+
+        following = db.select(
+            Follow.user_being_followed_id,
+            db.literal('following')
+        ).where(
+            Follow.user_following_id == viewer_id,
+            Follow.user_being_followed_id.in_(user_ids)
+        )
+
+        requested = db.select(
+            Request.user_being_requested_id,
+            db.literal('requested')
+        ).where(
+            Request.user_requesting_id == viewer_id,
+            Request.user_being_requested_id.in_(user_ids)
+        )
+
+        states = {}
+
+        for user_id, state in db.session.execute(db.union_all(following, requested)):
+            if states.get(user_id) != 'following':
+                states[user_id] = state
+
+        return states
+
     def is_following(self, other_user):
         """Checks if user is following other_user."""
 
-        user_list = [user for user in self.following if user == other_user]
-        return len(user_list) == 1
+        return db.session.query(
+            Follow.is_following(self.id, other_user.id)
+        ).scalar()
 
     def is_followed_by(self, other_user):
         """Checks if user is followed by other_user."""
 
-        user_list = [user for user in self.followers if user == other_user]
-        return len(user_list) == 1
+        return db.session.query(
+            Follow.is_following(other_user.id, self.id)
+        ).scalar()
+
+    @classmethod
+    def visible_to(cls, viewer_id):
+        """SQL expression: can user viewer_id see this user's profile?
+
+        True for public accounts, the viewer's own account, and private
+        accounts the viewer follows.
+        """
+
+        return db.or_(
+            cls.private.is_(False),
+            cls.id == viewer_id,
+            Follow.is_following(viewer_id, cls.id)
+        )
+
+    @classmethod
+    def get_with_visibility(cls, user_id, viewer_id):
+        """Gets (user, can_view) for viewer_id in one query.
+
+        Returns None if there is no such user.
+        """
+
+        return db.session.query(
+            cls,
+            cls.visible_to(viewer_id).label('can_view')
+        ).filter(
+            cls.id == user_id
+        ).one_or_none()
 
     def get_conversations(self):
-        """Gets information about all conversations user a participant in."""
+        """Gets information about all conversations user a participant in.
+
+        Each row has the conversation id, the other participants' usernames
+        and the number of messages from others user hasn't read yet.
+        """
 
-        conversation_ids = [
-        c.conversation_id for c
-        in Participant.query.filter(Participant.user_id == self.id)]
+        viewer = aliased(Participant)
+
+        unread = db.session.query(
+            func.count(Message.id)
+        ).filter(
+            Message.conversation_id == viewer.conversation_id,
+            Message.id > func.coalesce(viewer.last_read_message_id, 0),
+            Message.user_id != self.id
+        ).correlate(viewer).scalar_subquery()
 
         return db.session.query(
             Participant.conversation_id,
-            array_agg(User.username, type_=ARRAY(String)).label('usernames')
-        ).outerjoin(
+            string_array_agg(User.username).label('usernames'),
+            unread.label('unread')
+        ).select_from(
+            User
+        ).join(
             Participant
+        ).join(
+            viewer,
+            db.and_(
+                viewer.conversation_id == Participant.conversation_id,
+                viewer.user_id == self.id
+            )
         ).filter(
-            Participant.user_id != self.id,
-            Participant.conversation_id.in_(conversation_ids)
+            Participant.user_id != self.id
         ).group_by(
-            Participant.conversation_id
+            Participant.conversation_id,
+            viewer.conversation_id,
+            viewer.last_read_message_id
         ).all()
 
+    def count_unread_messages(self):
+        """Counts messages from others user hasn't read, across conversations."""
+
+        return db.session.query(
+            func.count(Message.id)
+        ).join(
+            Participant,
+            db.and_(
+                Participant.conversation_id == Message.conversation_id,
+                Participant.user_id == self.id
+            )
+        ).filter(
+            Message.id > func.coalesce(Participant.last_read_message_id, 0),
+            Message.user_id != self.id
+        ).scalar()
+
+
+@event.listens_for(User, 'after_delete')
+def unfollow_deleted_user(mapper, connection, target):
+    """Take a deleted user's follows out of the follow graph.
+
+    The database deletes them by cascade, which the graph doesn't see.
+    """
+
+    session = object_session(target)
+    graph = follow_graphs.current
+
+    try:
+        following = graph.following(target.id)
+        followers = graph.followers(target.id)
+    except GraphUnavailable:
+        # nothing to take out; a build will read the follows that are left
+        return
+
+    for followed_id in following:
+        record_unfollow(session, target.id, followed_id)
+
+    for follower_id in followers:
+        record_unfollow(session, follower_id, target.id)
+
 
 class ProjectNeedle(db.Model):
     """Join table for projects and needles"""
@@ -293,6 +881,44 @@ class Project(db.Model):
 
     time_logs = db.relationship('TimeLog', backref='project')
 
+    @classmethod
+    def get_with_visibility(cls, project_id, viewer_id):
+        """Gets (project, can_view) for viewer_id in one query.
+
+        The project's user is loaded by the same query. Returns None if
+        there is no such project.
+        """
+
+        return db.session.query(
+            cls,
+            User.visible_to(viewer_id).label('can_view')
+        ).join(
+            cls.user
+        ).options(
+            contains_eager(cls.user)
+        ).filter(
+            cls.id == project_id
+        ).one_or_none()
+
+    @classmethod
+    def get_cards(cls, user_id):
+        """Gets user's project cards, pinned first, then newest first.
+
+        Rows of just the columns the cards show, not Project objects, so
+        nothing is built or tracked in the session for them.
+        """
+
+        return db.session.query(
+            cls.id,
+            cls.title,
+            cls.progress,
+            cls.pinned
+        ).filter(
+            cls.user_id == user_id
+        ).order_by(
+            cls.pinned.desc(), cls.created_at.desc()
+        ).all()
+
 class Yarn(db.Model):
     """Yarn details."""
 
@@ -426,12 +1052,92 @@ class Conversation(db.Model):
         autoincrement=True
     )
 
+    # For one-to-one conversations, the participants' ids in sorted order.
+    # Unique together so each pair of users has at most one conversation.
+    user_low_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='set null'),
+        nullable=True
+    )
+
+    user_high_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='set null'),
+        nullable=True
+    )
+
+    __table_args__ = (
+        db.UniqueConstraint('user_low_id', 'user_high_id'),
+    )
+
+    @classmethod
+    def get_or_create_direct(cls, user_id, other_user_id):
+        """Get the one-to-one conversation between two users.
+
+        If there isn't one yet, create it with both users as participants and
+        add to session; caller commits. A concurrent create of the same pair
+        is caught by the unique pair constraint and the winner is returned.
+        """
+
+        user_low_id, user_high_id = sorted((user_id, other_user_id))
+
+        conversation = cls.query.filter(
+            cls.user_low_id == user_low_id,
+            cls.user_high_id == user_high_id
+        ).one_or_none()
+
+        if conversation:
+            return conversation
+
+        try:
+            with db.session.begin_nested():
+                conversation = cls(
+                    user_low_id=user_low_id,
+                    user_high_id=user_high_id
+                )
+                db.session.add(conversation)
+                db.session.flush()
+
+                db.session.add_all([
+                    Participant(user_id=user_low_id, conversation_id=conversation.id),
+                    Participant(user_id=user_high_id, conversation_id=conversation.id),
+                ])
+                db.session.flush()
+
+        except IntegrityError:
+            conversation = cls.query.filter(
+                cls.user_low_id == user_low_id,
+                cls.user_high_id == user_high_id
+            ).one()
+
+        return conversation
+
+
+class ParticipantCache:
+    """An app's cached memberships (see Participant.is_participant).
+
+    entries maps (user_id, conversation_id) pairs known to be participants
+    to when that stops being trusted, most recently used last. Only
+    memberships are cached, never their absence, so a participant added by
+    another worker process is seen immediately. One removed by another
+    process, or by deleting its user or conversation (which cascades in the
+    database, without ORM events), is seen once its entry expires.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
 
 class Participant(db.Model):
     """Join table for users <--> conversations."""
 
     __tablename__ = 'participants'
 
+    __table_args__ = (
+        db.UniqueConstraint('conversation_id', 'user_id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -448,12 +1154,124 @@ class Participant(db.Model):
         db.ForeignKey('conversations.id', ondelete='cascade')
     )
 
+    last_read_message_id = db.Column(
+        db.Integer,
+        nullable=True
+    )
+
+    @classmethod
+    def is_participant(cls, user_id, conversation_id):
+        """Checks if user is a participant in conversation.
+
+        Memberships are cached per process and app for
+        PARTICIPANT_CACHE_SECONDS, so repeat checks for the same user and
+        conversation don't touch the database.
+        """
+
+        cache = cls._cache()
+        key = (user_id, conversation_id)
+        now = time.monotonic()
+
+        with cache.lock:
+            expires_at = cache.entries.get(key)
+
+            if expires_at is not None:
+                if expires_at > now:
+                    cache.entries.move_to_end(key)
+                    return True
+
+                del cache.entries[key]
+
+        found = db.session.query(
+            cls.query.filter(
+                cls.conversation_id == conversation_id,
+                cls.user_id == user_id
+            ).exists()
+        ).scalar()
+
+        if found:
+            with cache.lock:
+                cache.entries[key] = now + PARTICIPANT_CACHE_SECONDS
+                if len(cache.entries) > PARTICIPANT_CACHE_SIZE:
+                    cache.entries.popitem(last=False)
+
+        return found
+
+    @classmethod
+    def uncache(cls, user_id, conversation_id):
+        """Drop cached membership of user in conversation."""
+
+        cache = cls._cache()
+
+        with cache.lock:
+            cache.entries.pop((user_id, conversation_id), None)
+
+    @classmethod
+    def clear_cache(cls):
+        """Drop all cached memberships."""
+
+        cache = cls._cache()
+
+        with cache.lock:
+            cache.entries.clear()
+
+    @staticmethod
+    def _cache():
+        """The current app's ParticipantCache."""
+
+        return current_app.extensions['participant_cache']
+
+    @classmethod
+    def mark_read(cls, user_id, conversation_id, message_id):
+        """Record user has read conversation up to message_id.
+
+        Single UPDATE that never moves the marker backwards. Adds to session;
+        caller commits.
+        """
+
+        cls.query.filter(
+            cls.user_id == user_id,
+            cls.conversation_id == conversation_id,
+            db.or_(
+                cls.last_read_message_id.is_(None),
+                cls.last_read_message_id < message_id
+            )
+        ).update(
+            {cls.last_read_message_id: message_id},
+            synchronize_session=False
+        )
+
+
+@event.listens_for(Participant, 'after_insert')
+@event.listens_for(Participant, 'after_update')
+@event.listens_for(Participant, 'after_delete')
+def invalidate_participant_cache(mapper, connection, target):
+    """Keep cached memberships in sync with participant changes."""
+
+    Participant.uncache(target.user_id, target.conversation_id)
+
+    # a participant moved to another user or conversation no longer
+    # belongs to its old one
+    attrs = inspect(target).attrs
+    old_user_ids = attrs.user_id.history.deleted or [target.user_id]
+    old_conversation_ids = (attrs.conversation_id.history.deleted
+                            or [target.conversation_id])
+
+    for user_id in old_user_ids:
+        for conversation_id in old_conversation_ids:
+            Participant.uncache(user_id, conversation_id)
+
 
 class Message(db.Model):
     """Messages in a conversation."""
 
     __tablename__ = 'messages'
 
+    # unread counts and conversation history are range scans on this index
+    __table_args__ = (
+        db.Index('ix_messages_conversation_id_id', 'conversation_id', 'id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -485,6 +1303,202 @@ class Message(db.Model):
     conversation = db.relationship('Conversation', backref='messages')
 
 
+class Notification(db.Model):
+    """Event shown on a user's notifications page.
+
+    Append-only: rows are inserted as things happen and never updated.
+    """
+
+    __tablename__ = 'notifications'
+
+    FOLLOW_REQUEST = 'follow_request'
+    NEW_FOLLOWER = 'new_follower'
+    FOLLOW_ACCEPTED = 'follow_accepted'
+    NEW_MESSAGE = 'new_message'
+
+    PAGE_SIZE = 20
+
+    # SQLite only autoincrements INTEGER PRIMARY KEY columns
+    id = db.Column(
+        db.BigInteger().with_variant(db.Integer, 'sqlite'),
+        primary_key=True,
+        autoincrement=True
+    )
+
+    # user being notified
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False
+    )
+
+    # user whose action caused the notification
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False
+    )
+
+    kind = db.Column(
+        db.String(30),
+        nullable=False
+    )
+
+    conversation_id = db.Column(
+        db.Integer,
+        db.ForeignKey('conversations.id', ondelete='cascade'),
+        nullable=True
+    )
+
+    created_at = db.Column(
+        db.DateTime(timezone=True),
+        server_default=timestamp_now(),
+        nullable=False
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_notifications_user_id_created_at',
+            user_id,
+            created_at.desc(),
+            id.desc()
+        ),
+    )
+
+    @classmethod
+    def insert_from(cls, kind, user_id, actor_id, conversation_id=None, where=()):
+        """Build INSERT ... SELECT appending one notification per source row.
+
+        Arguments are column expressions from the table or CTE being selected
+        from (e.g. the RETURNING of another insert), so a write and its
+        notifications can go to the database as one statement.
+        """
+
+        columns = ['user_id', 'actor_id', 'kind']
+        values = [user_id, actor_id, db.literal(kind)]
+
+        if conversation_id is not None:
+            columns.append('conversation_id')
+            values.append(conversation_id)
+
+        return insert(cls).from_select(columns, db.select(*values).where(*where))
+
+    @classmethod
+    def add_for_inserted(cls, kind, inserted, user_id, actor_id):
+        """Run INSERT ... RETURNING, notifying for each row it inserted.
+
+        user_id and actor_id name the RETURNING columns holding the user to
+        notify and the actor. With writable CTEs this is one statement;
+        otherwise the returned rows are read back and notified in a second.
+        Caller commits.
+        """
+
+        if writable_ctes():
+            inserted = inserted.cte('inserted')
+
+            db.session.execute(
+                cls.insert_from(kind, inserted.c[user_id], inserted.c[actor_id])
+            )
+
+            return
+
+        rows = db.session.execute(inserted).mappings().all()
+
+        cls.add_all(kind, [(row[user_id], row[actor_id]) for row in rows])
+
+    @classmethod
+    def add_all(cls, kind, user_and_actor_ids):
+        """Insert a notification per (user id, actor id) pair. Caller commits."""
+
+        if user_and_actor_ids:
+            db.session.execute(
+                db.insert(cls),
+                [
+                    {'user_id': user_id, 'actor_id': actor_id, 'kind': kind}
+                    for user_id, actor_id in user_and_actor_ids
+                ]
+            )
+
+    @classmethod
+    def add_for_message(cls, message):
+        """Notify the other participants of a conversation of a new message.
+
+        One INSERT ... SELECT from participants. Caller commits.
+        """
+
+        db.session.execute(
+            cls.insert_from(
+                cls.NEW_MESSAGE,
+                Participant.user_id,
+                db.literal(message.user_id),
+                Participant.conversation_id,
+                where=(
+                    Participant.conversation_id == message.conversation_id,
+                    Participant.user_id != message.user_id
+                )
+            )
+        )
+
+    @classmethod
+    def get_page(cls, user_id, before=None):
+        """Get a page of user's notifications, newest first.
+
+        before is the (created_at, id) of the last notification on the
+        previous page. Each page is a range scan of the (user_id, created_at)
+        index, however far back it is.
+
+        Returns (notifications, cursor for the next page or None).
+        """
+
+        actor = aliased(User)
+
+        query = db.session.query(
+            cls.id,
+            cls.kind,
+            cls.actor_id,
+            cls.conversation_id,
+            cls.created_at,
+            actor.username.label('actor_username')
+        ).join(
+            actor, actor.id == cls.actor_id
+        ).filter(
+            cls.user_id == user_id
+        )
+
+        if before is not None:
+            query = query.filter(db.tuple_(cls.created_at, cls.id) < before)
+
+        rows = query.order_by(
+            cls.created_at.desc(),
+            cls.id.desc()
+        ).limit(cls.PAGE_SIZE + 1).all()
+
+        notifications = rows[:cls.PAGE_SIZE]
+
+        if len(rows) > cls.PAGE_SIZE:
+            last = notifications[-1]
+            return (notifications, (last.created_at, last.id))
+
+        return (notifications, None)
+
+    @staticmethod
+    def encode_cursor(cursor):
+        """Turn (created_at, id) page cursor into a query string value."""
+
+        created_at, id = cursor
+        return f'{created_at.isoformat()}_{id}'
+
+    @staticmethod
+    def decode_cursor(value):
+        """Turn query string value back into (created_at, id) page cursor.
+
+        Raises ValueError if value isn't a valid cursor.
+        """
+
+        created_at, id = value.rsplit('_', 1)
+        return (datetime.fromisoformat(created_at), int(id))
+
+
 # class Gauge(db.Model):
 #     """Gauge details."""
 
@@ -540,8 +1554,32 @@ class Message(db.Model):
 
 
 def connect_db(app):
-    """Connect to database."""
+    """Set up the database for app, from its pool settings (see pooling).
+
+    REPLICA_DATABASE_URL adds a replica engine (see replicas).
+
+    Connections are only opened once the app is used.
+    """
+
+    if app.config.get('REPLICA_DATABASE_URL'):
+        app.config['SQLALCHEMY_BINDS'] = {
+            **app.config.get('SQLALCHEMY_BINDS', {}),
+            REPLICA_BIND: app.config['REPLICA_DATABASE_URL'],
+        }
+
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        **engine_options(app.config),
+        **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}),
+    }
+
+    db.init_app(app)
+    bcrypt.init_app(app)
+
+    app.extensions['participant_cache'] = ParticipantCache()
+
+    with app.app_context():
+        for engine in db.engines.values():
+            configure_engine(engine)
+            configure_pool(engine, app.config)
 
-    app.app_context().push()
-    db.app = app
-    db.init_app(app)
\ No newline at end of file
+        dispose_after_fork(list(db.engines.values()))
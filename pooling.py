@@ -0,0 +1,95 @@
+"""Connection pool settings, and keeping pools safe across fork.
+
+create_app reads these from the environment (see app.config_from_env):
+
+- DB_POOL_SIZE, DB_MAX_OVERFLOW: connections each worker process keeps
+  open, and how many more it may open under load
+- DB_POOL_RECYCLE: seconds after which a connection is replaced; -1 never
+- DB_POOL_PRE_PING: test connections on checkout, so ones closed by the
+  server or a proxy while idle are replaced instead of failing a request
+- DB_STATEMENT_TIMEOUT_MS: cancel statements running longer; 0 never
+- DB_PGBOUNCER: DATABASE_URL points at PgBouncer in transaction pooling mode
+
+In transaction pooling mode consecutive transactions can run on different
+server connections, so nothing may rely on session state. PgBouncer also
+rejects the startup options that set the statement timeout per connection,
+so it's set with SET LOCAL at the start of every transaction instead.
+LISTEN needs a connection of its own, so message streams listen on
+LISTEN_DATABASE_URL (PostgreSQL itself, or PgBouncer in session mode).
+psycopg2 doesn't use server-side prepared statements, which transaction
+pooling would break.
+
+Each worker process must use its own connections. Forked workers (e.g.
+gunicorn --preload, after the app has been used in the parent) drop the
+pool they inherited, without closing connections the parent still uses.
+"""
+
+import os
+import weakref
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+from dialects import POSTGRESQL
+
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS for the DB_* settings in config.
+
+    Pool sizes only apply to PostgreSQL; SQLite keeps SQLAlchemy's pools.
+    """
+
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+
+    if url.get_backend_name() != POSTGRESQL:
+        return {}
+
+    options = {
+        'pool_size': config.get('DB_POOL_SIZE', 5),
+        'max_overflow': config.get('DB_MAX_OVERFLOW', 10),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', -1),
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', False),
+    }
+
+    timeout = config.get('DB_STATEMENT_TIMEOUT_MS', 0)
+
+    if timeout and not config.get('DB_PGBOUNCER', False):
+        options['connect_args'] = {'options': f'-c statement_timeout={timeout}'}
+
+    return options
+
+
+def configure_pool(engine, config):
+    """Install per-transaction settings on engine, for PgBouncer."""
+
+    timeout = config.get('DB_STATEMENT_TIMEOUT_MS', 0)
+
+    if not (timeout
+            and config.get('DB_PGBOUNCER', False)
+            and engine.dialect.name == POSTGRESQL):
+        return
+
+    @event.listens_for(engine, 'begin')
+    def set_statement_timeout(connection):
+        connection.exec_driver_sql(f'SET LOCAL statement_timeout = {int(timeout)}')
+
+
+# engines whose pools forked children drop; weak, so an app's engines can
+# still be garbage collected
+_fork_safe_engines = weakref.WeakSet()
+
+
+def dispose_after_fork(engines):
+    """Have child processes forked from now on drop engines' inherited pools."""
+
+    _fork_safe_engines.update(engines)
+
+
+def _dispose_inherited_pools():
+    for engine in list(_fork_safe_engines):
+        # close=False: leave the parent's connections alone and just stop
+        # this process from handing them out
+        engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_dispose_inherited_pools)
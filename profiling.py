@@ -0,0 +1,210 @@
+"""On-demand profiling of single requests.
+
+When PROFILER_ENABLED is set, an admin can add ?_profile=1 to any URL to
+profile that one request. A sampling thread records the request thread's
+stack every PROFILER_INTERVAL_MS while it runs. Two files are written to
+PROFILE_DIR, named after the time and endpoint:
+
+- <name>.folded: one `frame;frame;frame count` line per distinct stack,
+  the input format of flamegraph.pl and speedscope
+- <name>.json: wall time and how it splits between db (driver and
+  connection), orm (SQLAlchemy ORM), template (Jinja), form (WTForms) and
+  app (everything else), estimated from the share of samples in each
+
+The file name is sent back in an X-Profile header.
+
+Samples are only taken when the sampling thread gets the GIL, so the real
+resolution is the interpreter's switch interval (5ms by default) rather
+than PROFILER_INTERVAL_MS; short requests give few samples.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import current_app, g, request
+
+DEFAULT_PROFILE_DIR = 'profiles'
+DEFAULT_INTERVAL_MS = 1
+PROFILE_PARAM = '_profile'
+
+CATEGORIES = ('db', 'orm', 'template', 'form', 'app')
+
+# module name prefixes by category; the innermost frame that matches one
+# decides a sample's category
+MODULE_CATEGORIES = (
+    ('psycopg2', 'db'),
+    ('sqlalchemy.engine', 'db'),
+    ('sqlalchemy.pool', 'db'),
+    ('sqlalchemy.dialects', 'db'),
+    ('sqlalchemy.orm', 'orm'),
+    ('jinja2', 'template'),
+    ('wtforms', 'form'),
+    ('flask_wtf', 'form'),
+)
+
+
+class Sampler:
+    """Samples one thread's stack from a background thread."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.categories = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='request-profiler', daemon=True)
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.wall_seconds = time.perf_counter() - self.started_at
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+
+            if frame is not None:
+                self._record(frame)
+
+    def _record(self, frame):
+        names = []
+        category = None
+
+        while frame is not None:
+            module = frame.f_globals.get('__name__', '')
+            template = frame.f_globals.get('__jinja_template__')
+
+            if template is not None:
+                names.append(f'{template.name}:{frame.f_code.co_name}')
+                category = category or 'template'
+            else:
+                names.append(f'{module}:{frame.f_code.co_name}')
+                category = category or _module_category(module)
+
+            frame = frame.f_back
+
+        self.stacks[';'.join(reversed(names))] += 1
+        self.categories[category or 'app'] += 1
+
+
+def _module_category(module):
+    for prefix, category in MODULE_CATEGORIES:
+        if module == prefix or module.startswith(prefix + '.'):
+            return category
+
+    return None
+
+
+class RequestProfiler:
+    """Flask extension profiling admin requests that ask for it.
+
+    Its before_request hook needs g.user, so init_app must be called after
+    the hook that loads the current user is registered.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read settings and install request hooks."""
+
+        app.extensions['profiler'] = _State(
+            app.config.get('PROFILER_ENABLED', False),
+            app.config.get('PROFILE_DIR') or DEFAULT_PROFILE_DIR,
+            app.config.get('PROFILER_INTERVAL_MS', DEFAULT_INTERVAL_MS) / 1000
+        )
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._teardown_request)
+
+    def _start_request(self):
+        state = current_app.extensions['profiler']
+
+        if not (state.enabled
+                and request.args.get(PROFILE_PARAM)
+                and g.get('user') is not None
+                and g.user.is_admin):
+            return
+
+        g.profiler = Sampler(threading.get_ident(), state.interval)
+        g.profiler.start()
+
+    def _finish_request(self, response):
+        sampler = g.pop('profiler', None)
+
+        if sampler is None:
+            return response
+
+        sampler.stop()
+        response.headers['X-Profile'] = self.save(sampler)
+
+        return response
+
+    def _teardown_request(self, exc):
+        sampler = g.pop('profiler', None)
+
+        if sampler is not None:
+            sampler.stop()
+
+    def save(self, sampler):
+        """Write folded stacks and summary; return their shared file name."""
+
+        directory = current_app.extensions['profiler'].directory
+        os.makedirs(directory, exist_ok=True)
+
+        name = (f'{datetime.now().strftime("%Y%m%d-%H%M%S-%f")}-'
+                f'{request.endpoint or "none"}')
+        path = os.path.join(directory, name)
+
+        with open(f'{path}.folded', 'w') as f:
+            for stack, count in sampler.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+        num_samples = sum(sampler.categories.values())
+        wall_ms = sampler.wall_seconds * 1000
+
+        split = {}
+
+        for category in CATEGORIES:
+            share = sampler.categories[category] / num_samples if num_samples else 0
+            split[category] = {
+                'samples': sampler.categories[category],
+                'ms': round(share * wall_ms, 2),
+                'percent': round(share * 100, 1),
+            }
+
+        with open(f'{path}.json', 'w') as f:
+            json.dump({
+                'endpoint': request.endpoint,
+                'method': request.method,
+                'path': request.full_path,
+                'wall_ms': round(wall_ms, 2),
+                'samples': num_samples,
+                'interval_ms': sampler.interval * 1000,
+                'split': split,
+            }, f, indent=2)
+
+        return name
+
+
+class _State:
+    """One app's profiler settings."""
+
+    def __init__(self, enabled, directory, interval):
+        self.enabled = enabled
+        self.directory = directory
+        self.interval = interval
+
+
+profiler = RequestProfiler()
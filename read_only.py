@@ -0,0 +1,90 @@
+"""Read-only transactions for GET requests.
+
+GET and HEAD requests run read-only:
+
+- On PostgreSQL their transactions start READ ONLY (psycopg2 sends BEGIN
+  READ ONLY, so it costs no extra round trip). A stray write fails instead
+  of landing, and nothing they run needs the primary.
+- Autoflush is off. There's nothing to flush, and queries skip checking.
+- Objects aren't expired on commit, e.g. when a stream ends its
+  transaction early, so reading them afterwards doesn't reload them.
+
+Views whose templates only read columns can go further and query plain
+rows (see Project.get_cards), which skips building objects and tracking
+them in the session.
+"""
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy.engine import Engine
+
+from dialects import POSTGRESQL
+
+READ_METHODS = ('GET', 'HEAD')
+
+
+class ReadOnlyRequests:
+    """Flask extension running GET requests read-only.
+
+    Must be initialized before other before_request hooks that query.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Install request hooks."""
+
+        # read-only views of the app's engines, made as they're first needed
+        app.extensions['read_only_requests'] = {}
+        app.before_request(self._start_request)
+        app.teardown_request(self._finish_request)
+
+    @property
+    def active(self):
+        """Is the current request read-only?"""
+
+        return has_request_context() and g.get('read_only', False)
+
+    def bind_for(self, engine):
+        """engine, or during a read-only request, a read-only view of it.
+
+        The view shares engine's pool; connections go back to read-write
+        when they're returned.
+        """
+
+        if (not self.active
+                or not isinstance(engine, Engine)
+                or engine.dialect.name != POSTGRESQL):
+            return engine
+
+        read_only_engines = current_app.extensions['read_only_requests']
+        read_only_engine = read_only_engines.get(engine)
+
+        if read_only_engine is None:
+            read_only_engine = engine.execution_options(postgresql_readonly=True)
+            read_only_engines[engine] = read_only_engine
+
+        return read_only_engine
+
+    def _start_request(self):
+        g.read_only = (request.method in READ_METHODS
+                       and request.endpoint in current_app.view_functions)
+
+        if g.read_only:
+            session = current_app.extensions['sqlalchemy'].session()
+            g.session_settings = (session.autoflush, session.expire_on_commit)
+
+            session.autoflush = False
+            session.expire_on_commit = False
+
+    def _finish_request(self, exc):
+        settings = g.pop('session_settings', None)
+        g.read_only = False
+
+        if settings is not None:
+            session = current_app.extensions['sqlalchemy'].session()
+            session.autoflush, session.expire_on_commit = settings
+
+
+read_only_requests = ReadOnlyRequests()
@@ -0,0 +1,136 @@
+"""Read replica routing.
+
+With REPLICA_DATABASE_URL set, reads made while handling GET and HEAD
+requests go to the replica, and everything else goes to the primary:
+
+- writes (flushes, INSERT/UPDATE/DELETE, text() statements such as
+  pg_notify, SELECT ... FOR UPDATE), and every read after them in the same
+  request, so a request reads its own writes
+- every statement of other requests (POST etc.), which read in order to
+  write
+- anything outside a request: scripts, tests, background threads
+
+Replicas lag behind the primary, so after a user's request writes, their
+requests stick to the primary for REPLICA_STICKY_SECONDS (default 10).
+The deadline is kept in their session cookie, which every worker can read.
+
+A replica can be tried out locally as a second URL for the same database:
+
+    REPLICA_DATABASE_URL=postgresql:///craft_app?application_name=replica
+"""
+
+import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+
+from read_only import READ_METHODS, read_only_requests
+
+REPLICA_BIND = 'replica'
+PRIMARY_UNTIL_KEY = 'primary_until'
+DEFAULT_STICKY_SECONDS = 10
+
+
+class ReplicaRouter:
+    """Flask extension choosing the primary or the replica per statement.
+
+    An app's replica engine is its 'replica' bind, which connect_db adds
+    from REPLICA_DATABASE_URL. Routing is off for apps without one.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Find the replica engine and install request hooks.
+
+        Must be called before other before_request hooks that query.
+        """
+
+        with app.app_context():
+            replica = app.extensions['sqlalchemy'].engines.get(REPLICA_BIND)
+
+        app.extensions['replica_router'] = _State(
+            replica,
+            app.config.get('REPLICA_STICKY_SECONDS', DEFAULT_STICKY_SECONDS)
+        )
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+    @property
+    def replica(self):
+        """The current app's replica engine, or None."""
+
+        return current_app.extensions['replica_router'].replica
+
+    def use_primary(self):
+        """Send the rest of the current request's statements to the primary.
+
+        For reads that mustn't lag behind it, such as ones that must see
+        everything already announced by NOTIFY, which the primary sends.
+        """
+
+        g.db_primary = True
+
+    def use_replica(self, clause, flushing):
+        """Should the statement clause go to the replica?
+
+        Records writes, so the rest of the request reads from the primary.
+        """
+
+        if not has_request_context() or self.replica is None:
+            return False
+
+        if (flushing
+                or clause is None
+                or not clause.is_select
+                or getattr(clause, '_for_update_arg', None) is not None):
+            g.db_wrote = True
+            return False
+
+        return (request.method in READ_METHODS
+                and not g.get('db_wrote', True)
+                and not g.get('db_primary', True))
+
+    def _start_request(self):
+        g.db_wrote = False
+        g.db_primary = time.time() < session.get(PRIMARY_UNTIL_KEY, 0)
+
+    def _finish_request(self, response):
+        state = current_app.extensions['replica_router']
+
+        if state.replica is None:
+            return response
+
+        if g.get('db_wrote'):
+            session[PRIMARY_UNTIL_KEY] = time.time() + state.sticky_seconds
+
+        return response
+
+
+class _State:
+    """One app's replica engine and sticky window."""
+
+    def __init__(self, replica, sticky_seconds):
+        self.replica = replica
+        self.sticky_seconds = sticky_seconds
+
+
+replica_router = ReplicaRouter()
+
+
+class RoutingSession(Session):
+    """Session sending statements where replica_router says.
+
+    During read-only requests, transactions start READ ONLY (see read_only).
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and replica_router.use_replica(clause, self._flushing):
+            engine = replica_router.replica
+        else:
+            engine = super().get_bind(
+                mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+        return read_only_requests.bind_for(engine)
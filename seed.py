@@ -0,0 +1,468 @@
+"""Seed database with synthetic data.
+
+Drops and recreates every table in DATABASE_URL, then fills them with
+generated users, follows, follow requests, projects (with yarns, needles,
+hooks and time logs), conversations, messages and notifications.
+
+    python seed.py                          # small dataset for development
+    python seed.py --users 100000 --projects 1000000 --conversations 200000
+
+Rows are generated with fixed ids and streamed in with COPY, so large
+datasets load in minutes. SQLite has no COPY, so there they're inserted in
+batches instead:
+
+    python seed.py --database-url sqlite:///craft_app.db
+
+Every user's password is "password"; user1 is an admin.
+"""
+
+import argparse
+import io
+import os
+import random
+import time
+from datetime import date, datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+
+from dialects import POSTGRESQL
+from models import db, bcrypt, Notification, DEFAULT_IMG_URL
+from forms import YarnForm, NeedleForm, HookForm, ProgressForm
+
+BATCH_SIZE = 50000
+PASSWORD = 'password'
+
+# followed mostly by popularity, sometimes uniformly, so the in-degree
+# distribution has a power-law tail without every user following the same few
+PREFERENTIAL_FRACTION = 0.8
+
+NEEDLE_SIZES = [size for size, _ in NeedleForm.size.kwargs['choices']]
+HOOK_SIZES = [size for size, _ in HookForm.size.kwargs['choices']]
+YARN_WEIGHTS = [weight for weight, _ in YarnForm.weight.kwargs['choices']]
+PROGRESS = [progress for progress, _ in ProgressForm.progress.kwargs['choices']]
+
+ADJECTIVES = ['Cozy', 'Chunky', 'Striped', 'Cabled', 'Lacy', 'Simple', 'Twisted',
+              'Brioche', 'Ribbed', 'Seamless', 'Fair Isle', 'Granny']
+ITEMS = ['Sweater', 'Hat', 'Scarf', 'Socks', 'Mittens', 'Shawl', 'Blanket',
+         'Cardigan', 'Cowl', 'Tote', 'Amigurumi Bear', 'Vest']
+YARNS = ['Merino Worsted', 'Alpaca Silk', 'Cotton DK', 'Sock Yarn', 'Mohair Lace',
+         'Acrylic Aran', 'Wool Bulky']
+COLORS = ['Oatmeal', 'Forest', 'Rust', 'Navy', 'Blush', 'Charcoal', 'Mustard']
+MESSAGES = ['hi!', 'love your latest project', 'what yarn is that?',
+            'thanks!', 'which needle size did you use?', 'so cozy',
+            'want to swap patterns?', 'frogged mine again...']
+
+
+def power_law_edges(num_users, avg_following, seed=0):
+    """Generate (follower id, followed id) pairs by preferential attachment.
+
+    Users join one at a time and follow an exponentially distributed number
+    of earlier users, picked in proportion to their follower count most of
+    the time. Ids run from 1 to num_users.
+    """
+
+    rng = random.Random(seed)
+    popular = []
+    edges = []
+
+    for user_id in range(2, num_users + 1):
+        num_following = min(user_id - 1, int(rng.expovariate(1 / avg_following)))
+        following = set()
+
+        while len(following) < num_following:
+            if popular and rng.random() < PREFERENTIAL_FRACTION:
+                following.add(rng.choice(popular))
+            else:
+                following.add(rng.randint(1, user_id - 1))
+
+        for followed_id in following:
+            edges.append((user_id, followed_id))
+            popular.append(followed_id)
+
+    return edges
+
+
+def copy_rows(cursor, table, columns, rows):
+    """COPY rows (tuples, None for NULL) into table, in batches.
+
+    Returns number of rows copied.
+    """
+
+    statement = f'COPY {table} ({", ".join(columns)}) FROM STDIN'
+    num_rows = 0
+    buffer = io.StringIO()
+
+    for row in rows:
+        buffer.write('\t'.join(_copy_value(value) for value in row))
+        buffer.write('\n')
+        num_rows += 1
+
+        if num_rows % BATCH_SIZE == 0:
+            buffer.seek(0)
+            cursor.copy_expert(statement, buffer)
+            buffer = io.StringIO()
+
+    buffer.seek(0)
+    cursor.copy_expert(statement, buffer)
+
+    return num_rows
+
+
+def insert_rows(cursor, table, columns, rows):
+    """INSERT rows into table, in batches, for SQLite, which has no COPY.
+
+    Returns number of rows inserted.
+    """
+
+    statement = (f'INSERT INTO {table} ({", ".join(columns)}) '
+                 f'VALUES ({", ".join("?" * len(columns))})')
+    num_rows = 0
+    batch = []
+
+    for row in rows:
+        batch.append(tuple(_insert_value(value) for value in row))
+        num_rows += 1
+
+        if len(batch) == BATCH_SIZE:
+            cursor.executemany(statement, batch)
+            batch = []
+
+    cursor.executemany(statement, batch)
+
+    return num_rows
+
+
+def _insert_value(value):
+    # stored the way SQLAlchemy stores dates and datetimes on SQLite,
+    # datetimes in UTC, so they compare correctly with ones it binds
+    if isinstance(value, datetime):
+        return (value.astimezone(timezone.utc).replace(tzinfo=None)
+                .strftime('%Y-%m-%d %H:%M:%S.%f'))
+
+    if isinstance(value, date):
+        return value.isoformat()
+
+    return value
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+
+    return (str(value)
+            .replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n'))
+
+
+class Generator:
+    """Rows for each table, generated from one seed so reruns match.
+
+    Dates and times are date and datetime objects; copy_rows and
+    insert_rows each format them for their database.
+    """
+
+    def __init__(self, users, following, private, pending, projects,
+                 conversations, messages, seed=0):
+        self.num_users = users
+        self.avg_following = following
+        self.private_fraction = private
+        self.pending_fraction = pending
+        self.num_projects = projects
+        self.num_conversations = conversations
+        self.avg_messages = messages
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.now = datetime.now(timezone.utc)
+
+        self.private = {
+            user_id for user_id in range(1, users + 1)
+            if self.rng.random() < private
+        }
+
+        self.follows = []
+        self.requests = []
+
+        for follower_id, followed_id in power_law_edges(users, following, seed):
+            if followed_id in self.private and self.rng.random() < pending:
+                self.requests.append((followed_id, follower_id))
+            else:
+                self.follows.append((followed_id, follower_id))
+
+    def users(self):
+        password = bcrypt.generate_password_hash(PASSWORD).decode('utf-8')
+
+        for user_id in range(1, self.num_users + 1):
+            yield (
+                user_id,
+                f'user{user_id}',
+                f'user{user_id}@example.com',
+                DEFAULT_IMG_URL,
+                password,
+                user_id in self.private,
+                user_id == 1,
+            )
+
+    def projects(self):
+        """Projects, and the yarns, needles, hooks and time logs for each.
+
+        Yields (table, row) pairs so one pass fills every project table.
+        """
+
+        rng = self.rng
+        ids = {'yarns': 0, 'projects_needles': 0, 'projects_hooks': 0, 'time_logs': 0}
+
+        for project_id in range(1, self.num_projects + 1):
+            created_at = self.now - timedelta(seconds=rng.randrange(3 * 365 * 86400))
+
+            yield 'projects', (
+                project_id,
+                rng.randint(1, self.num_users),
+                f'{rng.choice(ADJECTIVES)} {rng.choice(ITEMS)}',
+                f'Pattern {rng.randrange(10000)}',
+                f'Designer {rng.randrange(1000)}',
+                rng.random() < 0.05,
+                rng.choice(PROGRESS),
+                created_at,
+            )
+
+            for _ in range(rng.randint(0, 3)):
+                ids['yarns'] += 1
+                yield 'yarns', (
+                    ids['yarns'],
+                    project_id,
+                    rng.choice(YARNS),
+                    rng.choice(COLORS),
+                    f'{rng.randrange(1000):03}',
+                    rng.choice(YARN_WEIGHTS),
+                    100,
+                    'grams',
+                    rng.choice([200, 220, 400]),
+                    'yards',
+                    rng.randint(1, 10),
+                )
+
+            for size in rng.sample(NEEDLE_SIZES, rng.randint(0, 2)):
+                ids['projects_needles'] += 1
+                yield 'projects_needles', (ids['projects_needles'], project_id, size)
+
+            for size in rng.sample(HOOK_SIZES, rng.randint(0, 1)):
+                ids['projects_hooks'] += 1
+                yield 'projects_hooks', (ids['projects_hooks'], project_id, size)
+
+            for _ in range(rng.randint(0, 5)):
+                ids['time_logs'] += 1
+                logged_on = created_at.date() + timedelta(days=rng.randrange(60))
+                yield 'time_logs', (
+                    ids['time_logs'],
+                    project_id,
+                    min(logged_on, date.today()),
+                    rng.randint(0, 3),
+                    rng.randrange(0, 60, 5),
+                    '',
+                )
+
+    def conversations(self):
+        """Conversations, their participants and messages, as (table, row)."""
+
+        rng = self.rng
+        pairs = set()
+        max_pairs = self.num_users * (self.num_users - 1) // 2
+
+        while len(pairs) < min(self.num_conversations, max_pairs):
+            a, b = rng.sample(range(1, self.num_users + 1), 2)
+            pairs.add((min(a, b), max(a, b)))
+
+        participant_id = 0
+        message_id = 0
+
+        for conversation_id, (low_id, high_id) in enumerate(sorted(pairs), 1):
+            yield 'conversations', (conversation_id, low_id, high_id)
+
+            sent_at = self.now - timedelta(seconds=rng.randrange(365 * 86400))
+            message_ids = []
+
+            for _ in range(1 + int(rng.expovariate(1 / self.avg_messages))):
+                message_id += 1
+                sent_at += timedelta(seconds=rng.randrange(1, 3600))
+                sender_id = rng.choice((low_id, high_id))
+                message_ids.append((message_id, sender_id))
+
+                yield 'messages', (
+                    message_id,
+                    sender_id,
+                    conversation_id,
+                    rng.choice(MESSAGES),
+                    min(sent_at, self.now),
+                )
+
+            for user_id in (low_id, high_id):
+                participant_id += 1
+
+                # read up to a random point, so some conversations are unread
+                read = message_ids[:rng.randint(0, len(message_ids))]
+
+                yield 'participants', (
+                    participant_id,
+                    user_id,
+                    conversation_id,
+                    read[-1][0] if read else None,
+                )
+
+    def notifications(self):
+        """A follow request notification for each pending request."""
+
+        for notification_id, (requested_id, requesting_id) in enumerate(self.requests, 1):
+            yield (
+                notification_id,
+                requested_id,
+                requesting_id,
+                Notification.FOLLOW_REQUEST,
+                self.now,
+            )
+
+
+TABLE_COLUMNS = {
+    'users': ('id', 'username', 'email', 'image_url', 'password', 'private', 'is_admin'),
+    'needles': ('size',),
+    'hooks': ('size',),
+    'follows': ('user_being_followed_id', 'user_following_id'),
+    'requests': ('user_being_requested_id', 'user_requesting_id'),
+    'projects': ('id', 'user_id', 'title', 'pattern', 'designer', 'pinned',
+                 'progress', 'created_at'),
+    'yarns': ('id', 'project_id', 'yarn_name', 'color', 'dye_lot', 'weight',
+              'skein_weight', 'skein_weight_unit', 'skein_length',
+              'skein_length_unit', 'num_skeins'),
+    'projects_needles': ('id', 'project_id', 'needle_size'),
+    'projects_hooks': ('id', 'project_id', 'hook_size'),
+    'time_logs': ('id', 'project_id', 'date', 'hours', 'minutes', 'notes'),
+    'conversations': ('id', 'user_low_id', 'user_high_id'),
+    'messages': ('id', 'user_id', 'conversation_id', 'text', 'created_at'),
+    'participants': ('id', 'user_id', 'conversation_id', 'last_read_message_id'),
+    'notifications': ('id', 'user_id', 'actor_id', 'kind', 'created_at'),
+}
+
+# tables with serial ids whose sequences need moving past the copied ids
+SERIAL_TABLES = ['users', 'projects', 'yarns', 'projects_needles',
+                 'projects_hooks', 'time_logs', 'conversations', 'messages',
+                 'participants', 'notifications']
+
+
+def seed(engine, generator, log=print):
+    """Recreate all tables in engine's database and load generator's rows."""
+
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+
+    postgresql = engine.dialect.name == POSTGRESQL
+    load_rows = copy_rows if postgresql else insert_rows
+
+    connection = engine.raw_connection()
+
+    try:
+        cursor = connection.cursor()
+        counts = {}
+
+        def load(table, rows):
+            start = time.perf_counter()
+            counts[table] = load_rows(cursor, table, TABLE_COLUMNS[table], rows)
+            log(f'{table:18} {counts[table]:>10} rows  {time.perf_counter() - start:6.1f}s')
+
+        load('needles', ((size,) for size in NEEDLE_SIZES))
+        load('hooks', ((size,) for size in HOOK_SIZES))
+        load('users', generator.users())
+        load('follows', generator.follows)
+        load('requests', generator.requests)
+        load('notifications', generator.notifications())
+
+        for group in (generator.projects, generator.conversations):
+            # one generator pass fills several tables; buffer rows per table
+            # and COPY them all whenever one fills up, parents first (in the
+            # order first yielded) so foreign keys are always satisfied
+            start = time.perf_counter()
+            buffers = {}
+
+            def flush():
+                for table, rows in buffers.items():
+                    counts[table] = counts.get(table, 0) + load_rows(
+                        cursor, table, TABLE_COLUMNS[table], rows)
+                    rows.clear()
+
+            for table, row in group():
+                rows = buffers.setdefault(table, [])
+                rows.append(row)
+
+                if len(rows) >= BATCH_SIZE:
+                    flush()
+
+            flush()
+
+            for table in buffers:
+                log(f'{table:18} {counts[table]:>10} rows')
+
+            log(f'{"":18} {"":>10}       {time.perf_counter() - start:6.1f}s')
+
+        # SQLite carries on from the highest id by itself
+        for table in SERIAL_TABLES if postgresql else ():
+            cursor.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"(SELECT coalesce(max(id), 0) + 1 FROM {table}), false)"
+            )
+
+        connection.commit()
+
+        for table in TABLE_COLUMNS:
+            cursor.execute(f'ANALYZE {table}')
+
+        connection.commit()
+
+    finally:
+        connection.close()
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--following', type=float, default=10,
+                        help='average number of users each user follows')
+    parser.add_argument('--private', type=float, default=0.1,
+                        help='fraction of accounts that are private')
+    parser.add_argument('--pending', type=float, default=0.2,
+                        help='fraction of follows of private accounts left as requests')
+    parser.add_argument('--projects', type=int, default=1000)
+    parser.add_argument('--conversations', type=int, default=300)
+    parser.add_argument('--messages', type=float, default=8,
+                        help='average number of messages per conversation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database-url', default=None)
+    args = parser.parse_args()
+
+    load_dotenv()
+
+    engine = create_engine(args.database_url or os.environ['DATABASE_URL'])
+
+    start = time.perf_counter()
+
+    generator = Generator(
+        users=args.users,
+        following=args.following,
+        private=args.private,
+        pending=args.pending,
+        projects=args.projects,
+        conversations=args.conversations,
+        messages=args.messages,
+        seed=args.seed,
+    )
+
+    seed(engine, generator)
+
+    print(f'seeded in {time.perf_counter() - start:.1f}s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""Slow-query log.
+
+Statements slower than a threshold are written, one JSON object per line,
+to a rotating log file with what's needed to find where they came from:
+
+- the SQL and the shape of its parameters (types, not values, so password
+  hashes and messages stay out of the log)
+- the endpoint, method and path of the request that ran it
+- the app and template frames that led to it, innermost last; template
+  frames give the template line, e.g. a lazy load from a macro shows up as
+  `users/macros.html:12 (template macro create_user_card)`
+
+A sample of slow SELECTs can also be run again under EXPLAIN ANALYZE. That
+runs inside a savepoint that is rolled back, so functions with side effects
+(pg_notify) don't fire twice.
+"""
+
+import json
+import logging
+import os
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+
+from flask import current_app, has_request_context, request
+from sqlalchemy import event
+
+from models import db
+
+START_KEY = 'slow_query_start'
+EXPLAIN_SAVEPOINT = 'slow_query_explain'
+DEFAULT_LOG_FILE = 'slow_queries.log'
+DEFAULT_STACK_DEPTH = 12
+MAX_LOG_BYTES = 10 * 1024 * 1024
+NUM_LOG_BACKUPS = 5
+
+
+class SlowQueryLog:
+    """Flask extension logging statements slower than a threshold.
+
+    Config, per app:
+    - SLOW_QUERY_MS: threshold; unset or 0 turns the log off
+    - SLOW_QUERY_LOG: file to write, rotated at 10MB
+    - SLOW_QUERY_EXPLAIN_RATE: fraction of slow SELECTs to EXPLAIN ANALYZE
+      (PostgreSQL only)
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Open the log file and start listening if a threshold is set."""
+
+        with app.app_context():
+            # the primary, and the replica if there is one
+            engines = list(db.engines.values())
+
+        app.extensions['slow_query_log'] = _State(
+            engines,
+            app.root_path,
+            app.config.get('SLOW_QUERY_STACK_DEPTH', DEFAULT_STACK_DEPTH)
+        )
+
+        if app.config.get('SLOW_QUERY_MS'):
+            self.enable(
+                app.config['SLOW_QUERY_MS'],
+                app.config.get('SLOW_QUERY_LOG') or DEFAULT_LOG_FILE,
+                app.config.get('SLOW_QUERY_EXPLAIN_RATE', 0.0),
+                app
+            )
+
+    @property
+    def enabled(self):
+        """Is the current app logging slow statements?"""
+
+        return _state().enabled
+
+    def enable(self, threshold_ms, path=DEFAULT_LOG_FILE, explain_rate=0.0, app=None):
+        """Log app's statements taking at least threshold_ms to path.
+
+        app is by default the current one.
+        """
+
+        state = _state(app)
+        state.disable()
+        state.enable(threshold_ms / 1000, path, explain_rate)
+
+    def disable(self, app=None):
+        """Stop logging app's statements and close the log file."""
+
+        _state(app).disable()
+
+
+class _State:
+    """One app's engines, and the log they're being listened on for."""
+
+    def __init__(self, engines, root_path, stack_depth):
+        self.engines = engines
+        self.root_path = root_path
+        self.stack_depth = stack_depth
+        self.threshold_seconds = None
+        self.explain_rate = 0.0
+        self.handler = None
+
+    @property
+    def enabled(self):
+        return self.threshold_seconds is not None
+
+    def enable(self, threshold_seconds, path, explain_rate):
+        self.handler = RotatingFileHandler(
+            path, maxBytes=MAX_LOG_BYTES, backupCount=NUM_LOG_BACKUPS)
+        self.handler.setFormatter(logging.Formatter('%(message)s'))
+        self.threshold_seconds = threshold_seconds
+        self.explain_rate = explain_rate
+
+        for engine in self.engines:
+            event.listen(engine, 'before_cursor_execute', self._before_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_execute)
+
+    def disable(self):
+        if not self.enabled:
+            return
+
+        for engine in self.engines:
+            event.remove(engine, 'before_cursor_execute', self._before_execute)
+            event.remove(engine, 'after_cursor_execute', self._after_execute)
+
+        self.threshold_seconds = None
+        self.handler.close()
+        self.handler = None
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info[START_KEY] = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started_at = conn.info.pop(START_KEY, None)
+
+        if started_at is None:
+            return
+
+        duration = time.perf_counter() - started_at
+
+        if duration < self.threshold_seconds:
+            return
+
+        record = {
+            'at': datetime.now(timezone.utc).isoformat(),
+            'duration_ms': round(duration * 1000, 2),
+            'statement': statement,
+            'parameters': parameter_shape(parameters),
+            'executemany': executemany,
+            'endpoint': None,
+            'method': None,
+            'path': None,
+            'stack': call_site(self.root_path, self.stack_depth),
+        }
+
+        if has_request_context():
+            record['endpoint'] = request.endpoint
+            record['method'] = request.method
+            record['path'] = request.path
+
+        if (self.explain_rate
+                and conn.dialect.name == 'postgresql'
+                and conn.in_transaction()
+                and not executemany
+                and statement.lstrip().upper().startswith('SELECT')
+                and random.random() < self.explain_rate):
+            record['explain'] = explain_analyze(cursor.connection, statement, parameters)
+
+        # straight to this app's file, not through a logger every app shares
+        self.handler.handle(logging.makeLogRecord({
+            'name': __name__,
+            'levelno': logging.INFO,
+            'levelname': 'INFO',
+            'msg': json.dumps(record, default=str),
+        }))
+
+
+def _state(app=None):
+    return (app or current_app).extensions['slow_query_log']
+
+
+def parameter_shape(parameters):
+    """Parameters with values replaced by their type names."""
+
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            return [f'{len(parameters)} x', parameter_shape(parameters[0])]
+
+        return [type(value).__name__ for value in parameters]
+
+    return type(parameters).__name__
+
+
+def call_site(root_path, depth):
+    """App and template frames leading to the current statement.
+
+    Outermost first, at most depth of them, skipping library frames and
+    this module.
+    """
+
+    frames = []
+    frame = sys._getframe(1)
+    this_file = os.path.abspath(__file__)
+
+    while frame is not None and len(frames) < depth:
+        template = frame.f_globals.get('__jinja_template__')
+        filename = os.path.abspath(frame.f_code.co_filename)
+
+        if template is not None:
+            frames.append(
+                f'{template.name}:{template.get_corresponding_lineno(frame.f_lineno)} '
+                f'(template {_template_function(frame)})'
+            )
+
+        elif (not frame.f_code.co_filename.startswith('<')
+                and filename.startswith(root_path + os.sep)
+                and filename != this_file
+                and 'site-packages' not in filename):
+            frames.append(
+                f'{os.path.relpath(filename, root_path)}:{frame.f_lineno} '
+                f'in {frame.f_code.co_name}'
+            )
+
+        frame = frame.f_back
+
+    return frames[::-1]
+
+
+def _template_function(frame):
+    """Readable name for a compiled template function's frame.
+
+    Blocks compile to block_<name> functions. Macros all compile to
+    functions named macro, called by jinja2's Macro object, which has the
+    name.
+    """
+
+    code_name = frame.f_code.co_name
+
+    if code_name.startswith('block_'):
+        return f'block {code_name[len("block_"):]}'
+
+    if code_name == 'macro' and frame.f_back is not None:
+        macro = frame.f_back.f_locals.get('self')
+
+        if getattr(macro, 'name', None):
+            return f'macro {macro.name}'
+
+    return code_name
+
+
+def explain_analyze(dbapi_connection, statement, parameters):
+    """EXPLAIN ANALYZE plan for statement, run and rolled back in a savepoint.
+
+    Must be called inside a transaction. Never raises, so it can't fail the
+    statement being logged: anything that goes wrong is returned as lines
+    of the plan instead.
+    """
+
+    try:
+        cursor = dbapi_connection.cursor()
+    except Exception as error:
+        return [f'EXPLAIN failed: {error}']
+
+    try:
+        try:
+            cursor.execute(f'SAVEPOINT {EXPLAIN_SAVEPOINT}')
+        except Exception as error:
+            return [f'EXPLAIN failed: {error}']
+
+        try:
+            cursor.execute(f'EXPLAIN ANALYZE {statement}', parameters)
+            plan = [row[0] for row in cursor.fetchall()]
+        except Exception as error:
+            plan = [f'EXPLAIN failed: {error}']
+
+        # separately, so a failure here doesn't hide why EXPLAIN failed
+        try:
+            cursor.execute(f'ROLLBACK TO SAVEPOINT {EXPLAIN_SAVEPOINT}')
+            cursor.execute(f'RELEASE SAVEPOINT {EXPLAIN_SAVEPOINT}')
+        except Exception as error:
+            plan.append(f'Rolling back EXPLAIN failed: {error}')
+
+        return plan
+
+    finally:
+        try:
+            cursor.close()
+        except Exception:
+            pass
+
+
+slow_query_log = SlowQueryLog()
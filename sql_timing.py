@@ -0,0 +1,176 @@
+"""Per-request SQL timing.
+
+When enabled, every statement sent to the database while a request is
+handled is counted and timed. The totals go out as a Server-Timing response
+header, which browser dev tools show next to the request, and as one JSON
+log line per request:
+
+    Server-Timing: db;dur=12.4;desc="7 queries", db-slowest;dur=5.1, app;dur=31.0
+
+When disabled, no engine listeners are installed, so statements cost
+nothing extra; the request hooks only check a flag.
+"""
+
+import json
+import logging
+import time
+
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+STATS_KEY = 'sql_stats'
+START_KEY = 'sql_timing_start'
+MAX_LOGGED_STATEMENT_LENGTH = 500
+
+
+class RequestStats:
+    """Statements run while handling one request."""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.num_statements = 0
+        self.db_seconds = 0.0
+        self.slowest_seconds = 0.0
+        self.slowest_statement = None
+
+    def record(self, statement, seconds):
+        self.num_statements += 1
+        self.db_seconds += seconds
+
+        if seconds >= self.slowest_seconds:
+            self.slowest_seconds = seconds
+            self.slowest_statement = statement
+
+    def server_timing(self):
+        """Value for the Server-Timing header. Durations in milliseconds."""
+
+        total_ms = (time.perf_counter() - self.started_at) * 1000
+
+        return (
+            f'db;dur={self.db_seconds * 1000:.1f};desc="{self.num_statements} queries", '
+            f'db-slowest;dur={self.slowest_seconds * 1000:.1f}, '
+            f'app;dur={total_ms:.1f}'
+        )
+
+
+class SQLTiming:
+    """Flask extension recording SQL statement count and time per request.
+
+    Switched per app by the SQL_TIMING config value, or at runtime with
+    enable() and disable().
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Install request hooks, and engine listeners if enabled in config."""
+
+        with app.app_context():
+            # the primary, and the replica if there is one
+            engines = list(db.engines.values())
+
+        app.extensions['sql_timing'] = _State(engines)
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+        if app.config.get('SQL_TIMING', False):
+            self.enable(app)
+
+    @property
+    def enabled(self):
+        """Is the current app timing statements?"""
+
+        return _state().enabled
+
+    def enable(self, app=None):
+        """Start timing statements in app, by default the current one."""
+
+        state = _state(app)
+
+        if not state.enabled:
+            for engine in state.engines:
+                event.listen(engine, 'before_cursor_execute', _before_execute)
+                event.listen(engine, 'after_cursor_execute', _after_execute)
+            state.enabled = True
+
+    def disable(self, app=None):
+        """Stop timing statements and remove the engine listeners."""
+
+        state = _state(app)
+
+        if state.enabled:
+            for engine in state.engines:
+                event.remove(engine, 'before_cursor_execute', _before_execute)
+                event.remove(engine, 'after_cursor_execute', _after_execute)
+            state.enabled = False
+
+    def _start_request(self):
+        g.pop(STATS_KEY, None)
+
+        if _state().enabled:
+            g.sql_stats = RequestStats()
+
+    def _finish_request(self, response):
+        stats = g.pop(STATS_KEY, None)
+
+        if stats is None:
+            return response
+
+        response.headers['Server-Timing'] = stats.server_timing()
+
+        statement = stats.slowest_statement
+
+        if statement is not None and len(statement) > MAX_LOGGED_STATEMENT_LENGTH:
+            statement = statement[:MAX_LOGGED_STATEMENT_LENGTH] + '...'
+
+        logger.info(json.dumps({
+            'event': 'sql_timing',
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'statements': stats.num_statements,
+            'db_ms': round(stats.db_seconds * 1000, 2),
+            'slowest_ms': round(stats.slowest_seconds * 1000, 2),
+            'slowest_statement': statement,
+            'total_ms': round((time.perf_counter() - stats.started_at) * 1000, 2),
+        }))
+
+        return response
+
+
+class _State:
+    """One app's engines, and whether they're being timed."""
+
+    def __init__(self, engines):
+        self.engines = engines
+        self.enabled = False
+
+
+def _state(app=None):
+    return (app or current_app).extensions['sql_timing']
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info[START_KEY] = time.perf_counter()
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    started_at = conn.info.pop(START_KEY, None)
+
+    if started_at is None or not has_app_context():
+        return
+
+    stats = g.get(STATS_KEY)
+
+    if stats is not None:
+        stats.record(statement, time.perf_counter() - started_at)
+
+
+sql_timing = SQLTiming()
@@ -0,0 +1,90 @@
+"use strict";
+
+/** Send and receive messages in the open conversation without reloading. */
+
+const $messages = document.getElementById("messages");
+const $form = document.getElementById("msg-form");
+const $compose = document.getElementById("msg-compose");
+const currentUserId = Number($messages.dataset.userId);
+
+/** Checks if message is already shown. */
+function isShown(messageId) {
+  return $messages.querySelector(`[data-message-id="${messageId}"]`) !== null;
+}
+
+/** Id of the last message shown, or 0 if there are none. */
+function lastShownId() {
+  const $shown = $messages.querySelectorAll("[data-message-id]");
+
+  return $shown.length ? $shown[$shown.length - 1].dataset.messageId : 0;
+}
+
+/** Record that the user has read up to the last message shown. */
+function markRead() {
+  const lastId = lastShownId();
+  if (!lastId || document.visibilityState !== "visible") return;
+
+  const data = new FormData();
+  const $csrfToken = $form.elements.csrf_token;
+  if ($csrfToken) data.append("csrf_token", $csrfToken.value);
+  data.append("message_id", lastId);
+
+  fetch($messages.dataset.readUrl, { method: "POST", body: data });
+}
+
+/** Add message to the conversation unless it is already shown. */
+function appendMessage(message) {
+  if (isShown(message.id)) return;
+
+  const $message = document.createElement("div");
+  $message.dataset.messageId = message.id;
+  $message.className = message.user_id === currentUserId
+    ? "rounded p-2 message mb-1 bg-secondary-subtle align-self-end"
+    : "rounded p-2 message mb-1 align-self-start bg-primary-subtle";
+  $message.textContent = message.text;
+
+  $messages.append($message);
+}
+
+/** Send composed message; fall back to a normal form post on failure. */
+async function sendMessage(evt) {
+  evt.preventDefault();
+
+  const resp = await fetch($form.dataset.apiUrl, {
+    method: "POST",
+    body: new FormData($form),
+  });
+
+  if (!resp.ok) {
+    $form.submit();
+    return;
+  }
+
+  const { message, html } = await resp.json();
+
+  if (!isShown(message.id)) {
+    $messages.insertAdjacentHTML("beforeend", html);
+  }
+
+  $compose.value = "";
+}
+
+$form.addEventListener("submit", sendMessage);
+
+/** Stream URL asking for messages after the last one rendered, which
+ * covers any sent between rendering the page and the stream opening. */
+function streamUrl() {
+  const url = new URL($messages.dataset.streamUrl, window.location.href);
+  url.searchParams.set("after", lastShownId());
+  return url;
+}
+
+const stream = new EventSource(streamUrl());
+
+stream.addEventListener("message", function (evt) {
+  appendMessage(JSON.parse(evt.data));
+  markRead();
+});
+
+document.addEventListener("visibilitychange", markRead);
+markRead();
@@ -0,0 +1,30 @@
+"use strict";
+
+/** Suggest message recipients as the user types a username. */
+
+const $recipient = document.getElementById("recipient");
+const $options = document.getElementById("recipient-options");
+
+const SEARCH_DELAY_MS = 200;
+let searchTimeout;
+
+/** Replace suggestions with users whose username starts with prefix. */
+async function suggestRecipients(prefix) {
+  const resp = await fetch(`/users/search?q=${encodeURIComponent(prefix)}`);
+  const { users } = await resp.json();
+
+  $options.replaceChildren(...users.map(function (user) {
+    const $option = document.createElement("option");
+    $option.value = user.username;
+    return $option;
+  }));
+}
+
+$recipient.addEventListener("input", function () {
+  clearTimeout(searchTimeout);
+
+  const prefix = $recipient.value.trim();
+  if (!prefix) return;
+
+  searchTimeout = setTimeout(suggestRecipients, SEARCH_DELAY_MS, prefix);
+});
@@ -0,0 +1,337 @@
+"""Live message delivery.
+
+New messages are announced with Postgres NOTIFY on MESSAGE_CHANNEL in the
+same transaction that inserts them, so listeners only hear about committed
+messages. Each worker process runs one listener thread per app that
+LISTENs on the channel and fans messages out to the conversation streams
+open in that worker. This works across any number of worker processes
+without them knowing about each other. Other databases have no NOTIFY, so streams only
+receive messages on PostgreSQL.
+
+NOTIFYs sent while the listener is reconnecting are lost, so once it is
+listening again it ends every open stream. Clients reconnect with their
+Last-Event-ID and are sent what they missed.
+
+LISTEN needs a session of its own, which PgBouncer in transaction pooling
+mode can't give; set LISTEN_DATABASE_URL to listen on another connection.
+"""
+
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
+
+from dialects import POSTGRESQL, notify
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_CHANNEL = 'new_message'
+DEFAULT_MAX_STREAMS = 100
+KEEPALIVE_SECONDS = 15
+RECONNECT_SECONDS = 1
+LISTENER_STARTUP_SECONDS = 5
+CLIENT_RETRY_MILLISECONDS = 3000
+
+# put on a stream's queue to end it
+END_OF_STREAM = None
+
+
+class StreamLimitReached(Exception):
+    """Raised when a worker already has its maximum number of open streams."""
+
+
+class MessageBroker:
+    """Flask extension giving each app a MessageHub."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Make app's hub from its stream settings."""
+
+        app.extensions['message_broker'] = MessageHub(
+            app.config.get('MAX_MESSAGE_STREAMS', DEFAULT_MAX_STREAMS),
+            app.config.get('LISTEN_DATABASE_URL')
+        )
+
+    @property
+    def current(self):
+        """The current app's MessageHub."""
+
+        return current_app.extensions['message_broker']
+
+
+class MessageHub:
+    """Per-worker fan-out of new messages to open conversation streams.
+
+    The listener thread is only started when the first stream subscribes,
+    so workers that never serve a stream never hold a LISTEN connection.
+    """
+
+    def __init__(self, max_streams=DEFAULT_MAX_STREAMS, listen_url=None):
+        self.max_streams = max_streams
+        self.listen_url = listen_url
+        self._engine = None
+        self._subscribers = {}
+        self._num_streams = 0
+        self._lock = threading.Lock()
+        self._listener = None
+        self._listening = threading.Event()
+        self._pid = None
+
+    def subscribe(self, conversation_id, engine):
+        """Register a new stream for a conversation and return its queue.
+
+        Raises StreamLimitReached if this worker is at its stream cap, and
+        ValueError unless engine is PostgreSQL, the only database with
+        LISTEN.
+        """
+
+        if engine.dialect.name != POSTGRESQL:
+            raise ValueError(f'Cannot listen on {engine.dialect.name}.')
+
+        with self._lock:
+            if self._num_streams >= self.max_streams:
+                raise StreamLimitReached()
+
+            self._ensure_listener(engine)
+
+            subscriber = queue.SimpleQueue()
+            self._subscribers.setdefault(conversation_id, set()).add(subscriber)
+            self._num_streams += 1
+
+        # wait for LISTEN to be in place, so the stream doesn't miss messages
+        # sent right after it opens; outside the lock, which publishing and
+        # other streams need meanwhile
+        self._listening.wait(LISTENER_STARTUP_SECONDS)
+
+        return subscriber
+
+    def unsubscribe(self, conversation_id, subscriber):
+        """Remove a stream's queue."""
+
+        with self._lock:
+            subscribers = self._subscribers.get(conversation_id)
+
+            if subscribers is None or subscriber not in subscribers:
+                return
+
+            subscribers.discard(subscriber)
+            self._num_streams -= 1
+
+            if not subscribers:
+                del self._subscribers[conversation_id]
+
+    @property
+    def num_streams(self):
+        """Number of streams open in this worker."""
+
+        return self._num_streams
+
+    def has_subscribers(self, conversation_id):
+        """Checks if any stream in this worker is open for conversation."""
+
+        return conversation_id in self._subscribers
+
+    def publish(self, message):
+        """Hand message (dict with conversation_id) to every subscribed stream."""
+
+        with self._lock:
+            subscribers = list(self._subscribers.get(message['conversation_id'], ()))
+
+        for subscriber in subscribers:
+            subscriber.put(message)
+
+    def _ensure_listener(self, engine):
+        """Start the listener thread if it isn't running in this process.
+
+        Threads don't survive fork, so a listener started in a parent process
+        is replaced in the child. Called holding _lock; doesn't wait for the
+        thread to LISTEN.
+        """
+
+        if (self._listener is not None
+                and self._listener.is_alive()
+                and self._pid == os.getpid()):
+            return
+
+        if self.listen_url:
+            # only ever one connection, held open by the listener
+            engine = create_engine(self.listen_url, poolclass=NullPool)
+
+        self._engine = engine
+        self._pid = os.getpid()
+        self._listener = threading.Thread(
+            target=self._listen,
+            name='message-listener',
+            daemon=True
+        )
+        self._listening.clear()
+        self._listener.start()
+
+    def _connect(self):
+        """Open a dedicated autocommit connection outside the pool."""
+
+        connection = self._engine.raw_connection()
+        dbapi_connection = connection.driver_connection
+        connection.detach()
+
+        dbapi_connection.autocommit = True
+
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f'LISTEN {MESSAGE_CHANNEL}')
+        cursor.close()
+
+        return dbapi_connection
+
+    def _listen(self):
+        """Listener thread: wait for NOTIFY and dispatch to subscribers."""
+
+        reconnecting = False
+
+        while True:
+            try:
+                connection = self._connect()
+                self._listening.set()
+
+                if reconnecting:
+                    self._end_streams()
+
+                reconnecting = True
+            except Exception:
+                logger.exception('Could not open message listener connection.')
+                time.sleep(RECONNECT_SECONDS)
+                continue
+
+            try:
+                while True:
+                    if select.select([connection], [], [], KEEPALIVE_SECONDS) == ([], [], []):
+                        continue
+
+                    connection.poll()
+
+                    while connection.notifies:
+                        notify = connection.notifies.pop(0)
+                        self._dispatch(connection, json.loads(notify.payload))
+
+            except Exception:
+                logger.exception('Message listener connection lost.')
+                self._listening.clear()
+                time.sleep(RECONNECT_SECONDS)
+
+            finally:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+
+    def _end_streams(self):
+        """End every open stream, so its client reconnects and catches up."""
+
+        with self._lock:
+            subscribers = [
+                subscriber
+                for subscribers in self._subscribers.values()
+                for subscriber in subscribers
+            ]
+
+        for subscriber in subscribers:
+            subscriber.put(END_OF_STREAM)
+
+    def _dispatch(self, connection, payload):
+        """Load a notified message once and publish it to local streams.
+
+        Notify payloads only carry ids (NOTIFY payloads are capped at 8000
+        bytes), so the message body is read here, and only if a stream in
+        this worker wants it.
+        """
+
+        if not self.has_subscribers(payload['conversation_id']):
+            return
+
+        cursor = connection.cursor()
+        cursor.execute(
+            'SELECT id, conversation_id, user_id, text FROM messages WHERE id = %s',
+            (payload['id'],)
+        )
+        row = cursor.fetchone()
+        cursor.close()
+
+        if row:
+            self.publish({
+                'id': row[0],
+                'conversation_id': row[1],
+                'user_id': row[2],
+                'text': row[3],
+            })
+
+
+broker = MessageBroker()
+
+
+def notify_new_message(session, message):
+    """Queue a NOTIFY for message in session's transaction.
+
+    Postgres delivers the notification when the transaction commits, and drops
+    it if it rolls back. The message must already be flushed so it has an id.
+    """
+
+    notify(session, MESSAGE_CHANNEL, {
+        'id': message.id,
+        'conversation_id': message.conversation_id,
+    })
+
+
+def format_event(message):
+    """Format message as a server-sent event."""
+
+    data = json.dumps({
+        'id': message['id'],
+        'user_id': message['user_id'],
+        'text': message['text'],
+    })
+
+    return f"id: {message['id']}\nevent: message\ndata: {data}\n\n"
+
+
+def stream_messages(hub, conversation_id, subscriber, backlog=()):
+    """Generator of server-sent events for a subscribed conversation stream.
+
+    Yields any backlog first (messages missed since the client's
+    Last-Event-ID), then messages as they arrive, with periodic comments to
+    keep the connection open, until END_OF_STREAM. Unsubscribes from hub
+    when the stream ends or the client disconnects.
+
+    Without a subscriber, the stream ends after the backlog, and the client
+    reconnects after CLIENT_RETRY_MILLISECONDS.
+    """
+
+    try:
+        yield f'retry: {CLIENT_RETRY_MILLISECONDS}\n\n'
+
+        for message in backlog:
+            yield format_event(message)
+
+        while subscriber is not None:
+            try:
+                message = subscriber.get(timeout=KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+
+            if message is END_OF_STREAM:
+                break
+
+            yield format_event(message)
+
+    finally:
+        if subscriber is not None:
+            hub.unsubscribe(conversation_id, subscriber)
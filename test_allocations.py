@@ -0,0 +1,90 @@
+"""Allocation tracking tests."""
+
+import os
+import shutil
+import tempfile
+
+from models import db, User
+from testing import create_test_app, TransactionalTestCase
+from app import CURR_USER_KEY
+from allocations import allocation_tracker
+
+app = create_test_app()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class AllocationTrackerTestCase(TransactionalTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup('u1', 'u1@email.com', None, 'password')
+        u2 = User.signup('u2', 'u2@email.com', None, 'password')
+        u1.is_admin = True
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        self.directory = tempfile.mkdtemp()
+        settings = app.extensions['allocation_tracker']
+        settings.directory = self.directory
+        settings.snapshot_every = 1
+        allocation_tracker.enable()
+
+    def tearDown(self):
+        allocation_tracker.disable()
+        shutil.rmtree(self.directory)
+        db.session.rollback()
+
+    def test_memory_report(self):
+        """Test peaks and top sites recorded per endpoint."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            client.get(f'/users/{self.u1_id}')
+            client.get(f'/users/{self.u1_id}')
+
+            resp = client.get('/admin/memory')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.json['tracing'])
+
+        user_page = resp.json['endpoints']['views.user_page']
+
+        self.assertEqual(user_page['requests'], 2)
+        self.assertEqual(user_page['snapshots'], 2)
+        self.assertGreater(user_page['max_peak_bytes'], 0)
+        self.assertTrue(all(
+            site['size_bytes'] > 0 and ':' in site['site']
+            for site in user_page['top_sites']
+        ))
+
+    def test_dump(self):
+        """Test report and snapshot written to dump files."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.post('/admin/memory/dump')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            sorted([resp.json['report'], resp.json['snapshot']])
+        )
+
+    def test_not_admin(self):
+        """Test non-admin can't see report."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u2_id
+
+            resp = client.get('/admin/memory')
+
+        self.assertEqual(resp.status_code, 403)
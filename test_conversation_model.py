@@ -0,0 +1,139 @@
+"""Conversation model tests."""
+
+from unittest.mock import patch
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, User, Conversation, Participant
+from testing import create_test_app, TransactionalTestCase
+from app import create_app
+
+create_test_app()
+
+class ConversationModelTestCase(TransactionalTestCase):
+    def setUp(self):
+        super().setUp()
+
+        Participant.clear_cache()
+
+        u1 = User.signup('u1', 'u1@email.com', None, 'password')
+        u2 = User.signup('u2', 'u2@email.com', None, 'password')
+
+        c1 = Conversation()
+
+        db.session.add_all([u1, u2, c1])
+        db.session.commit()
+
+        db.session.add(Participant(user_id=u1.id, conversation_id=c1.id))
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.c1_id = c1.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    # #################### Participant tests
+
+    def test_duplicate_participant(self):
+        """Test same user can't be added to a conversation twice."""
+
+        with self.assertRaises(IntegrityError):
+            db.session.add(
+                Participant(user_id=self.u1_id, conversation_id=self.c1_id))
+            db.session.commit()
+
+    def test_is_participant(self):
+        """Test Participant class method, is_participant."""
+
+        self.assertTrue(Participant.is_participant(self.u1_id, self.c1_id))
+        self.assertFalse(Participant.is_participant(self.u2_id, self.c1_id))
+
+    def test_is_participant_cached(self):
+        """Test membership served from cache once known."""
+
+        self.assertTrue(Participant.is_participant(self.u1_id, self.c1_id))
+
+        # bypass ORM events, so only the cache can answer
+        Participant.query.filter(
+            Participant.user_id == self.u1_id
+        ).delete()
+        db.session.commit()
+
+        self.assertTrue(Participant.is_participant(self.u1_id, self.c1_id))
+
+        Participant.uncache(self.u1_id, self.c1_id)
+
+        self.assertFalse(Participant.is_participant(self.u1_id, self.c1_id))
+
+    def test_is_participant_cache_per_app(self):
+        """Test memberships cached for one app aren't trusted by another."""
+
+        self.assertTrue(Participant.is_participant(self.u1_id, self.c1_id))
+
+        # bypass ORM events, so only the cache can answer
+        Participant.query.filter(
+            Participant.user_id == self.u1_id
+        ).delete()
+        db.session.commit()
+
+        other_app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+
+        with other_app.app_context():
+            self.assertFalse(Participant.is_participant(self.u1_id, self.c1_id))
+
+        self.assertTrue(Participant.is_participant(self.u1_id, self.c1_id))
+
+    def test_is_participant_cache_expires(self):
+        """Test cached membership checked again once it expires."""
+
+        with patch('models.PARTICIPANT_CACHE_SECONDS', 0):
+            self.assertTrue(Participant.is_participant(self.u1_id, self.c1_id))
+
+        # deleting the conversation cascades in the database, unseen by the
+        # ORM
+        Conversation.query.filter(Conversation.id == self.c1_id).delete()
+        db.session.commit()
+
+        self.assertFalse(Participant.is_participant(self.u1_id, self.c1_id))
+
+    def test_is_participant_after_move(self):
+        """Test participant moved to another user uncached for the old one."""
+
+        self.assertTrue(Participant.is_participant(self.u1_id, self.c1_id))
+
+        participant = Participant.query.filter_by(user_id=self.u1_id).one()
+        participant.user_id = self.u2_id
+        db.session.commit()
+
+        self.assertFalse(Participant.is_participant(self.u1_id, self.c1_id))
+        self.assertTrue(Participant.is_participant(self.u2_id, self.c1_id))
+
+    def test_is_participant_after_add(self):
+        """Test user added to conversation is a participant right away."""
+
+        self.assertFalse(Participant.is_participant(self.u2_id, self.c1_id))
+
+        db.session.add(Participant(user_id=self.u2_id, conversation_id=self.c1_id))
+        db.session.commit()
+
+        self.assertTrue(Participant.is_participant(self.u2_id, self.c1_id))
+
+    # #################### Direct conversation tests
+
+    def test_get_or_create_direct(self):
+        """Test Conversation class method, get_or_create_direct."""
+
+        conversation = Conversation.get_or_create_direct(self.u2_id, self.u1_id)
+        db.session.commit()
+
+        self.assertNotEqual(conversation.id, self.c1_id)
+        self.assertEqual(conversation.user_low_id, min(self.u1_id, self.u2_id))
+        self.assertEqual(conversation.user_high_id, max(self.u1_id, self.u2_id))
+        self.assertTrue(Participant.is_participant(self.u1_id, conversation.id))
+        self.assertTrue(Participant.is_participant(self.u2_id, conversation.id))
+
+        same = Conversation.get_or_create_direct(self.u1_id, self.u2_id)
+
+        self.assertEqual(same.id, conversation.id)
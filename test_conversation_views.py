@@ -0,0 +1,627 @@
+"""Conversation View tests."""
+
+import threading
+from itertools import islice
+from unittest import mock, skipIf
+
+from sqlalchemy import text
+
+from models import db, User, Conversation, Participant, Message, Notification
+from testing import (
+    create_test_app, TransactionalTestCase, query_budget,
+    postgres_only, on_postgresql)
+from app import CURR_USER_KEY, NAV_COUNTS_KEY
+from streams import broker
+
+app = create_test_app()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# most statements each route may send while handling one request
+QUERY_BUDGETS = {
+    'views.show_converation': 10,
+    'views.new_conversation': 11,
+    'views.search_users': 2,
+    'views.api_send_message': 6,
+    'views.api_mark_read': 3,
+}
+
+
+class ConversationBaseViewTestCase(TransactionalTestCase):
+    def setUp(self):
+        super().setUp()
+
+        Participant.clear_cache()
+
+        u1 = User.signup('u1', 'u1@email.com', None, 'password')
+        u2 = User.signup('u2', 'u2@email.com', None, 'password')
+        u3 = User.signup('u3', 'u3@email.com', None, 'password')
+
+        c1 = Conversation()
+        u1.conversations.append(c1)
+        u2.conversations.append(c1)
+
+        db.session.add_all([u1, u2, u3, c1])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.u3_id = u3.id
+        self.c1_id = c1.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+
+class ShowConversationTestCase(ConversationBaseViewTestCase):
+    @query_budget(QUERY_BUDGETS)
+    def test_show_conversation(self):
+        """Test viewing conversation user is a participant in."""
+
+        db.session.add(Message(
+            user_id=self.u2_id,
+            conversation_id=self.c1_id,
+            text='hello u1'
+        ))
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get(f'/conversations/{self.c1_id}')
+
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('hello u1', html)
+            self.assertIn(f'/conversations/{self.c1_id}/stream', html)
+
+    def test_unauthorized_show_conversation(self):
+        """Test viewing conversation user is not a participant in."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u3_id
+
+            resp = client.get(
+                f'/conversations/{self.c1_id}',
+                follow_redirects=True
+            )
+
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Unauthorized', html)
+
+
+class UnreadMessagesTestCase(ConversationBaseViewTestCase):
+    def test_unread_counts(self):
+        """Test only others' messages after last read count as unread."""
+
+        db.session.add_all([
+            Message(user_id=self.u2_id, conversation_id=self.c1_id, text='one'),
+            Message(user_id=self.u2_id, conversation_id=self.c1_id, text='two'),
+            Message(user_id=self.u1_id, conversation_id=self.c1_id, text='mine'),
+        ])
+        db.session.commit()
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        [conversation] = u1.get_conversations()
+        self.assertEqual(conversation.conversation_id, self.c1_id)
+        self.assertEqual(conversation.usernames, ['u2'])
+        self.assertEqual(conversation.unread, 2)
+        self.assertEqual(u1.count_unread_messages(), 2)
+        self.assertEqual(u2.count_unread_messages(), 1)
+
+    def test_show_conversation_read_only(self):
+        """Test viewing conversation leaves marking it read to the page."""
+
+        db.session.add(Message(
+            user_id=self.u2_id,
+            conversation_id=self.c1_id,
+            text='unread'
+        ))
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get(f'/conversations/{self.c1_id}')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f'data-read-url="/api/conversations/{self.c1_id}/read"', html)
+
+        u1 = User.query.get(self.u1_id)
+
+        self.assertEqual(u1.count_unread_messages(), 1)
+
+    @query_budget(QUERY_BUDGETS)
+    def test_mark_read(self):
+        """Test posting last message shown marks conversation read."""
+
+        message = Message(
+            user_id=self.u2_id,
+            conversation_id=self.c1_id,
+            text='unread'
+        )
+        db.session.add(message)
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.post(
+                f'/api/conversations/{self.c1_id}/read',
+                data={'message_id': message.id}
+            )
+
+            self.assertEqual(resp.status_code, 204)
+
+            resp = client.post(f'/api/conversations/{self.c1_id}/read')
+
+            self.assertEqual(resp.status_code, 400)
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        self.assertEqual(u1.count_unread_messages(), 0)
+        self.assertEqual(u1.get_conversations()[0].unread, 0)
+        self.assertEqual(u2.count_unread_messages(), 0)
+
+    def test_navbar_counts_cached(self):
+        """Test navbar counts kept in session until expired or read."""
+
+        def add_message():
+            db.session.add(Message(
+                user_id=self.u2_id, conversation_id=self.c1_id, text='unread'))
+            db.session.commit()
+
+        def nav_counts(client):
+            with client.session_transaction() as session:
+                return session[NAV_COUNTS_KEY][:2]
+
+        add_message()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            client.get('/conversations')
+            self.assertEqual(nav_counts(client), [0, 1])
+
+            add_message()
+
+            client.get('/conversations')
+            self.assertEqual(nav_counts(client), [0, 1])
+
+            with client.session_transaction() as session:
+                session[NAV_COUNTS_KEY] = session[NAV_COUNTS_KEY][:2] + [0]
+
+            client.get('/conversations')
+            self.assertEqual(nav_counts(client), [0, 2])
+
+            last_id = db.session.query(db.func.max(Message.id)).scalar()
+            client.post(f'/api/conversations/{self.c1_id}/read',
+                        data={'message_id': last_id})
+
+            client.get('/conversations')
+            self.assertEqual(nav_counts(client), [0, 0])
+
+    def test_mark_read_never_moves_back(self):
+        """Test marking an older message read keeps the newer marker."""
+
+        Participant.mark_read(self.u1_id, self.c1_id, 10)
+        Participant.mark_read(self.u1_id, self.c1_id, 5)
+        db.session.commit()
+
+        participant = Participant.query.filter(
+            Participant.user_id == self.u1_id,
+            Participant.conversation_id == self.c1_id
+        ).one()
+
+        self.assertEqual(participant.last_read_message_id, 10)
+
+
+@postgres_only
+class StreamConversationTestCase(ConversationBaseViewTestCase):
+    # streams listen for notifications on their own connection, which only
+    # sees committed messages
+    transactional = False
+
+    def test_stream_new_message(self):
+        """Test message sent by another user arrives on open stream."""
+
+        with app.test_client() as client, app.test_client() as other_client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            with other_client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u2_id
+
+            resp = client.get(f'/conversations/{self.c1_id}/stream')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+
+            events = iter(resp.response)
+            self.assertIn(b'retry:', next(events))
+
+            other_client.post(
+                f'/conversations/{self.c1_id}/new_message',
+                data={'message': 'streamed hello'}
+            )
+
+            event = next(events)
+            while event.startswith(b':'):
+                event = next(events)
+
+            self.assertIn(b'event: message', event)
+            self.assertIn(b'streamed hello', event)
+
+            resp.close()
+
+            self.assertFalse(broker.current.has_subscribers(self.c1_id))
+
+    def test_stream_ends_after_listener_reconnects(self):
+        """Test streams end when LISTEN reconnects, to catch up on what
+        was sent meanwhile."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get(f'/conversations/{self.c1_id}/stream')
+
+            events = iter(resp.response)
+            self.assertIn(b'retry:', next(events))
+
+            db.session.execute(text(
+                "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+                "WHERE datname = current_database() AND query LIKE 'LISTEN %'"
+            ))
+            db.session.commit()
+
+            # ended within a few keepalives, rather than kept open
+            with mock.patch('streams.KEEPALIVE_SECONDS', 0.5):
+                rest = list(islice(events, 10))
+
+            self.assertLess(len(rest), 10)
+            self.assertTrue(all(event.startswith(b':') for event in rest))
+
+            resp.close()
+
+        self.assertFalse(broker.current.has_subscribers(self.c1_id))
+
+    def test_stream_backlog(self):
+        """Test reconnecting stream sends messages after Last-Event-ID."""
+
+        m1 = Message(user_id=self.u2_id, conversation_id=self.c1_id, text='seen')
+        db.session.add(m1)
+        db.session.commit()
+
+        m2 = Message(user_id=self.u2_id, conversation_id=self.c1_id, text='missed')
+        db.session.add(m2)
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get(
+                f'/conversations/{self.c1_id}/stream',
+                headers={'Last-Event-ID': str(m1.id)}
+            )
+
+            events = iter(resp.response)
+            next(events)
+            event = next(events)
+
+            self.assertIn(f'id: {m2.id}'.encode(), event)
+            self.assertIn(b'missed', event)
+
+            resp.close()
+
+    def test_stream_after(self):
+        """Test first connection sends messages after the ?after= id."""
+
+        m1 = Message(user_id=self.u2_id, conversation_id=self.c1_id, text='seen')
+        db.session.add(m1)
+        db.session.commit()
+
+        m2 = Message(user_id=self.u2_id, conversation_id=self.c1_id, text='missed')
+        db.session.add(m2)
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get(
+                f'/conversations/{self.c1_id}/stream?after={m1.id}')
+
+            events = iter(resp.response)
+            next(events)
+            event = next(events)
+
+            self.assertIn(f'id: {m2.id}'.encode(), event)
+            self.assertNotIn(b'seen', event)
+
+            resp.close()
+
+    def test_unauthorized_stream(self):
+        """Test streaming conversation user is not a participant in."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u3_id
+
+            resp = client.get(f'/conversations/{self.c1_id}/stream')
+
+            self.assertEqual(resp.status_code, 403)
+
+    def test_subscribe_waits_outside_lock(self):
+        """Test streams and publishing not blocked while LISTEN starts."""
+
+        hub = broker.current
+        # the thread below has no app context to find it in
+        engine = db.engine
+
+        # starts the listener
+        subscribed = [hub.subscribe(self.c1_id, engine)]
+
+        waiting = threading.Event()
+        listening = threading.Event()
+
+        def wait(timeout):
+            waiting.set()
+            return listening.wait(timeout)
+
+        # as if the listener had just been started and not yet listening
+        with mock.patch.object(hub, '_listening', mock.Mock(wait=wait)):
+            thread = threading.Thread(
+                target=lambda: subscribed.append(hub.subscribe(self.c1_id, engine)))
+            thread.start()
+
+            try:
+                self.assertTrue(waiting.wait(1))
+                self.assertTrue(hub._lock.acquire(timeout=1))
+                hub._lock.release()
+            finally:
+                listening.set()
+                thread.join()
+
+        for subscriber in subscribed:
+            hub.unsubscribe(self.c1_id, subscriber)
+
+    def test_stream_limit(self):
+        """Test streams refused once worker is at its stream cap."""
+
+        hub = broker.current
+        max_streams = hub.max_streams
+        hub.max_streams = 0
+
+        try:
+            with app.test_client() as client:
+                with client.session_transaction() as session:
+                    session[CURR_USER_KEY] = self.u1_id
+
+                resp = client.get(f'/conversations/{self.c1_id}/stream')
+
+                self.assertEqual(resp.status_code, 503)
+                self.assertIn('Retry-After', resp.headers)
+
+        finally:
+            hub.max_streams = max_streams
+
+
+@skipIf(on_postgresql(), 'streams stay open on PostgreSQL')
+class PollingStreamTestCase(ConversationBaseViewTestCase):
+    # a listener would take connections from the app's own pool, and on
+    # in-memory SQLite closing one loses the database
+    transactional = False
+
+    def test_stream_backlog_then_close(self):
+        """Test stream without LISTEN sends missed messages and closes."""
+
+        m1 = Message(user_id=self.u2_id, conversation_id=self.c1_id, text='seen')
+        db.session.add(m1)
+        db.session.commit()
+
+        m2 = Message(user_id=self.u2_id, conversation_id=self.c1_id, text='missed')
+        db.session.add(m2)
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get(
+                f'/conversations/{self.c1_id}/stream',
+                headers={'Last-Event-ID': str(m1.id)}
+            )
+
+            body = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('retry:', body)
+        self.assertIn(f'id: {m2.id}', body)
+        self.assertNotIn('seen', body)
+        self.assertEqual(broker.current.num_streams, 0)
+
+        # the database is still there
+        self.assertEqual(User.query.count(), 3)
+
+
+class NewConversationTestCase(ConversationBaseViewTestCase):
+    @query_budget(QUERY_BUDGETS)
+    def test_new_conversation(self):
+        """Test starting conversation with a user."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.post(
+                '/conversations/new',
+                data={'recipient': 'u3', 'message': 'hi u3'},
+                follow_redirects=True
+            )
+
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('hi u3', html)
+
+        conversation = Conversation.query.filter(
+            Conversation.user_low_id == min(self.u1_id, self.u3_id),
+            Conversation.user_high_id == max(self.u1_id, self.u3_id)
+        ).one()
+
+        self.assertEqual(
+            Participant.query.filter(
+                Participant.conversation_id == conversation.id
+            ).count(),
+            2
+        )
+
+    def test_new_conversation_reuses_existing(self):
+        """Test messaging same user twice uses one conversation."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            first = client.post(
+                '/conversations/new',
+                data={'recipient': 'u3', 'message': 'first'}
+            )
+
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u3_id
+
+            second = client.post(
+                '/conversations/new',
+                data={'recipient': 'u1', 'message': 'second'}
+            )
+
+            self.assertEqual(first.location, second.location)
+
+        self.assertEqual(Conversation.query.count(), 2)
+
+    def test_new_conversation_unknown_recipient(self):
+        """Test starting conversation with nonexistent user."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.post(
+                '/conversations/new',
+                data={'recipient': 'nobody', 'message': 'hello?'}
+            )
+
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('User not found', html)
+            self.assertEqual(Message.query.count(), 0)
+
+
+class SearchUsersTestCase(ConversationBaseViewTestCase):
+    @query_budget(QUERY_BUDGETS)
+    def test_search_users(self):
+        """Test recipient search by username prefix, excluding self."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get('/users/search?q=U')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                [u['username'] for u in resp.json['users']],
+                ['u2', 'u3']
+            )
+
+    def test_search_users_escapes_wildcards(self):
+        """Test LIKE wildcards in query are matched literally."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get('/users/search?q=%25')
+
+            self.assertEqual(resp.json['users'], [])
+
+
+class ApiSendMessageTestCase(ConversationBaseViewTestCase):
+    @query_budget(QUERY_BUDGETS)
+    def test_api_send_message(self):
+        """Test sending message returns it as JSON with rendered HTML."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.post(
+                f'/api/conversations/{self.c1_id}/messages',
+                data={'message': 'quick reply'}
+            )
+
+            self.assertEqual(resp.status_code, 201)
+            self.assertEqual(resp.json['message']['text'], 'quick reply')
+            self.assertEqual(resp.json['message']['user_id'], self.u1_id)
+            self.assertIn('quick reply', resp.json['html'])
+            self.assertIn(
+                f'data-message-id="{resp.json["message"]["id"]}"',
+                resp.json['html']
+            )
+
+        message = Message.query.one()
+        self.assertEqual(message.text, 'quick reply')
+        self.assertEqual(message.conversation_id, self.c1_id)
+
+        [event], _ = Notification.get_page(self.u2_id)
+        self.assertEqual(event.kind, Notification.NEW_MESSAGE)
+        self.assertEqual(event.actor_id, self.u1_id)
+        self.assertEqual(event.conversation_id, self.c1_id)
+        self.assertEqual(Notification.get_page(self.u1_id), ([], None))
+
+    def test_api_send_invalid_message(self):
+        """Test sending empty message returns form errors."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.post(
+                f'/api/conversations/{self.c1_id}/messages',
+                data={'message': ''}
+            )
+
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn('message', resp.json['errors'])
+            self.assertEqual(Message.query.count(), 0)
+
+    def test_unauthorized_api_send_message(self):
+        """Test sending message to conversation user isn't in."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u3_id
+
+            resp = client.post(
+                f'/api/conversations/{self.c1_id}/messages',
+                data={'message': 'let me in'}
+            )
+
+            self.assertEqual(resp.status_code, 403)
+            self.assertEqual(Message.query.count(), 0)
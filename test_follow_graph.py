@@ -0,0 +1,237 @@
+"""Follow graph tests."""
+
+from collections import Counter
+from unittest import TestCase, mock
+
+from models import db, User, Follow, Request
+from testing import create_test_app, TransactionalTestCase
+from follow_graph import FollowGraph, follow_graphs
+
+create_test_app()
+
+# 1 -> 2 means user 1 follows user 2
+EDGES = [
+    (1, 2), (1, 3),
+    (2, 1), (2, 3), (2, 4),
+    (3, 4), (3, 5),
+    (4, 5),
+    (5, 1),
+]
+
+
+class FollowGraphTestCase(TestCase):
+    def setUp(self):
+        self.graph = FollowGraph.from_edges(EDGES)
+
+    def test_following_and_followers(self):
+        """Test neighbours in both directions."""
+
+        self.assertEqual(self.graph.following(2), [1, 3, 4])
+        self.assertEqual(self.graph.followers(5), [3, 4])
+        self.assertEqual(self.graph.following(6), [])
+        self.assertEqual(self.graph.followers(6), [])
+
+    def test_degrees(self):
+        """Test follower and following counts."""
+
+        self.assertEqual(self.graph.num_following(2), 3)
+        self.assertEqual(self.graph.num_followers(1), 2)
+        self.assertEqual(self.graph.num_followers(6), 0)
+
+    def test_is_following(self):
+        """Test edge lookup."""
+
+        self.assertTrue(self.graph.is_following(1, 2))
+        self.assertFalse(self.graph.is_following(4, 3))
+
+    def test_mutual_followers(self):
+        """Test users following both users."""
+
+        self.assertEqual(self.graph.mutual_followers(3, 4), [2])
+        self.assertEqual(self.graph.mutual_followers(1, 5), [])
+
+    def test_followed_by_following(self):
+        """Test users one user follows who follow another."""
+
+        self.assertEqual(self.graph.followed_by_following(1, 4), [2, 3])
+        self.assertEqual(self.graph.followed_by_following(4, 1), [5])
+
+    def test_suggestions(self):
+        """Test friends of friends, ranked by number of paths."""
+
+        # 1 follows 2 and 3; they follow 4 (twice), 5 and 1
+        self.assertEqual(self.graph.suggestions(1), [(4, 2), (5, 1)])
+        self.assertEqual(self.graph.suggestions(1, limit=1), [(4, 2)])
+
+    def test_suggestions_counted_outside_lock(self):
+        """Test suggestions don't block updates while counting."""
+
+        graph = self.graph
+        graph.add(2, 5)
+        locked = []
+
+        class CheckedCounter(Counter):
+            def update(self, *args, **kwargs):
+                locked.append(graph._lock.locked())
+                super().update(*args, **kwargs)
+
+        with mock.patch('follow_graph.Counter', CheckedCounter):
+            self.assertEqual(graph.suggestions(1), [(4, 2), (5, 2)])
+
+        self.assertTrue(locked)
+        self.assertFalse(any(locked))
+
+    def test_add_and_remove(self):
+        """Test changes on top of built graph."""
+
+        self.graph.add(4, 3)
+        self.graph.add(6, 1)
+        self.graph.remove(1, 2)
+        self.graph.remove(1, 2)
+
+        self.assertEqual(self.graph.following(4), [3, 5])
+        self.assertEqual(self.graph.followers(1), [2, 5, 6])
+        self.assertEqual(self.graph.num_followers(2), 0)
+        self.assertEqual(self.graph.num_following(1), 1)
+        self.assertFalse(self.graph.is_following(1, 2))
+
+        self.graph.add(1, 2)
+        self.graph.remove(6, 1)
+
+        self.assertEqual(self.graph.following(1), [2, 3])
+        self.assertEqual(self.graph.num_followers(1), 2)
+
+
+class FollowGraphEventsTestCase(TransactionalTestCase):
+    # the graph is built on its own connection, which only sees committed
+    # follows
+    transactional = False
+
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup('u1', 'u1@email.com', None, 'password')
+        u2 = User.signup('u2', 'u2@email.com', None, 'password')
+        u3 = User.signup('u3', 'u3@email.com', None, 'password')
+
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.u3_id = u3.id
+
+        db.session.add(Follow(
+            user_being_followed_id=self.u2_id,
+            user_following_id=self.u1_id
+        ))
+        db.session.commit()
+
+        follow_graphs.current.invalidate()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_build(self):
+        """Test graph built from follows table."""
+
+        self.assertEqual(follow_graphs.current.following(self.u1_id), [self.u2_id])
+        self.assertEqual(follow_graphs.current.followers(self.u2_id), [self.u1_id])
+
+    def test_follow_committed(self):
+        """Test committed follows and unfollows update graph."""
+
+        follow_graphs.current.following(self.u1_id)
+
+        Follow.add(self.u3_id, self.u1_id)
+        Follow.remove(self.u2_id, self.u1_id)
+
+        self.assertEqual(follow_graphs.current.following(self.u1_id), [self.u2_id])
+
+        db.session.commit()
+
+        self.assertEqual(follow_graphs.current.following(self.u1_id), [self.u3_id])
+
+    def test_follow_rolled_back(self):
+        """Test rolled back follows don't reach graph."""
+
+        follow_graphs.current.following(self.u1_id)
+
+        Follow.add(self.u3_id, self.u1_id)
+        db.session.rollback()
+
+        self.assertEqual(follow_graphs.current.following(self.u1_id), [self.u2_id])
+
+    def test_user_deleted(self):
+        """Test deleted user's follows, removed by cascade, leave graph."""
+
+        follow_graphs.current.following(self.u1_id)
+
+        db.session.delete(User.query.get(self.u2_id))
+        db.session.commit()
+
+        self.assertEqual(follow_graphs.current.following(self.u1_id), [])
+        self.assertEqual(follow_graphs.current.num_followers(self.u2_id), 0)
+
+    def test_request_accepted(self):
+        """Test accepted follow requests update graph."""
+
+        follow_graphs.current.following(self.u1_id)
+
+        Request.add(self.u3_id, self.u1_id)
+        Request.add(self.u3_id, self.u2_id)
+        db.session.commit()
+
+        self.assertEqual(Request.accept(self.u3_id), 2)
+        db.session.commit()
+
+        self.assertEqual(
+            follow_graphs.current.followers(self.u3_id),
+            sorted([self.u1_id, self.u2_id])
+        )
+
+
+class FollowSQLTestCase(TransactionalTestCase):
+    """The SQL used while there's no graph answers as the graph does."""
+
+    def setUp(self):
+        super().setUp()
+
+        users = [
+            User.signup(f'u{i}', f'u{i}@email.com', None, 'password')
+            for i in range(1, 6)
+        ]
+        db.session.add_all(users)
+        db.session.commit()
+
+        self.ids = {i: user.id for i, user in enumerate(users, 1)}
+
+        for following, followed in EDGES:
+            Follow.add(self.ids[followed], self.ids[following])
+        db.session.commit()
+
+        self.graph = FollowGraph.from_edges(
+            (self.ids[following], self.ids[followed])
+            for following, followed in EDGES
+        )
+
+    def test_followed_by_following(self):
+        """Test users one user follows who follow another."""
+
+        for user_id in self.ids.values():
+            for other_user_id in self.ids.values():
+                self.assertEqual(
+                    Follow.followed_by_following(user_id, other_user_id),
+                    self.graph.followed_by_following(user_id, other_user_id)
+                )
+
+    def test_suggestions(self):
+        """Test friends of friends, ranked by number of paths."""
+
+        for user_id in self.ids.values():
+            self.assertEqual(
+                [tuple(row) for row in Follow.suggestions(user_id, 10)],
+                self.graph.suggestions(user_id, 10)
+            )
+
+        self.assertEqual(len(Follow.suggestions(self.ids[1], 1)), 1)
@@ -0,0 +1,181 @@
+"""Metrics tests."""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from models import db, User
+from testing import create_test_app, TransactionalTestCase
+from app import CURR_USER_KEY
+from metrics import metrics
+
+app = create_test_app()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['METRICS_TOKEN'] = 'secret'
+
+AUTHORIZATION = {'Authorization': 'Bearer secret'}
+
+# records a response and exits before it's due to flush
+WORKER = """
+import sys
+from sqlalchemy import create_engine
+from metrics import Registry
+
+registry = Registry(sys.argv[1], create_engine('sqlite://'))
+registry.enable()
+registry.inc('http_responses_total')
+"""
+
+
+class MetricsTestCase(TransactionalTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup('u1', 'u1@email.com', None, 'password')
+        db.session.add(u1)
+        db.session.commit()
+
+        self.u1_id = u1.id
+
+        self.registry = metrics.current
+        self.directory = self.registry.directory
+        self.registry.directory = tempfile.mkdtemp()
+        self.registry.clear()
+        self.registry.enable()
+
+    def tearDown(self):
+        self.registry.disable()
+        shutil.rmtree(self.registry.directory)
+        self.registry.directory = self.directory
+        db.session.rollback()
+
+    def test_request_metrics(self):
+        """Test latency histogram, status counts and pool stats exposed."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            client.get(f'/users/{self.u1_id}')
+            client.get(f'/users/{self.u1_id}')
+            client.get('/no/such/page')
+
+            resp = client.get('/metrics', headers=AUTHORIZATION)
+
+        text = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/plain')
+        self.assertIn('# TYPE http_request_duration_seconds histogram', text)
+        self.assertIn(
+            'http_request_duration_seconds_count{endpoint="views.user_page",method="GET"} 2',
+            text
+        )
+        self.assertIn(
+            'http_request_duration_seconds_bucket{endpoint="views.user_page",method="GET",le="+Inf"} 2',
+            text
+        )
+        self.assertIn('http_responses_total{endpoint="views.user_page",status="200"} 2', text)
+        self.assertIn('http_responses_total{endpoint="none",status="404"} 1', text)
+        self.assertIn('http_requests_in_flight 1', text)
+        self.assertIn('db_pool_checkouts_total ', text)
+
+        # SQLite's pools have no fixed size
+        if hasattr(db.engine.pool, 'size'):
+            self.assertIn('db_pool_size ', text)
+
+    def test_bcrypt_queue_depth(self):
+        """Test password hashing counted while in progress."""
+
+        with self.registry.in_progress('bcrypt_queue_depth'):
+            self.registry.flush()
+            _, _, gauges = self.registry.collect()
+
+            self.assertEqual(gauges[('bcrypt_queue_depth', ())], 1)
+
+        self.assertTrue(User.login('u1', 'password'))
+
+        self.registry.flush()
+        _, _, gauges = self.registry.collect()
+
+        self.assertEqual(gauges[('bcrypt_queue_depth', ())], 0)
+
+    def test_aggregates_workers(self):
+        """Test other workers' counters summed, and gauges only if running."""
+
+        exited = subprocess.Popen(['true'])
+        exited.wait()
+
+        with open(os.path.join(self.registry.run_directory, f'{exited.pid}-1.json'), 'w') as f:
+            json.dump({
+                'pid': exited.pid,
+                'counters': [['http_responses_total', [['endpoint', 'views.homepage'], ['status', '200']], 5]],
+                'histograms': [],
+                'gauges': [['http_requests_in_flight', [], 3]],
+            }, f)
+
+        with app.test_client() as client:
+            client.get('/')
+            resp = client.get('/metrics', headers=AUTHORIZATION)
+
+        text = resp.get_data(as_text=True)
+
+        self.assertIn('http_responses_total{endpoint="views.homepage",status="200"} 6', text)
+        self.assertIn('http_requests_in_flight 1', text)
+
+    def test_disabled(self):
+        """Test /metrics not found when disabled."""
+
+        self.registry.disable()
+
+        with app.test_client() as client:
+            resp = client.get('/metrics', headers=AUTHORIZATION)
+
+        self.assertEqual(resp.status_code, 404)
+
+    def test_token_required(self):
+        """Test /metrics refused without the token, and hidden without one set."""
+
+        with app.test_client() as client:
+            self.assertEqual(client.get('/metrics').status_code, 401)
+            self.assertEqual(client.get(
+                '/metrics', headers={'Authorization': 'Bearer wrong'}
+            ).status_code, 401)
+
+            app.config['METRICS_TOKEN'] = None
+
+            try:
+                resp = client.get('/metrics', headers=AUTHORIZATION)
+            finally:
+                app.config['METRICS_TOKEN'] = 'secret'
+
+        self.assertEqual(resp.status_code, 404)
+
+    def test_stopped_runs_removed(self):
+        """Test enabling removes files of runs whose processes have exited."""
+
+        exited = subprocess.Popen(['true'], process_group=0)
+        exited.wait()
+
+        stopped = os.path.join(self.registry.directory, str(exited.pid))
+        os.mkdir(stopped)
+
+        self.registry.disable()
+        self.registry.enable()
+
+        self.assertFalse(os.path.exists(stopped))
+        self.assertTrue(os.path.isdir(self.registry.run_directory))
+
+    def test_flush_at_exit(self):
+        """Test a worker's last interval written when it exits."""
+
+        subprocess.run([sys.executable, '-c', WORKER, self.registry.directory],
+                       check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        counters, _, _ = self.registry.collect()
+
+        self.assertEqual(counters[('http_responses_total', ())], 1)
@@ -0,0 +1,152 @@
+"""Connection pool tests."""
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine, text
+
+from models import db
+from testing import create_test_app, postgres_only, worker_database_url
+from pooling import engine_options, configure_pool, dispose_after_fork
+
+app = create_test_app()
+
+POSTGRESQL_URL = 'postgresql:///craft_app'
+
+
+class EngineOptionsTestCase(TestCase):
+    def test_pool_settings(self):
+        """Test pool settings passed to the engine."""
+
+        options = engine_options({
+            'SQLALCHEMY_DATABASE_URI': POSTGRESQL_URL,
+            'DB_POOL_SIZE': 20,
+            'DB_MAX_OVERFLOW': 0,
+            'DB_POOL_RECYCLE': 600,
+            'DB_POOL_PRE_PING': True,
+        })
+
+        self.assertEqual(options, {
+            'pool_size': 20,
+            'max_overflow': 0,
+            'pool_recycle': 600,
+            'pool_pre_ping': True,
+        })
+
+    def test_statement_timeout(self):
+        """Test statement timeout set per connection."""
+
+        options = engine_options({
+            'SQLALCHEMY_DATABASE_URI': POSTGRESQL_URL,
+            'DB_STATEMENT_TIMEOUT_MS': 2500,
+        })
+
+        self.assertEqual(
+            options['connect_args'],
+            {'options': '-c statement_timeout=2500'}
+        )
+
+    def test_pgbouncer_statement_timeout(self):
+        """Test no startup options sent to PgBouncer."""
+
+        options = engine_options({
+            'SQLALCHEMY_DATABASE_URI': POSTGRESQL_URL,
+            'DB_STATEMENT_TIMEOUT_MS': 2500,
+            'DB_PGBOUNCER': True,
+        })
+
+        self.assertNotIn('connect_args', options)
+
+    def test_sqlite(self):
+        """Test SQLite left with SQLAlchemy's own pool."""
+
+        self.assertEqual(
+            engine_options({'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+                            'DB_POOL_SIZE': 20}),
+            {}
+        )
+
+
+@postgres_only
+class PoolTestCase(TestCase):
+    # tests connections of engines of its own, and writes no rows
+    def setUp(self):
+        self.url = worker_database_url()
+
+    def make_engine(self, config):
+        engine = create_engine(self.url, **engine_options({
+            'SQLALCHEMY_DATABASE_URI': self.url,
+            **config
+        }))
+        configure_pool(engine, config)
+        self.addCleanup(engine.dispose)
+
+        return engine
+
+    def test_app_pool_size(self):
+        """Test app's engine built from its pool settings."""
+
+        self.assertEqual(db.engine.pool.size(), app.config['DB_POOL_SIZE'])
+
+    def test_statement_timeout(self):
+        """Test statement timeout in force on new connections."""
+
+        engine = self.make_engine({'DB_STATEMENT_TIMEOUT_MS': 1500})
+
+        with engine.connect() as connection:
+            timeout = connection.execute(text('SHOW statement_timeout')).scalar()
+
+        self.assertEqual(timeout, '1500ms')
+
+    def test_pgbouncer_statement_timeout(self):
+        """Test statement timeout set in every transaction, not the session."""
+
+        engine = self.make_engine(
+            {'DB_STATEMENT_TIMEOUT_MS': 1500, 'DB_PGBOUNCER': True})
+
+        with engine.connect() as connection:
+            timeout = connection.execute(text('SHOW statement_timeout')).scalar()
+            connection.rollback()
+
+            # outside SQLAlchemy's transactions, so without SET LOCAL
+            cursor = connection.connection.dbapi_connection.cursor()
+            cursor.execute('SHOW statement_timeout')
+            [after] = cursor.fetchone()
+            cursor.close()
+
+        self.assertEqual(timeout, '1500ms')
+        self.assertNotEqual(after, '1500ms')
+
+    def test_dispose_after_fork(self):
+        """Test forked child doesn't reuse the parent's pooled connections."""
+
+        engine = self.make_engine({})
+        dispose_after_fork([engine])
+
+        with engine.connect() as connection:
+            parent_backend = connection.execute(
+                text('SELECT pg_backend_pid()')).scalar()
+
+        pid = os.fork()
+
+        if pid == 0:
+            try:
+                with engine.connect() as connection:
+                    child_backend = connection.execute(
+                        text('SELECT pg_backend_pid()')).scalar()
+
+                os._exit(0 if child_backend != parent_backend else 1)
+
+            except BaseException:
+                os._exit(2)
+
+        _, status = os.waitpid(pid, 0)
+
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+
+        # the parent's connection is still open and usable
+        with engine.connect() as connection:
+            self.assertEqual(
+                connection.execute(text('SELECT pg_backend_pid()')).scalar(),
+                parent_backend
+            )
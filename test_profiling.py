@@ -0,0 +1,118 @@
+"""Request profiler tests."""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from models import db, User
+from testing import create_test_app, TransactionalTestCase
+from app import CURR_USER_KEY
+from profiling import Sampler, CATEGORIES
+
+app = create_test_app()
+
+
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+
+    while time.perf_counter() < end:
+        pass
+
+
+class SamplerTestCase(TestCase):
+    def test_samples_thread(self):
+        """Test sampled stacks show what the thread was running."""
+
+        thread = threading.Thread(target=busy_wait, args=(0.1,))
+        thread.start()
+
+        sampler = Sampler(thread.ident, 0.001)
+        sampler.start()
+        thread.join()
+        sampler.stop()
+
+        self.assertTrue(sampler.stacks)
+        self.assertTrue(all(
+            stack.endswith('test_profiling:busy_wait')
+            for stack in sampler.stacks
+        ))
+        self.assertEqual(set(sampler.categories), {'app'})
+
+
+class RequestProfilerTestCase(TransactionalTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup('u1', 'u1@email.com', None, 'password')
+        u2 = User.signup('u2', 'u2@email.com', None, 'password')
+        u1.is_admin = True
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        self.directory = tempfile.mkdtemp()
+        self.settings = app.extensions['profiler']
+        self.settings.directory = self.directory
+        self.settings.enabled = True
+
+    def tearDown(self):
+        self.settings.enabled = False
+        shutil.rmtree(self.directory)
+        db.session.rollback()
+
+    def test_profile_request(self):
+        """Test admin's request profiled and saved."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get(f'/users/{self.u1_id}?_profile=1')
+
+        self.assertEqual(resp.status_code, 200)
+
+        name = resp.headers['X-Profile']
+        self.assertTrue(name.endswith('-views.user_page'))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, f'{name}.folded')))
+
+        with open(os.path.join(self.directory, f'{name}.json')) as f:
+            summary = json.load(f)
+
+        self.assertEqual(summary['endpoint'], 'views.user_page')
+        self.assertEqual(set(summary['split']), set(CATEGORIES))
+        self.assertEqual(
+            sum(c['samples'] for c in summary['split'].values()),
+            summary['samples']
+        )
+
+    def test_not_admin(self):
+        """Test non-admin can't profile requests."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u2_id
+
+            resp = client.get(f'/users/{self.u2_id}?_profile=1')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('X-Profile', resp.headers)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_disabled(self):
+        """Test nothing profiled when profiler disabled."""
+
+        self.settings.enabled = False
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get(f'/users/{self.u1_id}?_profile=1')
+
+        self.assertNotIn('X-Profile', resp.headers)
@@ -1,23 +1,14 @@
 """User model tests."""
 
-import os
-from unittest import TestCase
 
 from models import db, User, Project, Yarn, Needle, Hook, TimeLog
+from testing import create_test_app, TransactionalTestCase
 
-# set up test database before importing app because
-# app already connected to a database
-os.environ['DATABASE_URL'] = "postgresql:///craft_app_test"
+create_test_app()
 
-from app import app
-
-db.drop_all()
-db.create_all()
-
-class UserModelTestCase(TestCase):
+class UserModelTestCase(TransactionalTestCase):
     def setUp(self):
-        Project.query.delete()
-        User.query.delete()
+        super().setUp()
 
         u1 = User.signup(
             username="u1",
@@ -0,0 +1,107 @@
+"""Read-only request tests."""
+
+from flask import g
+from sqlalchemy import text
+from sqlalchemy.exc import InternalError
+
+from models import db, User, Project
+from testing import create_test_app, postgres_only, TransactionalTestCase
+
+app = create_test_app()
+
+
+class ReadOnlyRequestTestCase(TransactionalTestCase):
+    # the test session always uses the test's connection, never the
+    # read-only view of the engine a request would use
+    transactional = False
+
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup('u1', 'u1@email.com', None, 'password')
+        db.session.add(u1)
+        db.session.commit()
+
+        self.u1_id = u1.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_get(self):
+        """Test GET request read-only, and session settings restored after."""
+
+        with app.test_request_context(f'/users/{self.u1_id}'):
+            app.preprocess_request()
+
+            self.assertTrue(g.read_only)
+            self.assertFalse(db.session.autoflush)
+            self.assertFalse(db.session().expire_on_commit)
+
+        self.assertTrue(db.session.autoflush)
+        self.assertTrue(db.session().expire_on_commit)
+
+    def test_post(self):
+        """Test POST request not read-only."""
+
+        with app.test_request_context(
+                f'/users/{self.u1_id}/follow', method='POST'):
+            app.preprocess_request()
+
+            self.assertFalse(g.read_only)
+            self.assertTrue(db.session.autoflush)
+
+    def test_conversation(self):
+        """Test GET request to a conversation read-only; marking it read
+        is a POST."""
+
+        with app.test_request_context('/conversations/1'):
+            app.preprocess_request()
+
+            self.assertTrue(g.read_only)
+
+        with app.test_request_context(
+                '/api/conversations/1/read', method='POST'):
+            app.preprocess_request()
+
+            self.assertFalse(g.read_only)
+
+    @postgres_only
+    def test_read_only_transaction(self):
+        """Test GET request's writes rejected by the database."""
+
+        with app.test_request_context(f'/users/{self.u1_id}'):
+            app.preprocess_request()
+
+            self.assertEqual(
+                db.session.execute(text('SHOW transaction_read_only')).scalar(),
+                'on'
+            )
+
+            with self.assertRaises(InternalError):
+                db.session.execute(
+                    db.update(User).values(image_url='written').where(
+                        User.id == self.u1_id)
+                )
+
+            db.session.rollback()
+
+        # the connection went back to the pool read-write
+        self.assertEqual(
+            db.session.execute(text('SHOW transaction_read_only')).scalar(),
+            'off'
+        )
+
+    def test_project_cards(self):
+        """Test project cards loaded as rows, pinned first."""
+
+        db.session.add_all([
+            Project(user_id=self.u1_id, title='scarf'),
+            Project(user_id=self.u1_id, title='hat', pinned=True),
+        ])
+        db.session.commit()
+        db.session.expunge_all()
+
+        cards = Project.get_cards(self.u1_id)
+
+        self.assertEqual([card.title for card in cards], ['hat', 'scarf'])
+        self.assertEqual(len(db.session.identity_map), 0)
@@ -0,0 +1,222 @@
+"""Read replica routing tests."""
+
+import time
+
+from sqlalchemy import create_engine, event, text
+
+from models import db, User, Conversation, Participant, Message
+from testing import (
+    create_test_app, postgres_only, worker_database_url, TransactionalTestCase)
+from app import CURR_USER_KEY
+from replicas import PRIMARY_UNTIL_KEY
+from follow_graph import follow_graphs
+
+app = create_test_app()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+@postgres_only
+class ReplicaRoutingTestCase(TransactionalTestCase):
+    """The replica is a second engine on the test database."""
+
+    # the replica's connections only see committed rows, and the test
+    # session would send every statement to the test's connection
+    transactional = False
+
+    def setUp(self):
+        super().setUp()
+
+        Participant.clear_cache()
+
+        u1 = User.signup('u1', 'u1@email.com', None, 'password')
+        u2 = User.signup('u2', 'u2@email.com', None, 'password')
+
+        conversation = Conversation()
+        u1.conversations.append(conversation)
+        u2.conversations.append(conversation)
+
+        db.session.add_all([u1, u2, conversation])
+        db.session.flush()
+
+        db.session.add(Message(
+            conversation_id=conversation.id,
+            user_id=u2.id,
+            text='hi'
+        ))
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.conversation_id = conversation.id
+
+        self.replica = create_engine(worker_database_url().update_query_dict(
+            {'application_name': 'replica'}))
+        app.extensions['replica_router'].replica = self.replica
+
+        # built on the primary, outside any request
+        follow_graphs.current.build(db.engine)
+
+        self.statements = {'primary': [], 'replica': []}
+
+        for name, engine in (('primary', db.engine), ('replica', self.replica)):
+            self.listen(engine, self.statements[name])
+
+    def tearDown(self):
+        app.extensions['replica_router'].replica = None
+        self.replica.dispose()
+        db.session.rollback()
+
+    def listen(self, engine, statements):
+        def on_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(engine, 'before_cursor_execute', on_execute)
+        self.addCleanup(event.remove, engine, 'before_cursor_execute', on_execute)
+
+    def login(self, client, primary_until=None):
+        with client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.u1_id
+
+            if primary_until is not None:
+                session[PRIMARY_UNTIL_KEY] = primary_until
+
+    def test_get_reads_replica(self):
+        """Test read-only GET served entirely by the replica."""
+
+        with app.test_client() as client:
+            self.login(client)
+            resp = client.get(f'/users/{self.u2_id}')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(self.statements['replica'])
+        self.assertEqual(self.statements['primary'], [])
+
+        with client.session_transaction() as session:
+            self.assertNotIn(PRIMARY_UNTIL_KEY, session)
+
+    def test_post_uses_primary(self):
+        """Test POST sent to the primary, and the user's reads stick to it."""
+
+        with app.test_client() as client:
+            self.login(client)
+            resp = client.post(f'/users/{self.u2_id}/follow')
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertTrue(self.statements['primary'])
+            self.assertEqual(self.statements['replica'], [])
+
+            resp = client.get(f'/users/{self.u2_id}/followers')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.statements['replica'], [])
+
+        with client.session_transaction() as session:
+            self.assertGreater(session[PRIMARY_UNTIL_KEY], time.time())
+
+    def test_post_without_write(self):
+        """Test POST that only reads doesn't stick the user to the primary."""
+
+        with app.test_client() as client:
+            resp = client.post(
+                '/login', data={'username': 'u1', 'password': 'wrong'})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(self.statements['primary'])
+
+        with client.session_transaction() as session:
+            self.assertNotIn(PRIMARY_UNTIL_KEY, session)
+
+    def test_stream_backlog_reads_primary(self):
+        """Test stream's missed messages read from the primary."""
+
+        m1 = Message.query.one()
+
+        with app.test_client() as client:
+            self.login(client)
+            resp = client.get(
+                f'/conversations/{self.conversation_id}/stream',
+                headers={'Last-Event-ID': str(m1.id - 1)}
+            )
+
+            events = iter(resp.response)
+            next(events)
+
+            self.assertIn(f'id: {m1.id}'.encode(), next(events))
+
+            resp.close()
+
+        self.assertTrue(any(
+            'FROM messages' in s for s in self.statements['primary']
+        ))
+        self.assertFalse(any(
+            'FROM messages' in s for s in self.statements['replica']
+        ))
+
+    def test_sticky_window_expires(self):
+        """Test reads go back to the replica once the window has passed."""
+
+        with app.test_client() as client:
+            self.login(client, primary_until=time.time() - 1)
+            client.get(f'/users/{self.u2_id}')
+
+        self.assertTrue(self.statements['replica'])
+        self.assertEqual(self.statements['primary'], [])
+
+    def test_get_with_write(self):
+        """Test reads after a GET's write go to the primary."""
+
+        with app.test_request_context(f'/users/{self.u2_id}'):
+            app.preprocess_request()
+
+            User.query.get(self.u1_id)
+            self.assertTrue(self.statements['replica'])
+            self.assertEqual(self.statements['primary'], [])
+
+            # text() statements, such as pg_notify, count as writes
+            db.session.execute(text('SELECT 1'))
+            User.query.get(self.u2_id)
+            db.session.rollback()
+
+        self.assertEqual(len(self.statements['replica']), 1)
+        self.assertIn('SELECT 1', self.statements['primary'])
+        self.assertTrue(any(
+            'FROM users' in s for s in self.statements['primary']
+        ))
+
+    def test_mark_read_uses_primary(self):
+        """Test marking a conversation read sticks the user to the primary."""
+
+        m1 = Message.query.one()
+        self.statements['primary'].clear()
+
+        with app.test_client() as client:
+            self.login(client)
+            resp = client.get(f'/conversations/{self.conversation_id}')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(self.statements['primary'], [])
+
+            resp = client.post(
+                f'/api/conversations/{self.conversation_id}/read',
+                data={'message_id': m1.id}
+            )
+
+        self.assertEqual(resp.status_code, 204)
+        self.assertTrue(any(
+            s.startswith('UPDATE participants') for s in self.statements['primary']
+        ))
+        self.assertFalse(any(
+            s.startswith('UPDATE') for s in self.statements['replica']
+        ))
+
+        with client.session_transaction() as session:
+            self.assertIn(PRIMARY_UNTIL_KEY, session)
+
+    def test_outside_request(self):
+        """Test queries outside requests use the primary."""
+
+        User.query.all()
+
+        self.assertTrue(self.statements['primary'])
+        self.assertEqual(self.statements['replica'], [])
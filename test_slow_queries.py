@@ -0,0 +1,121 @@
+"""Slow-query log tests."""
+
+import json
+import os
+import shutil
+import tempfile
+
+from sqlalchemy.exc import DBAPIError
+
+from models import db, User
+from testing import create_test_app, TransactionalTestCase, postgres_only
+from app import CURR_USER_KEY
+from slow_queries import slow_query_log, explain_analyze
+
+app = create_test_app()
+
+
+class SlowQueryLogTestCase(TransactionalTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup('u1', 'u1@email.com', None, 'password')
+        db.session.add(u1)
+        db.session.commit()
+
+        self.u1_id = u1.id
+
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'slow.log')
+
+        # log every statement
+        slow_query_log.enable(0, self.path)
+
+    def tearDown(self):
+        slow_query_log.disable()
+        shutil.rmtree(self.directory)
+        db.session.rollback()
+
+    def records(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_request_attribution(self):
+        """Test statements logged with endpoint and template call site."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get(f'/users/{self.u1_id}')
+
+        self.assertEqual(resp.status_code, 200)
+
+        records = self.records()
+
+        self.assertTrue(records)
+        self.assertTrue(all(r['endpoint'] == 'views.user_page' for r in records))
+        self.assertTrue(all(r['path'] == f'/users/{self.u1_id}' for r in records))
+
+        # user.projects|length lazy loads from the profile template
+        [lazy_load] = [
+            r for r in records
+            if r['statement'].startswith('SELECT projects.')
+            and 'users/profile.html' in r['stack'][-1]
+        ]
+
+        # named parameters on PostgreSQL, positional on SQLite
+        self.assertIn(lazy_load['parameters'], ({'param_1': 'int'}, ['int']))
+        self.assertRegex(
+            lazy_load['stack'][-1],
+            r'users/profile\.html:\d+ \(template block content\)$'
+        )
+        self.assertIn('app.py:', ' '.join(lazy_load['stack']))
+
+    def test_parameter_values_not_logged(self):
+        """Test only parameter types are written."""
+
+        User.login('u1', 'password')
+
+        [record] = [r for r in self.records() if 'users.username =' in r['statement']]
+
+        parameters = record['parameters']
+
+        if isinstance(parameters, dict):
+            parameters = list(parameters.values())
+
+        self.assertEqual(parameters, ['str'])
+        self.assertNotIn('u1', json.dumps(record['parameters']))
+        self.assertIsNone(record['endpoint'])
+        self.assertTrue(record['stack'][-1].startswith('models.py:'))
+
+    @postgres_only
+    def test_explain_analyze(self):
+        """Test sampled SELECTs logged with their plan."""
+
+        slow_query_log.enable(0, self.path, explain_rate=1)
+
+        User.query.filter(User.id == self.u1_id).one()
+
+        [record] = self.records()
+
+        self.assertTrue(any('actual time' in line for line in record['explain']))
+
+    @postgres_only
+    def test_explain_in_failed_transaction(self):
+        """Test EXPLAIN that can't run returns the error instead of raising."""
+
+        slow_query_log.disable()
+
+        with db.engine.connect() as connection:
+            with self.assertRaises(DBAPIError):
+                connection.exec_driver_sql('SELECT 1 / 0')
+
+            # every statement fails until the transaction is rolled back
+            plan = explain_analyze(
+                connection.connection.dbapi_connection, 'SELECT 1', None)
+
+            connection.rollback()
+
+        self.assertEqual(len(plan), 1)
+        self.assertTrue(plan[0].startswith('EXPLAIN failed:'))
@@ -0,0 +1,89 @@
+"""SQL timing tests."""
+
+import json
+
+from models import db, User
+from testing import create_test_app, TransactionalTestCase, TEST_BCRYPT_LOG_ROUNDS
+from app import CURR_USER_KEY, create_app
+from sql_timing import sql_timing
+
+app = create_test_app()
+
+
+class SQLTimingTestCase(TransactionalTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup('u1', 'u1@email.com', None, 'password')
+        db.session.add(u1)
+        db.session.commit()
+
+        self.u1_id = u1.id
+
+        sql_timing.enable()
+
+    def tearDown(self):
+        sql_timing.disable()
+        db.session.rollback()
+
+    def test_server_timing_header(self):
+        """Test statement count and times sent with response."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            with self.assertLogs('sql_timing', 'INFO') as logs:
+                resp = client.get(f'/users/{self.u1_id}')
+
+        self.assertEqual(resp.status_code, 200)
+
+        timing = resp.headers['Server-Timing']
+        self.assertRegex(timing, r'^db;dur=[\d.]+;desc="\d+ queries", ')
+        self.assertIn('db-slowest;dur=', timing)
+        self.assertIn('app;dur=', timing)
+
+        [line] = logs.records
+        record = json.loads(line.getMessage())
+
+        self.assertEqual(record['endpoint'], 'views.user_page')
+        self.assertEqual(record['status'], 200)
+        self.assertGreater(record['statements'], 0)
+        self.assertIn(f'{record["statements"]} queries', timing)
+        self.assertIn('SELECT', record['slowest_statement'])
+
+    def test_disabled(self):
+        """Test nothing recorded or sent when disabled."""
+
+        sql_timing.disable()
+
+        with app.test_client() as client:
+            resp = client.get('/')
+
+        self.assertNotIn('Server-Timing', resp.headers)
+
+    def test_apps_timed_separately(self):
+        """Test each app's engines switched on and off by its own setting."""
+
+        other = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+            'SQL_TIMING': True,
+            'BCRYPT_LOG_ROUNDS': TEST_BCRYPT_LOG_ROUNDS,
+        })
+
+        try:
+            sql_timing.disable()
+
+            with other.app_context():
+                self.assertTrue(sql_timing.enabled)
+
+                resp = other.test_client().get('/login')
+
+            self.assertIn('Server-Timing', resp.headers)
+            self.assertFalse(sql_timing.enabled)
+
+        finally:
+            sql_timing.disable(other)
+
+            with other.app_context():
+                db.engine.dispose()
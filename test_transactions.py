@@ -0,0 +1,139 @@
+"""Unit of work tests."""
+
+from models import db, User, Project, Needle, Hook, Request, Follow, Message
+from testing import create_test_app, count_round_trips, TransactionalTestCase
+from app import CURR_USER_KEY
+from transactions import unit_of_work
+
+app = create_test_app()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class UnitOfWorkTestCase(TransactionalTestCase):
+    # counts real commits, which the test transaction would turn into
+    # SAVEPOINTs
+    transactional = False
+
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup('u1', 'u1@email.com', None, 'password')
+        u2 = User.signup('u2', 'u2@email.com', None, 'password')
+
+        db.session.add_all([
+            u1,
+            u2,
+            Needle(size='US 1 - 2.25 mm'),
+            Needle(size='US 2 - 2.75 mm'),
+            Hook(size='0.6 mm'),
+        ])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_unit_of_work_commits(self):
+        """Test changes in block committed once together."""
+
+        with count_round_trips() as counts:
+            with unit_of_work():
+                db.session.add(Project(user_id=self.u1_id, title='a'))
+                db.session.add(Project(user_id=self.u1_id, title='b'))
+
+        self.assertEqual(counts['commits'], 1)
+        self.assertEqual(Project.query.count(), 2)
+
+    def test_unit_of_work_rolls_back(self):
+        """Test error in block discards all of its changes."""
+
+        with self.assertRaises(ValueError):
+            with unit_of_work():
+                db.session.add(Project(user_id=self.u1_id, title='a'))
+                db.session.flush()
+                raise ValueError()
+
+        self.assertEqual(Project.query.count(), 0)
+
+    def test_confirm_request_round_trips(self):
+        """Test confirming request is one transaction."""
+
+        db.session.add(Request(
+            user_being_requested_id=self.u1_id,
+            user_requesting_id=self.u2_id
+        ))
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            with count_round_trips() as counts:
+                resp = client.post(f'/requests/{self.u2_id}/confirm')
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(counts['commits'], 1)
+        self.assertLessEqual(counts['statements'], 6)
+        self.assertEqual(Request.query.count(), 0)
+        self.assertEqual(Follow.query.count(), 1)
+
+    def test_confirm_missing_request_rolls_back(self):
+        """Test confirming missing request changes nothing."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            with count_round_trips() as counts:
+                resp = client.post(f'/requests/{self.u2_id}/confirm')
+
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(counts['commits'], 0)
+        self.assertEqual(Follow.query.count(), 0)
+
+    def test_add_project_round_trips(self):
+        """Test adding project with needles and hooks is one transaction."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            with count_round_trips() as counts:
+                resp = client.post('/projects/new', data={
+                    'title': 'scarf',
+                    'needles-0-size': 'US 1 - 2.25 mm',
+                    'needles-1-size': 'US 2 - 2.75 mm',
+                    'hooks-0-size': '0.6 mm',
+                })
+
+        project = Project.query.one()
+
+        self.assertEqual(resp.location, f'/projects/{project.id}')
+        self.assertEqual(counts['commits'], 1)
+        self.assertLessEqual(counts['statements'], 7)
+        self.assertEqual(
+            sorted(n.size for n in project.needles),
+            ['US 1 - 2.25 mm', 'US 2 - 2.75 mm']
+        )
+        self.assertEqual([h.size for h in project.hooks], ['0.6 mm'])
+
+    def test_new_conversation_round_trips(self):
+        """Test starting conversation is one transaction."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            with count_round_trips() as counts:
+                resp = client.post(
+                    '/conversations/new',
+                    data={'recipient': 'u2', 'message': 'hi'}
+                )
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(counts['commits'], 1)
+        self.assertLessEqual(counts['statements'], 11)
+        self.assertEqual(Message.query.count(), 1)
@@ -1,26 +1,16 @@
 """User model tests."""
 
-import os
 from sqlalchemy.exc import IntegrityError
-from unittest import TestCase
-from flask_bcrypt import Bcrypt
 
-from models import db, User, DEFAULT_IMG_URL
+from models import db, bcrypt, User, Follow, Request, Notification, DEFAULT_IMG_URL
+from testing import create_test_app, TransactionalTestCase
 
-# set up test database before importing app because
-# app already connected to a database
-os.environ['DATABASE_URL'] = "postgresql:///craft_app_test"
+create_test_app()
 
-from app import app
 
-bcrypt = Bcrypt()
-
-db.drop_all()
-db.create_all()
-
-class UserModelTestCase(TestCase):
+class UserModelTestCase(TransactionalTestCase):
     def setUp(self):
-        User.query.delete()
+        super().setUp()
 
         hashed_password = (bcrypt
             .generate_password_hash("password")
@@ -153,6 +143,33 @@ class UserModelTestCase(TestCase):
         self.assertEqual(u1.following, [])
         self.assertEqual(u2.following, [u1])
 
+    def test_follow_add(self):
+        """Test Follow class method, add, is idempotent."""
+
+        Follow.add(self.u1_id, self.u2_id)
+        Follow.add(self.u1_id, self.u2_id)
+        db.session.commit()
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        self.assertEqual(u1.followers, [u2])
+        self.assertEqual(u2.following, [u1])
+
+    def test_follow_remove(self):
+        """Test Follow class method, remove."""
+
+        Follow.add(self.u1_id, self.u2_id)
+        db.session.commit()
+
+        Follow.remove(self.u1_id, self.u2_id)
+        Follow.remove(self.u1_id, self.u2_id)
+        db.session.commit()
+
+        u1 = User.query.get(self.u1_id)
+
+        self.assertEqual(u1.followers, [])
+
     def test_is_following(self):
         """Test User class method, is_following."""
 
@@ -177,6 +194,27 @@ class UserModelTestCase(TestCase):
         self.assertTrue(u1.is_followed_by(u2))
         self.assertFalse(u2.is_followed_by(u1))
 
+    def test_get_with_visibility(self):
+        """Test User class method, get_with_visibility."""
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        u2.private = True
+        db.session.commit()
+
+        user, can_view = User.get_with_visibility(self.u2_id, self.u1_id)
+        self.assertEqual(user, u2)
+        self.assertFalse(can_view)
+
+        self.assertTrue(User.get_with_visibility(self.u2_id, self.u2_id).can_view)
+        self.assertTrue(User.get_with_visibility(self.u1_id, self.u2_id).can_view)
+
+        u1.following.append(u2)
+        db.session.commit()
+
+        self.assertTrue(User.get_with_visibility(self.u2_id, self.u1_id).can_view)
+        self.assertIsNone(User.get_with_visibility(0, self.u1_id))
+
     # #################### Request tests
 
     def test_requests(self):
@@ -191,4 +229,142 @@ class UserModelTestCase(TestCase):
         self.assertEqual(u1.requests_received, [u2])
         self.assertEqual(u2.requests_received, [])
         self.assertEqual(u1.requests_made, [])
-        self.assertEqual(u2.requests_made, [u1])
\ No newline at end of file
+        self.assertEqual(u2.requests_made, [u1])
+
+    def test_request_add(self):
+        """Test Request class method, add, is idempotent."""
+
+        Request.add(self.u1_id, self.u2_id)
+        Request.add(self.u1_id, self.u2_id)
+        db.session.commit()
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        self.assertEqual(u1.requests_received, [u2])
+        self.assertEqual(u2.requests_made, [u1])
+
+    def test_request_remove(self):
+        """Test Request class method, remove."""
+
+        Request.add(self.u1_id, self.u2_id)
+        db.session.commit()
+
+        Request.remove(self.u1_id, self.u2_id)
+        db.session.commit()
+
+        u1 = User.query.get(self.u1_id)
+
+        self.assertEqual(u1.requests_received, [])
+
+    def test_request_accept(self):
+        """Test Request class method, accept, for a single request."""
+
+        Request.add(self.u1_id, self.u2_id)
+        db.session.commit()
+
+        self.assertEqual(Request.accept(self.u1_id, self.u2_id), 1)
+        db.session.commit()
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        self.assertEqual(u1.requests_received, [])
+        self.assertEqual(u1.followers, [u2])
+
+    def test_request_accept_missing(self):
+        """Test Request class method, accept, with no such request."""
+
+        self.assertEqual(Request.accept(self.u1_id, self.u2_id), 0)
+        db.session.commit()
+
+        self.assertEqual(User.query.get(self.u1_id).followers, [])
+
+    def test_request_accept_all(self):
+        """Test Request class method, accept, for all pending requests."""
+
+        u3 = User(username='u3', email='u3@email.com', password='password')
+        db.session.add(u3)
+        db.session.commit()
+
+        Request.add(self.u1_id, self.u2_id)
+        Request.add(self.u1_id, u3.id)
+        Request.add(self.u2_id, u3.id)
+        Follow.add(self.u1_id, u3.id)
+        db.session.commit()
+
+        self.assertEqual(Request.accept(self.u1_id), 2)
+        db.session.commit()
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        self.assertEqual(u1.requests_received, [])
+        self.assertEqual(len(u1.followers), 2)
+        self.assertEqual(u2.requests_received, [u3])
+
+    def test_request_deny_all(self):
+        """Test Request class method, deny, for all pending requests."""
+
+        Request.add(self.u1_id, self.u2_id)
+        db.session.commit()
+
+        self.assertEqual(Request.deny(self.u1_id), 1)
+        db.session.commit()
+
+        u1 = User.query.get(self.u1_id)
+
+        self.assertEqual(u1.requests_received, [])
+        self.assertEqual(u1.followers, [])
+
+    # #################### Notification tests
+
+    def test_follow_notifications(self):
+        """Test follows and requests append notifications once."""
+
+        Request.add(self.u1_id, self.u2_id)
+        Request.add(self.u1_id, self.u2_id)
+        Request.accept(self.u1_id)
+        Follow.add(self.u2_id, self.u1_id)
+        Follow.add(self.u2_id, self.u1_id)
+        db.session.commit()
+
+        u1_events, _ = Notification.get_page(self.u1_id)
+        u2_events, _ = Notification.get_page(self.u2_id)
+
+        self.assertEqual(
+            [(e.kind, e.actor_username) for e in u1_events],
+            [(Notification.FOLLOW_REQUEST, 'u2')]
+        )
+        self.assertEqual(
+            [(e.kind, e.actor_username) for e in u2_events],
+            [
+                (Notification.NEW_FOLLOWER, 'u1'),
+                (Notification.FOLLOW_ACCEPTED, 'u1'),
+            ]
+        )
+
+    def test_notification_pages(self):
+        """Test notifications paged newest first without gaps or repeats."""
+
+        for _ in range(Notification.PAGE_SIZE + 5):
+            db.session.add(Notification(
+                user_id=self.u1_id,
+                actor_id=self.u2_id,
+                kind=Notification.NEW_FOLLOWER
+            ))
+        db.session.commit()
+
+        first, cursor = Notification.get_page(self.u1_id)
+        second, last_cursor = Notification.get_page(self.u1_id, cursor)
+
+        ids = [n.id for n in first + second]
+
+        self.assertEqual(len(first), Notification.PAGE_SIZE)
+        self.assertEqual(len(second), 5)
+        self.assertIsNone(last_cursor)
+        self.assertEqual(ids, sorted(set(ids), reverse=True))
+        self.assertEqual(
+            Notification.decode_cursor(Notification.encode_cursor(cursor)),
+            cursor
+        )
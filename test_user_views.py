@@ -1,26 +1,40 @@
 """User View tests."""
 
-import os
-from unittest import TestCase
-from models import db, User, DEFAULT_IMG_URL
+from unittest import mock
 
-# set up test database before importing app because
-# app already connected to a database
-os.environ['DATABASE_URL'] = "postgresql:///craft_app_test"
+from models import (
+    db, User, Project, Follow, Request, Notification, DEFAULT_IMG_URL)
+from testing import create_test_app, TransactionalTestCase, query_budget
+from app import CURR_USER_KEY
+from follow_graph import FollowGraph
 
-from app import app, CURR_USER_KEY
-
-db.drop_all()
-db.create_all()
+app = create_test_app()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# most statements each route may send while handling one request; tests
+# decorated with query_budget fail if a change goes over, e.g. a template
+# lazy loading a relationship per card
+QUERY_BUDGETS = {
+    'views.user_list': 5,
+    'views.user_profile': 7,
+    'views.settings': 3,
+    'views.notifications': 5,
+    'views.user_page': 9,
+    'views.project_details': 8,
+    'views.user_following': 7,
+    'views.user_followers': 8,
+    # SQLite can't notify the followed user in the same statement
+    'views.follow_user': {'postgresql': 4, 'sqlite': 5},
+    'views.unfollow_user': 4,
+}
+
 NONEXISTENT_USER_ID = 0
 
 
-class UserBaseViewTestCase(TestCase):
+class UserBaseViewTestCase(TransactionalTestCase):
     def setUp(self):
-        User.query.delete()
+        super().setUp()
 
         u1 = User.signup('u1', 'u1@email.com', None, 'password')
         u2 = User.signup('u2', 'u2@email.com', None, 'password')
@@ -39,6 +53,7 @@ class UserBaseViewTestCase(TestCase):
         db.session.rollback()
 
 class UserListTestCase(UserBaseViewTestCase):
+    @query_budget(QUERY_BUDGETS)
     def test_show_all_users(self):
         """Test user list without search query."""
         with app.test_client() as client:
@@ -67,6 +82,7 @@ class UserListTestCase(UserBaseViewTestCase):
             self.assertIn('Unauthorized', html)
             self.assertIn('for testing anon home', html)
 
+    @query_budget(QUERY_BUDGETS)
     def test_show_search_users(self):
         """Test user list with search query."""
         with app.test_client() as client:
@@ -197,6 +213,32 @@ class UserLoginTestCase(UserBaseViewTestCase):
             self.assertIn('for testing profile page', html)
             self.assertIn('u1', html)
 
+    def test_login_csrf_token_per_session(self):
+        """Test each session's login form gets a token valid for it."""
+
+        app.config['WTF_CSRF_ENABLED'] = True
+
+        try:
+            with app.test_client() as other_client:
+                other_client.get('/login')
+
+            with app.test_client() as client:
+                html = client.get('/login').get_data(as_text=True)
+                token = html.split('name="csrf_token" type="hidden" value="')[1].split('"')[0]
+
+                resp = client.post(
+                    '/login',
+                    data={
+                        'username': 'u1',
+                        'password': 'password',
+                        'csrf_token': token
+                    }
+                )
+
+            self.assertEqual(resp.status_code, 302)
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = False
+
     def test_invalid_login_bad_username(self):
         """Test logging in with bad username"""
 
@@ -265,6 +307,7 @@ class UserLogoutTestCase(UserBaseViewTestCase):
 
 
 class UserProfileTestCase(UserBaseViewTestCase):
+    @query_budget(QUERY_BUDGETS)
     def test_profile_page(self):
         """Test user profile page."""
         with app.test_client() as client:
@@ -278,6 +321,30 @@ class UserProfileTestCase(UserBaseViewTestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('for testing profile page', html)
             self.assertIn('u1', html)
+            self.assertNotIn('for testing suggestions', html)
+
+    @query_budget(QUERY_BUDGETS)
+    def test_profile_page_suggestions(self):
+        """Test profile suggests users followed by users user follows."""
+
+        Follow.add(self.u2_id, self.u1_id)
+        Follow.add(self.u3_id, self.u2_id)
+        Follow.add(self.u4_id, self.u2_id)
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get('/profile')
+
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('for testing suggestions', html)
+            self.assertIn(f'href="/users/{self.u3_id}"', html)
+            self.assertIn(f'href="/users/{self.u4_id}"', html)
+            self.assertIn('Following 1', html)
 
     def test_unuathorized_profile_page(self):
         """Test unauthorized user profile page access."""
@@ -293,6 +360,7 @@ class UserProfileTestCase(UserBaseViewTestCase):
 
 
 class UserSettingsTestCase(UserBaseViewTestCase):
+    @query_budget(QUERY_BUDGETS)
     def test_get_settings_page(self):
         """Test user settings page."""
         with app.test_client() as client:
@@ -362,6 +430,7 @@ class UserSettingsTestCase(UserBaseViewTestCase):
 
 
 class UserNotificationsTestCase(UserBaseViewTestCase):
+    @query_budget(QUERY_BUDGETS)
     def test_notifications_page(self):
         """Test notifications page."""
         u1 = User.query.get(self.u1_id)
@@ -382,6 +451,54 @@ class UserNotificationsTestCase(UserBaseViewTestCase):
             self.assertIn('for testing notifications page', html)
             self.assertIn('u2', html)
 
+    @query_budget(QUERY_BUDGETS)
+    def test_notifications_page_events(self):
+        """Test notifications page pages through events."""
+
+        for _ in range(Notification.PAGE_SIZE + 1):
+            db.session.add(Notification(
+                user_id=self.u1_id,
+                actor_id=self.u2_id,
+                kind=Notification.NEW_FOLLOWER
+            ))
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get('/notifications')
+
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                html.count('started following you'),
+                Notification.PAGE_SIZE
+            )
+            self.assertIn('Older notifications', html)
+
+            older = html.split('/notifications?before=')[1].split('"')[0]
+
+            resp = client.get(f'/notifications?before={older}')
+
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(html.count('started following you'), 1)
+            self.assertNotIn('Older notifications', html)
+
+    def test_notifications_page_bad_cursor(self):
+        """Test notifications page with malformed cursor."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get('/notifications?before=nonsense')
+
+            self.assertEqual(resp.status_code, 400)
+
     def test_unauthorized_notifications_page(self):
         """Test unauthorized notifications page access."""
 
@@ -396,6 +513,7 @@ class UserNotificationsTestCase(UserBaseViewTestCase):
 
 
 class UserPageTestCase(UserBaseViewTestCase):
+    @query_budget(QUERY_BUDGETS)
     def test_own_user_page(self):
         """Test viewing own user page"""
 
@@ -414,6 +532,7 @@ class UserPageTestCase(UserBaseViewTestCase):
             self.assertIn('Log time', html)
             self.assertNotIn('formaction="/users/{{user.id}}/follow"', html)
 
+    @query_budget(QUERY_BUDGETS)
     def test_other_user_page(self):
         """Test viewing other's user page"""
 
@@ -432,6 +551,29 @@ class UserPageTestCase(UserBaseViewTestCase):
             self.assertNotIn('Log time', html)
             self.assertIn('for testing follow button', html)
 
+    @query_budget(QUERY_BUDGETS)
+    def test_followed_by_following(self):
+        """Test user page lists users viewer follows who follow user."""
+
+        Follow.add(self.u2_id, self.u1_id)
+        Follow.add(self.u3_id, self.u1_id)
+        Follow.add(self.u4_id, self.u2_id)
+        Follow.add(self.u4_id, self.u3_id)
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get(f'/users/{self.u4_id}')
+
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('for testing followed by', html)
+            self.assertIn('Followed by u2, u3', html)
+            self.assertIn('2 Followers', html)
+
     def test_unauthorized_user_page(self):
         """Test unauthorized access to user page"""
 
@@ -445,6 +587,7 @@ class UserPageTestCase(UserBaseViewTestCase):
             self.assertIn('for testing anon home', html)
             self.assertIn('Unauthorized', html)
 
+    @query_budget(QUERY_BUDGETS)
     def test_private_user_page(self):
         """Test private user page"""
 
@@ -463,6 +606,7 @@ class UserPageTestCase(UserBaseViewTestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('Account is private', html)
 
+    @query_budget(QUERY_BUDGETS)
     def test_authorized_private_user_page(self):
         """Test private user page of user being followed"""
 
@@ -472,6 +616,7 @@ class UserPageTestCase(UserBaseViewTestCase):
 
         u1 = User.query.get(self.u1_id)
         u1.following.append(u2)
+        db.session.commit()
 
         with app.test_client() as client:
             with client.session_transaction() as session:
@@ -485,6 +630,65 @@ class UserPageTestCase(UserBaseViewTestCase):
             self.assertIn('for testing profile page', html)
             self.assertNotIn('Account is private', html)
 
+    @query_budget(QUERY_BUDGETS)
+    def test_private_project_details(self):
+        """Test project page of private user not being followed"""
+
+        u2 = User.query.get(self.u2_id)
+        u2.private = True
+        project = Project(user_id=self.u2_id, title='secret scarf')
+        db.session.add(project)
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get(f'/projects/{project.id}')
+
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Account is private', html)
+            self.assertNotIn('secret scarf', html)
+
+    @query_budget(QUERY_BUDGETS)
+    def test_authorized_private_project_details(self):
+        """Test project page of private user being followed"""
+
+        u2 = User.query.get(self.u2_id)
+        u2.private = True
+        project = Project(user_id=self.u2_id, title='shared scarf')
+        db.session.add(project)
+        db.session.commit()
+
+        u1 = User.query.get(self.u1_id)
+        u1.following.append(u2)
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get(f'/projects/{project.id}')
+
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('for testing project page', html)
+            self.assertIn('shared scarf', html)
+
+    def test_nonexistent_project_details(self):
+        """Test project page of project that doesn't exist"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get('/projects/0')
+
+            self.assertEqual(resp.status_code, 404)
+
     # def test_nonexistent_user_page(self):
     #     """Test unauthorized access to user page"""
 
@@ -540,6 +744,30 @@ class UserPrivateTestCase(UserBaseViewTestCase):
             self.assertIn('Account now public', html)
             self.assertIn('for testing settings page', html)
 
+    def test_unprivate_user_accepts_requests(self):
+        """Test unprivating user accepts pending follow requests"""
+
+        u1 = User.query.get(self.u1_id)
+        u1.private = True
+        u1.requests_received.append(User.query.get(self.u2_id))
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.post('/settings/unprivate', follow_redirects=True)
+
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Confirmed 1 pending follow requests', html)
+
+        u1 = User.query.get(self.u1_id)
+
+        self.assertEqual(u1.requests_received, [])
+        self.assertEqual([u.id for u in u1.followers], [self.u2_id])
+
     def test_unauthorized_unprivate_user(self):
         """Test unauthorized unprivating of user"""
 
@@ -552,7 +780,32 @@ class UserPrivateTestCase(UserBaseViewTestCase):
             self.assertIn('Unauthorized', html)
             self.assertIn('for testing anon home', html)
 
+    def test_follow_then_view_without_graph(self):
+        """Test pages after a follow while the follow graph isn't built,
+        as on in-memory SQLite, where a request can't build it."""
+
+        Follow.add(self.u3_id, self.u2_id)
+        db.session.commit()
+
+        with mock.patch.dict(app.extensions, {'follow_graph': FollowGraph()}):
+            with app.test_client() as client:
+                with client.session_transaction() as session:
+                    session[CURR_USER_KEY] = self.u1_id
+
+                resp = client.post(f'/users/{self.u2_id}/follow')
+                self.assertEqual(resp.status_code, 302)
+
+                resp = client.get(f'/users/{self.u3_id}')
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn('1 Follower', resp.get_data(as_text=True))
+
+                resp = client.get('/profile')
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn('Following 1', resp.get_data(as_text=True))
+
+
 class UserFollowingPageTestCase(UserBaseViewTestCase):
+    @query_budget(QUERY_BUDGETS)
     def test_user_following_page(self):
         """Test user following page"""
 
@@ -562,8 +815,12 @@ class UserFollowingPageTestCase(UserBaseViewTestCase):
 
             u1 = User.query.get(self.u1_id)
             u2 = User.query.get(self.u2_id)
+            u3 = User.query.get(self.u3_id)
+            u4 = User.query.get(self.u4_id)
 
-            u1.following.append(u2)
+            # several cards, so a query per card goes over budget
+            for u in (u2, u3, u4):
+                Follow.add(u.id, u1.id)
             db.session.commit()
 
             resp = client.get(f'/users/{self.u1_id}/following')
@@ -573,6 +830,8 @@ class UserFollowingPageTestCase(UserBaseViewTestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('for testing following page', html)
             self.assertIn('u2', html)
+            self.assertIn('u3', html)
+            self.assertIn('u4', html)
 
     def test_unauthorized_user_following_page(self):
         """Test unauthorized access to user following page"""
@@ -601,6 +860,7 @@ class UserFollowingPageTestCase(UserBaseViewTestCase):
     #         self.assertEqual(resp.status_code, 404)
 
 class UserFollowersPageTestCase(UserBaseViewTestCase):
+    @query_budget(QUERY_BUDGETS)
     def test_user_followers_page(self):
         """Test user followers page"""
 
@@ -610,8 +870,12 @@ class UserFollowersPageTestCase(UserBaseViewTestCase):
 
             u1 = User.query.get(self.u1_id)
             u2 = User.query.get(self.u2_id)
+            u3 = User.query.get(self.u3_id)
+            u4 = User.query.get(self.u4_id)
 
-            u1.followers.append(u2)
+            # several cards, so a query per card goes over budget
+            for u in (u2, u3, u4):
+                Follow.add(u1.id, u.id)
             db.session.commit()
 
             resp = client.get(f'/users/{self.u1_id}/followers')
@@ -621,6 +885,61 @@ class UserFollowersPageTestCase(UserBaseViewTestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('for testing followers page', html)
             self.assertIn('u2', html)
+            self.assertIn('u3', html)
+            self.assertIn('u4', html)
+
+    @query_budget(QUERY_BUDGETS)
+    def test_user_followers_page_buttons(self):
+        """Test followers page buttons show whom viewer follows or asked to"""
+
+        Follow.add(self.u2_id, self.u3_id)
+        Follow.add(self.u2_id, self.u4_id)
+        Follow.add(self.u3_id, self.u1_id)
+        Request.add(self.u4_id, self.u1_id)
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get(f'/users/{self.u2_id}/followers')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f'formaction="/users/{self.u2_id}/follow"', html)
+            self.assertIn(f'formaction="/users/{self.u3_id}/unfollow"', html)
+            self.assertIn(f'formaction="/users/{self.u4_id}/cancel_request"', html)
+
+    @query_budget(QUERY_BUDGETS)
+    def test_user_followers_page_more(self):
+        """Test followers page shows a page of followers and a link to more"""
+
+        for user_id in (self.u2_id, self.u3_id, self.u4_id):
+            Follow.add(self.u1_id, user_id)
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            with mock.patch('models.NUM_FOLLOWS_SHOWN', 2):
+                resp = client.get(f'/users/{self.u1_id}/followers')
+                html = resp.get_data(as_text=True)
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(html.count('class="stretched-link"'), 2)
+                self.assertIn(
+                    f'href="/users/{self.u1_id}/followers?after={self.u3_id}"',
+                    html
+                )
+
+                resp = client.get(
+                    f'/users/{self.u1_id}/followers?after={self.u3_id}')
+                html = resp.get_data(as_text=True)
+
+                self.assertEqual(html.count('class="stretched-link"'), 1)
+                self.assertIn(f'href="/users/{self.u4_id}" class="stretched-link"', html)
+                self.assertNotIn('>More followers</a>', html)
 
     def test_unauthorized_user_followers_page(self):
         """Test unauthorized access to user followers page"""
@@ -684,6 +1003,7 @@ class UserDeleteTestCase(UserBaseViewTestCase):
             self.assertIn('for testing anon home', html)
 
 class UserFollowTestCase(UserBaseViewTestCase):
+    @query_budget(QUERY_BUDGETS)
     def test_follow_public_user(self):
         """Test follow public user"""
 
@@ -784,6 +1104,50 @@ class UserFollowTestCase(UserBaseViewTestCase):
             self.assertIn('Unauthorized', html)
             self.assertIn('for testing anon home', html)
 
+    @query_budget(QUERY_BUDGETS)
+    def test_unfollow_user(self):
+        """Test unfollow user"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            u1 = User.query.get(self.u1_id)
+            u2 = User.query.get(self.u2_id)
+
+            u1.following.append(u2)
+            db.session.commit()
+
+            resp = client.post(
+                f'/users/{self.u2_id}/unfollow',
+                data={'came_from': f'/users'},
+                follow_redirects=True
+                )
+
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Unfollowed', html)
+            self.assertEqual(User.query.get(self.u1_id).following, [])
+
+    def test_follow_user_twice(self):
+        """Test following already followed user is harmless"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            for _ in range(2):
+                resp = client.post(
+                    f'/users/{self.u2_id}/follow',
+                    data={'came_from': f'/users'},
+                    follow_redirects=True
+                    )
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Now following', resp.get_data(as_text=True))
+            self.assertEqual(len(User.query.get(self.u2_id).followers), 1)
+
 class UserRequestTestCase(UserBaseViewTestCase):
     def test_cancel_follow_request(self):
         """Test cancel follow request"""
@@ -907,4 +1271,60 @@ class UserRequestTestCase(UserBaseViewTestCase):
             self.assertIn(f'Unauthorized', html)
             self.assertIn('for testing anon home', html)
 
+    def test_confirm_all_follow_requests(self):
+        """Test confirming all follow requests"""
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            u1 = User.query.get(self.u1_id)
+            u1.requests_received.append(User.query.get(self.u2_id))
+            u1.requests_received.append(User.query.get(self.u3_id))
+            db.session.commit()
+
+            resp = client.post('requests/confirm_all', follow_redirects=True)
 
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Confirmed 2 follow requests', html)
+            self.assertIn('for testing notifications page', html)
+
+        u1 = User.query.get(self.u1_id)
+
+        self.assertEqual(u1.requests_received, [])
+        self.assertEqual(len(u1.followers), 2)
+
+    def test_delete_all_follow_requests(self):
+        """Test deleting all follow requests"""
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u1_id
+
+            u1 = User.query.get(self.u1_id)
+            u1.requests_received.append(User.query.get(self.u2_id))
+            u1.requests_received.append(User.query.get(self.u3_id))
+            db.session.commit()
+
+            resp = client.post('requests/delete_all', follow_redirects=True)
+
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Deleted 2 follow requests', html)
+
+        u1 = User.query.get(self.u1_id)
+
+        self.assertEqual(u1.requests_received, [])
+        self.assertEqual(u1.followers, [])
+
+    def test_unauthorized_confirm_all_follow_requests(self):
+        """Test unauthorized confirmation of all follow requests"""
+        with app.test_client() as client:
+            resp = client.post('requests/confirm_all', follow_redirects=True)
+
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Unauthorized', html)
+            self.assertIn('for testing anon home', html)
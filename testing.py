@@ -0,0 +1,294 @@
+"""Helpers shared by the test files.
+
+Each test file gets the app pointed at the test database from
+create_test_app():
+
+    from testing import create_test_app
+
+    app = create_test_app()
+
+Run under pytest-xdist (pytest -n 4), each worker process gets its own
+database, named after the worker, so files can run in parallel.
+
+Setting TEST_DATABASE_URL=sqlite:// runs the tests against in-memory
+SQLite instead, without a database server. Tests of PostgreSQL-only
+features are marked @postgres_only and skipped there.
+"""
+
+import os
+from contextlib import ContextDecorator, contextmanager
+from unittest import TestCase, skipUnless
+
+from flask import has_request_context, request, request_started, request_tearing_down
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+
+from app import create_app
+from models import db
+from follow_graph import follow_graphs
+
+DEFAULT_TEST_DATABASE_URL = 'postgresql:///craft_app_test'
+
+# cheapest cost bcrypt allows; hashing at the default cost dominated the
+# runtime of suites that sign users up in setUp
+TEST_BCRYPT_LOG_ROUNDS = 4
+
+MAX_LISTED_STATEMENTS = 20
+SAVEPOINT_STATEMENTS = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+_app = None
+
+
+def worker_database_url():
+    """TEST_DATABASE_URL, suffixed with the pytest-xdist worker id if any."""
+
+    url = make_url(os.environ.get('TEST_DATABASE_URL', DEFAULT_TEST_DATABASE_URL))
+    worker = os.environ.get('PYTEST_XDIST_WORKER')
+
+    if worker and url.database and url.database != ':memory:':
+        url = url.set(database=f'{url.database}_{worker}')
+
+    return url
+
+
+def create_test_app():
+    """The app under test, created once per process however many files ask.
+
+    Its database is created if it's missing and its tables are recreated,
+    and bcrypt's cost is turned down. Its app context stays pushed, so tests
+    can use db.session outside requests.
+    """
+
+    global _app
+
+    if _app is None:
+        url = worker_database_url()
+
+        if url.get_backend_name() == 'postgresql':
+            _create_database(url)
+
+        _app = create_app({
+            'SQLALCHEMY_DATABASE_URI': url.render_as_string(hide_password=False),
+            'BCRYPT_LOG_ROUNDS': TEST_BCRYPT_LOG_ROUNDS,
+        })
+        _app.app_context().push()
+
+        db.drop_all()
+        db.create_all()
+
+    return _app
+
+
+def on_postgresql():
+    return worker_database_url().get_backend_name() == 'postgresql'
+
+
+def postgres_only(test):
+    """Skip a test method or TestCase unless testing on PostgreSQL."""
+
+    return skipUnless(on_postgresql(), 'needs PostgreSQL')(test)
+
+
+def _create_database(url):
+    engine = create_engine(
+        url.set(database='postgres'), isolation_level='AUTOCOMMIT')
+
+    try:
+        with engine.connect() as connection:
+            exists = connection.execute(
+                text('SELECT 1 FROM pg_database WHERE datname = :name'),
+                {'name': url.database}
+            ).scalar()
+
+            if not exists:
+                connection.execute(text(f'CREATE DATABASE "{url.database}"'))
+    finally:
+        engine.dispose()
+
+
+class _ConnectionSession(Session):
+    """Session that always uses the connection it was bound to.
+
+    Flask-SQLAlchemy's session picks an engine per table, ignoring bind.
+    """
+
+    def get_bind(self, *args, **kwargs):
+        return self.bind
+
+
+class TransactionalTestCase(TestCase):
+    """TestCase whose tests' writes are all rolled back afterwards.
+
+    Each test gets one connection with a transaction open on it, and
+    db.session is swapped for a session bound to that connection. Its
+    commits and rollbacks only release or roll back SAVEPOINTs, so code
+    under test behaves as usual, and the whole transaction is rolled back
+    once the test and its tearDown are done. Subclasses' setUp must call
+    super().setUp() first.
+
+    Other connections never see the test's writes. Tests that need them
+    to (e.g. LISTEN/NOTIFY, or counting real commits) set transactional to
+    False to commit as usual; every table is emptied after each of them,
+    so the database is empty at the start of every test either way.
+    """
+
+    transactional = True
+
+    def setUp(self):
+        if not self.transactional:
+            self.addCleanup(_delete_all_rows)
+            return
+
+        # the graph reads follows on a connection of its own, so build it
+        # from the committed (empty) tables now; the test's follows are
+        # applied on top as they're committed
+        follow_graphs.current.build(db.engine)
+
+        connection = db.engine.connect()
+        transaction = connection.begin()
+        session = db.session
+
+        db.session = db._make_scoped_session({
+            'class_': _ConnectionSession,
+            'bind': connection,
+            'join_transaction_mode': 'create_savepoint',
+        })
+
+        def rollback():
+            db.session.remove()
+            db.session = session
+            transaction.rollback()
+            connection.close()
+
+            # the graph applied the test's follows when they were "committed"
+            follow_graphs.current.invalidate()
+
+        self.addCleanup(rollback)
+
+
+def _delete_all_rows():
+    db.session.rollback()
+
+    for table in reversed(db.metadata.sorted_tables):
+        db.session.execute(table.delete())
+
+    db.session.commit()
+    follow_graphs.current.invalidate()
+
+
+@contextmanager
+def count_round_trips():
+    """Count statements and commits sent to the database inside block."""
+
+    counts = {'statements': 0, 'commits': 0}
+
+    def on_execute(*args):
+        counts['statements'] += 1
+
+    def on_commit(*args):
+        counts['commits'] += 1
+
+    event.listen(db.engine, 'before_cursor_execute', on_execute)
+    event.listen(db.engine, 'commit', on_commit)
+
+    try:
+        yield counts
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', on_execute)
+        event.remove(db.engine, 'commit', on_commit)
+
+
+class query_budget(ContextDecorator):
+    """Fail if a request inside the block sends more statements than allowed.
+
+    Takes one budget for every request, or a dict of budgets by endpoint;
+    requests to endpoints missing from the dict aren't checked. A budget
+    can also be a dict by dialect name, for routes whose portable fallbacks
+    send more statements. Only statements run while a request is handled
+    count, so test setup and assertions don't use up the budget. Works as a
+    context manager or as a test method decorator:
+
+        QUERY_BUDGETS = {
+            'views.user_followers': 4,
+            'views.follow_user': {'postgresql': 4, 'sqlite': 5},
+        }
+
+        @query_budget(QUERY_BUDGETS)
+        def test_user_followers_page(self):
+            ...
+
+    After the block, requests holds (endpoint, statements) for each request.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.requests = []
+        self._current = None
+
+    def __enter__(self):
+        self.requests = []
+        self._current = None
+        self._engine = db.engine
+
+        event.listen(self._engine, 'before_cursor_execute', self._on_execute)
+        request_started.connect(self._on_request_started)
+        request_tearing_down.connect(self._on_request_tearing_down)
+
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self._engine, 'before_cursor_execute', self._on_execute)
+        request_started.disconnect(self._on_request_started)
+        request_tearing_down.disconnect(self._on_request_tearing_down)
+
+        if exc[0] is None:
+            self.check()
+
+        return False
+
+    def budget_for(self, endpoint):
+        budget = self.budget
+
+        if isinstance(budget, dict):
+            budget = budget.get(endpoint)
+
+        if isinstance(budget, dict):
+            budget = budget[self._engine.dialect.name]
+
+        return budget
+
+    def check(self):
+        """Raise AssertionError for the first request over its budget."""
+
+        for endpoint, statements in self.requests:
+            budget = self.budget_for(endpoint)
+
+            if budget is not None and len(statements) > budget:
+                listed = '\n'.join(
+                    f'  {i}. {" ".join(statement.split())[:200]}'
+                    for i, statement in enumerate(
+                        statements[:MAX_LISTED_STATEMENTS], 1)
+                )
+
+                raise AssertionError(
+                    f'{endpoint} sent {len(statements)} statements, '
+                    f'budget is {budget}:\n{listed}'
+                )
+
+    def _on_request_started(self, sender, **extra):
+        self._current = (request.endpoint, [])
+
+    def _on_request_tearing_down(self, sender, **extra):
+        if self._current is not None:
+            self.requests.append(self._current)
+            self._current = None
+
+    def _on_execute(self, conn, cursor, statement, *args):
+        # TransactionalTestCase turns commits into SAVEPOINT statements,
+        # which requests outside tests don't send
+        if statement.startswith(SAVEPOINT_STATEMENTS):
+            return
+
+        if self._current is not None and has_request_context():
+            self._current[1].append(statement)
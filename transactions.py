@@ -0,0 +1,39 @@
+"""Helpers for grouping a route's writes into a single transaction."""
+
+from contextlib import contextmanager
+
+from models import db
+
+
+@contextmanager
+def unit_of_work():
+    """Run block as one transaction, committed once at the end.
+
+    - Autoflush is off inside the block, so queries made while building up
+      changes don't flush them early; everything pending goes out in one
+      flush at commit. Code that needs a generated id can still flush.
+    - Objects aren't expired on commit. The request is about to end, so
+      reading attributes afterwards (e.g. project.id for a redirect) shouldn't
+      cost a reload.
+    - Any exception, including an HTTP abort, rolls the whole block back and
+      is re-raised.
+
+    Yields the session.
+    """
+
+    session = db.session()
+    expire_on_commit = session.expire_on_commit
+
+    try:
+        with session.no_autoflush:
+            yield session
+
+        session.expire_on_commit = False
+        session.commit()
+
+    except Exception:
+        session.rollback()
+        raise
+
+    finally:
+        session.expire_on_commit = expire_on_commit
@@ -0,0 +1,8 @@
+"""App for WSGI servers and flask run.
+
+    gunicorn wsgi:app
+"""
+
+from app import create_app
+
+app = create_app()